@@ -0,0 +1,156 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from magiskboot.compress import encode, iter_chunks
+from magiskboot.format import Format, check_fmt, name2fmt
+from magiskboot.magiskboot import RAMDISK_FILE
+
+STAGES = ("detect", "unpack", "hexpatch", "compress", "repack")
+
+# 合成 kernel 中一定存在的字符串, 用作 hexpatch 的目标
+HEXPATCH_PATCHES = [("736B69705F696E697472616D6673", "77616E745F696E697472616D6673")]
+
+def sample_payload(size: int):
+    # 一半随机数据一半重复数据, 压缩率接近真实的 kernel / ramdisk
+    half = size // 2
+    pattern = bytes(range(256)) * 64 + b"init.rc\x00/system/bin/sh\x00" * 256
+    body = (pattern * (half // len(pattern) + 1))[:half]
+    return os.urandom(size - half) + body
+
+def bench_compress(fmt: Format, data: bytes, workers: int):
+    start = time.perf_counter()
+    out = 0
+    for chunk in encode(fmt, iter_chunks(data), workers):
+        out += len(chunk)
+    return time.perf_counter() - start, out
+
+def _target():
+    # vendor_boot 没有 kernel, 用 ramdisk 代替
+    return "kernel" if os.path.exists("kernel") else RAMDISK_FILE
+
+def _stage(stage: str, image: str, workdir: str, workers: int):
+    # 在独立的子进程中执行, 返回 (处理的字节数, 耗时)
+    from magiskboot.bootimg import BootImage, repack, unpack
+    from magiskboot.hexpatch import hexpatch_batch
+    os.chdir(workdir)
+    start = time.perf_counter()
+    if stage == "detect":
+        with open(image, 'rb') as f:
+            check_fmt(f.read(4096), 4096)
+        BootImage(image).close()
+        size = os.path.getsize(image)
+    elif stage == "unpack":
+        unpack(image)
+        size = os.path.getsize(image)
+    elif stage == "hexpatch":
+        hexpatch_batch(_target(), HEXPATCH_PATCHES)
+        size = os.path.getsize(_target())
+    elif stage == "compress":
+        with open(_target(), 'rb') as f:
+            data = f.read()
+        fmt = json.load(open("meta.json"))["codec"]
+        start = time.perf_counter()
+        for _ in encode(name2fmt(fmt.lower()), iter_chunks(data), workers):
+            pass
+        size = len(data)
+    else:
+        repack(image, "new-boot.img")
+        size = os.path.getsize("new-boot.img")
+    return size, time.perf_counter() - start
+
+def _run_stage(stage: str, image: str, workdir: str, workers: int):
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        size, elapsed = _stage(stage, image, workdir, workers)
+    # ru_maxrss 在 Linux 上以 KB 为单位, macOS 上以字节为单位
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        rss <<= 10
+    return size, elapsed, rss
+
+def bench_suite(directory: str, kernel_size: int, ramdisk_size: int, codecs, wrappers, workers: int = 1):
+    from magiskboot.corpus import make_corpus
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for image, meta in make_corpus(directory, kernel_size, ramdisk_size, codecs, wrappers):
+        workdir = image[:-len(".img")]
+        os.makedirs(workdir, exist_ok=True)
+        with open(os.path.join(workdir, "meta.json"), 'w') as f:
+            json.dump(meta, f)
+        for stage in STAGES:
+            record = dict(meta, image=os.path.basename(image), stage=stage)
+            # 每个阶段一个新进程, 峰值 RSS 互不影响
+            with ctx.Pool(1) as pool:
+                try:
+                    size, elapsed, rss = pool.apply(_run_stage, (stage, image, workdir, workers))
+                    record.update(ok=True, bytes=size, seconds=elapsed,
+                                  mb_per_s=size / elapsed / (1 << 20) if elapsed else None,
+                                  peak_rss_mb=rss / (1 << 20))
+                except Exception as e:
+                    record.update(ok=False, error="%s: %s" % (type(e).__name__, e))
+            results.append(record)
+    return results
+
+def main_compress(args):
+    data = sample_payload(args.size << 20)
+    counts = sorted({1, 2, 4, 8, args.max_workers} & set(range(1, args.max_workers + 1)))
+    print("%-12s %8s %10s %10s %8s" % ("format", "workers", "MB/s", "out_MB", "speedup"))
+    for name in args.formats.split(","):
+        fmt = name2fmt(name)
+        try:
+            base, _ = bench_compress(fmt, data, 1)
+        except RuntimeError as e:
+            print("%-12s skipped: %s" % (name, e))
+            continue
+        for workers in counts:
+            elapsed, out = bench_compress(fmt, data, workers)
+            print("%-12s %8d %10.1f %10.2f %7.2fx" % (
+                name, workers, len(data) / elapsed / (1 << 20), out / (1 << 20), base / elapsed))
+
+def main_suite(args):
+    codecs = [name2fmt(name) for name in args.formats.split(",")]
+    wrappers = [()] + [tuple(w.split("+")) for w in args.wrappers.split(",") if w]
+    directory = args.corpus or tempfile.mkdtemp(prefix="magiskboot-corpus-")
+    try:
+        results = bench_suite(directory, args.kernel_size << 10, args.ramdisk_size << 10,
+                              codecs, wrappers, args.max_workers)
+    finally:
+        if not args.corpus:
+            shutil.rmtree(directory, ignore_errors=True)
+    out = json.dumps({"python": sys.version.split()[0], "cpus": os.cpu_count(), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
+
+def main():
+    parser = argparse.ArgumentParser(description="magiskboot benchmarks")
+    parser.add_argument("--suite", action="store_true",
+                        help="run detection/unpack/hexpatch/compress/repack over a synthetic corpus, JSON output")
+    parser.add_argument("--size", type=int, default=32, help="payload size in MB (compression benchmark)")
+    parser.add_argument("--formats", default=None, help="codecs, default gzip,xz,lz4_legacy (suite: gzip)")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--kernel-size", type=int, default=8192, help="suite: kernel payload size in KB")
+    parser.add_argument("--ramdisk-size", type=int, default=4096, help="suite: ramdisk payload size in KB")
+    parser.add_argument("--wrappers", default="mtk,dhtb,lg_bump,seandroid,avb",
+                        help="suite: wrapper combinations, '+' joins several wrappers")
+    parser.add_argument("--corpus", default=None, help="suite: keep the generated corpus in this directory")
+    parser.add_argument("-o", "--output", default=None, help="suite: write JSON here instead of stdout")
+    args = parser.parse_args()
+    if args.suite:
+        args.formats = args.formats or "gzip"
+        main_suite(args)
+    else:
+        args.formats = args.formats or "gzip,xz,lz4_legacy"
+        main_compress(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,42 @@
-#from .bootimg import unpack, repack
-from .hexpatch import hexpatch
+import sys
+from types import ModuleType
+
 from .magiskboot import *
-from .format import fmt2ext, fmt2name, name2fmt
\ No newline at end of file
+
+# 公开函数 -> 所在子模块; 第一次访问时才导入, 命令行只加载所用子命令需要的模块
+_LAZY = {
+    "unpack": "bootimg",
+    "repack": "bootimg",
+    "info": "bootimg",
+    "unpack_stream": "stream",
+    "hexpatch": "hexpatch",
+    "hexpatch_batch": "hexpatch",
+    "hexpatch_compressed": "hexpatch",
+    "Cpio": "cpio",
+    "fmt2ext": "format",
+    "fmt2name": "format",
+    "name2fmt": "format",
+}
+
+__all__ = [name for name in globals() if name.isupper()] + list(_LAZY)
+
+def __getattr__(name):
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    from importlib import import_module
+    value = getattr(import_module("." + module, __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
+
+class _Package(ModuleType):
+    def __setattr__(self, name, value):
+        # 导入子模块 hexpatch 时不覆盖同名的 hexpatch() 函数
+        if isinstance(value, ModuleType) and _LAZY.get(name) == name:
+            return
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _Package
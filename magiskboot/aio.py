@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from . import cache
+from .batch import _warmup, run_job
+from .bootimg import BootFlag, BootImage, HashedWriter, check_fmt_lg, vendor_ramdisk_file
+from .compress import iter_chunks
+from .format import COMPRESSED, Format
+from .hexpatch import hexpatch as _hexpatch
+from .magiskboot import *
+
+# asyncio 接口: 同一个事件循环里同时处理大量镜像
+#   boot = await parse("boot.img")
+#   async for data in iter_component(boot, KERNEL_FILE): ...
+#   await unpack("boot.img", "out/boot")
+#   await repack("boot.img", "new-boot.img", "out/boot")
+# 阻塞的工作都交给有界的执行器, 事件循环线程只做调度
+
+class Executors:
+    # io: 文件读写与 mmap 缺页; codec: 编解码 (zlib/lzma/bz2/lz4 会释放 GIL);
+    # proc: repack 在组件目录中执行 (依赖 cwd), 每个进程同时只跑一个任务
+    # 每个池在途的任务数不超过 workers * backlog, 满了调用方在 await 处等待, 而不是在池的队列里无限堆积
+    def __init__(self, io_workers: int = 4, codec_workers: int = 0, proc_workers: int = 0, backlog: int = 2):
+        cpus = os.cpu_count() or 1
+        self.workers = {
+            "io": io_workers,
+            "codec": codec_workers if codec_workers > 0 else cpus,
+            "proc": proc_workers if proc_workers > 0 else cpus,
+        }
+        self.backlog = backlog
+        self.pools = {}
+        # 信号量绑定在创建它的事件循环上: 按循环分别创建, 同一个 Executors (包括默认的) 可用于多次 asyncio.run
+        self.sems = weakref.WeakKeyDictionary()
+
+    def _pool(self, kind: str):
+        pool = self.pools.get(kind)
+        if pool is None:
+            n = self.workers[kind]
+            if kind == "proc":
+                pool = ProcessPoolExecutor(max_workers=n, initializer=_warmup)
+            else:
+                pool = ThreadPoolExecutor(max_workers=n, thread_name_prefix="magiskboot-" + kind)
+            self.pools[kind] = pool
+        return pool
+
+    def _sem(self, kind: str):
+        sems = self.sems.setdefault(asyncio.get_running_loop(), {})
+        sem = sems.get(kind)
+        if sem is None:
+            sem = sems[kind] = asyncio.Semaphore(self.workers[kind] * self.backlog)
+        return sem
+
+    async def run(self, kind: str, func, *args, **kwargs):
+        pool = self._pool(kind)
+        async with self._sem(kind):
+            return await asyncio.get_running_loop().run_in_executor(pool, partial(func, *args, **kwargs))
+
+    def io(self, func, *args, **kwargs):
+        return self.run("io", func, *args, **kwargs)
+
+    def codec(self, func, *args, **kwargs):
+        return self.run("codec", func, *args, **kwargs)
+
+    def proc(self, func, *args, **kwargs):
+        return self.run("proc", func, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True):
+        for pool in self.pools.values():
+            pool.shutdown(wait=wait)
+        self.pools.clear()
+        self.sems.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await asyncio.get_running_loop().run_in_executor(None, self.shutdown)
+
+_default = None
+
+def default_executors():
+    # 未指定 ex 时共用的执行器, 第一次使用时创建
+    global _default
+    if _default is None:
+        _default = Executors()
+    return _default
+
+def components(boot: BootImage):
+    # unpack 写出的组件: [(文件名, 视图, 格式), ...], 顺序与 unpack 相同, 空组件不列出
+    items = [(KERNEL_FILE, boot.kernel, boot.k_fmt), (KER_DTB_FILE, boot.kernel_dtb, Format.UNKNOWN)]
+    if boot.vendor_ramdisks:
+        for entry in boot.vendor_ramdisks:
+            frag = boot.vendor_ramdisk(entry)
+            items.append((vendor_ramdisk_file(entry), frag, check_fmt_lg(frag, len(frag))))
+    else:
+        items.append((RAMDISK_FILE, boot.ramdisk, boot.r_fmt))
+    items += [(SECOND_FILE, boot.second, Format.UNKNOWN), (EXTRA_FILE, boot.extra, boot.e_fmt),
+              (RECV_DTBO_FILE, boot.recovery_dtbo, Format.UNKNOWN), (DTB_FILE, boot.dtb, Format.UNKNOWN)]
+    return [item for item in items if len(item[1])]
+
+async def parse(image: str, ex: Executors = None):
+    # 在 io 池中映射并解析镜像; 调用者负责 boot.close()
+    ex = ex or default_executors()
+    return await ex.io(BootImage, image)
+
+async def _iter_view(buf, fmt: Format, decompress: bool, ex: Executors):
+    # 按需拉取: 每次只在执行器中产出一块 (不超过 CHUNK), 消费者不取就不会继续解压
+    if decompress and COMPRESSED(fmt):
+        # 与 bootimg.decompress 相同, 经过组件缓存 (已启用时)
+        it, run = cache.decode(fmt, buf), ex.codec
+    else:
+        # 拷贝成 bytes, 消费者不持有映射的视图
+        it, run = (bytes(c) for c in iter_chunks(buf)), ex.io
+    try:
+        while True:
+            data = await run(next, it, None)
+            if data is None:
+                break
+            yield data
+    finally:
+        # 消费者提前放弃或出错: 关闭生成器, 丢弃不完整的缓存数据
+        # (等待中被取消时生成器可能仍在执行器中运行, 之后由垃圾回收关闭)
+        try:
+            it.close()
+        except ValueError:
+            pass
+
+def iter_component(boot: BootImage, filename: str, decompress: bool = True, ex: Executors = None):
+    # 以异步迭代器产出组件 (filename 为 unpack 时的文件名) 的内容, decompress 时按组件格式解压
+    for name, buf, fmt in components(boot):
+        if name == filename:
+            return _iter_view(buf, fmt, decompress, ex or default_executors())
+    raise ValueError("No such component [%s]" % filename)
+
+async def unpack(image: str, out_dir: str = ".", skip_decomp: bool = False, hdr: bool = False,
+                 ex: Executors = None):
+    # 与 bootimg.unpack 相同的输出, 但写到 out_dir 而不是 cwd, 各组件并发写出
+    ex = ex or default_executors()
+    boot = await parse(image, ex)
+    try:
+        await ex.io(os.makedirs, out_dir, exist_ok=True)
+        if hdr:
+            await ex.io(boot.hdr.dump_hdr_file, os.path.join(out_dir, HEADER_FILE))
+        items = components(boot)
+        sums = dict.fromkeys(name for name, _, _ in items)
+
+        async def dump(filename, buf, fmt):
+            path = os.path.join(out_dir, filename)
+            await ex.io(os.makedirs, os.path.dirname(path), exist_ok=True)
+            ctx = hashlib.sha1()
+            fd = HashedWriter(await ex.io(open, path, 'wb'), ctx)
+            try:
+                async for data in _iter_view(buf, fmt, not skip_decomp, ex):
+                    await ex.io(fd.write, data)
+            finally:
+                await ex.io(fd.close)
+            src = await ex.codec(lambda: hashlib.sha1(buf).hexdigest())
+            sums[filename] = (ctx.hexdigest(), src)
+
+        await asyncio.gather(*(dump(*item) for item in items))
+
+        def write_checksums():
+            with open(os.path.join(out_dir, CHECKSUM_FILE), 'w') as fp:
+                for name, (raw, src) in sums.items():
+                    print("%s=%s %s" %(name, raw, src), file=fp)
+
+        await ex.io(write_checksums)
+        return 2 if boot.flags[BootFlag.CHROMEOS_FLAG.value] else 0
+    finally:
+        boot.close()
+
+async def hexpatch(file_path: str, from_hex: str, to_hex: str, compressed: bool = False, ex: Executors = None):
+    # compressed 时需要解压 / 重新压缩, 交给 codec 池
+    ex = ex or default_executors()
+    run = ex.codec if compressed else ex.io
+    return await run(_hexpatch, file_path, from_hex, to_hex, compressed)
+
+async def repack(src_img: str, out_img: str, work_dir: str = ".", skip_comp: bool = False,
+                 workers: int = 1, size_limit: int = 0, ex: Executors = None):
+    # 在进程池中以 work_dir 为 cwd 执行 bootimg.repack, 多个 repack 互不干扰
+    # 路径相对于调用者的 cwd; 每个进程默认只用一个编解码线程, 并发由进程数决定
+    ex = ex or default_executors()
+    result = await ex.proc(run_job, {
+        "op": "repack",
+        "image": os.path.abspath(src_img),
+        "out": os.path.abspath(out_img),
+        "workdir": os.path.abspath(work_dir),
+        "skip_comp": skip_comp,
+        "workers": workers,
+        "size_limit": size_limit,
+    })
+    print(result["log"], end="")
+    if not result["ok"]:
+        error = result["error"]
+        raise RuntimeError("Repack failed [%s]: %s: %s" %(src_img, error["type"], error["message"]))
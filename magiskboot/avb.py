@@ -0,0 +1,239 @@
+import hashlib
+from ctypes import BigEndianStructure, c_uint8, c_uint32, c_uint64, sizeof
+
+from .bootimg import AvbVBMetaImageHeader, PADDING
+
+AVB_DESCRIPTOR_TAG_HASH = 2
+
+# 流式计算摘要时每次送入 hashlib 的大小
+HASH_CHUNK = 0x1000000
+
+class AvbDescriptor(BigEndianStructure):
+    _fields_ = [
+        ("tag", c_uint64),  # uint64_t
+        ("num_bytes_following", c_uint64)  # uint64_t
+    ]
+    _pack_ = 1
+
+class AvbHashDescriptor(BigEndianStructure):
+    _fields_ = [
+        ("parent_descriptor", AvbDescriptor),
+        ("image_size", c_uint64),  # uint64_t
+        ("hash_algorithm", c_uint8 * 32),  # uint8_t[32]
+        ("partition_name_len", c_uint32),  # uint32_t
+        ("salt_len", c_uint32),  # uint32_t
+        ("digest_len", c_uint32),  # uint32_t
+        ("flags", c_uint32),  # uint32_t
+        ("reserved", c_uint8 * 60)  # uint8_t[60]
+    ]
+    _pack_ = 1
+
+class AvbRSAPublicKeyHeader(BigEndianStructure):
+    _fields_ = [
+        ("key_num_bits", c_uint32),  # uint32_t
+        ("n0inv", c_uint32)  # uint32_t
+    ]
+    _pack_ = 1
+
+# algorithm_type -> (哈希算法, RSA 位数)
+AVB_ALGORITHMS = {
+    0: (None, 0),
+    1: ("sha256", 2048),
+    2: ("sha256", 4096),
+    3: ("sha256", 8192),
+    4: ("sha512", 2048),
+    5: ("sha512", 4096),
+    6: ("sha512", 8192),
+}
+
+# PKCS#1 v1.5 签名中的 DigestInfo 前缀
+DIGEST_INFO = {
+    "sha256": bytes.fromhex("3031300d060960864801650304020105000420"),
+    "sha512": bytes.fromhex("3051300d060960864801650304020305000440"),
+}
+
+RSA_OID = bytes.fromhex("2a864886f70d010101")
+
+def stream_digest(algorithm: str, buf, start: int, size: int, salt: bytes = b""):
+    # 大块切片 memoryview 送入 hashlib, 不复制数据
+    ctx = hashlib.new(algorithm)
+    ctx.update(salt)
+    view = memoryview(buf)
+    for off in range(start, start + size, HASH_CHUNK):
+        ctx.update(view[off:min(off + HASH_CHUNK, start + size)])
+    return ctx.digest()
+
+def _der_items(buf: bytes, pos: int, end: int):
+    # 极简 DER 解析: 返回 [(tag, start, end), ...]
+    items = []
+    while pos < end:
+        tag = buf[pos]
+        length = buf[pos + 1]
+        pos += 2
+        if length & 0x80:
+            n = length & 0x7f
+            length = int.from_bytes(buf[pos:pos + n], "big")
+            pos += n
+        items.append((tag, pos, pos + length))
+        pos += length
+    return items
+
+def _der_int(buf: bytes, item):
+    return int.from_bytes(buf[item[1]:item[2]], "big")
+
+def _parse_der_key(der: bytes, start: int, end: int):
+    # 支持 PKCS#1 / PKCS#8 私钥, PKCS#1 / SubjectPublicKeyInfo 公钥, 以及 X.509 证书
+    for tag, s, e in _der_items(der, start, end):
+        if tag != 0x30:
+            continue
+        items = _der_items(der, s, e)
+        tags = [t for t, _, _ in items]
+        if len(items) >= 9 and all(t == 0x02 for t in tags[:9]):
+            return {"n": _der_int(der, items[1]), "e": _der_int(der, items[2]), "d": _der_int(der, items[3])}
+        if tags == [0x02, 0x02]:
+            return {"n": _der_int(der, items[0]), "e": _der_int(der, items[1]), "d": None}
+        if tags[:3] == [0x02, 0x30, 0x04]:
+            key = _parse_der_key(der, items[2][1], items[2][2])
+            if key:
+                return key
+        if tags[:2] == [0x30, 0x03] and RSA_OID in der[items[0][1]:items[0][2]]:
+            # BIT STRING 第一个字节为未使用位数
+            key = _parse_der_key(der, items[1][1] + 1, items[1][2])
+            if key:
+                return key
+        key = _parse_der_key(der, s, e)
+        if key:
+            return key
+    return None
+
+def load_key(path: str):
+    # PEM / DER 格式的 RSA 密钥或证书, 或 avbtool extract_public_key 导出的公钥
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.startswith(b"-----BEGIN"):
+        import base64
+        lines = [l for l in data.splitlines() if l and not l.startswith(b"-----")]
+        data = base64.b64decode(b"".join(lines))
+    elif not data.startswith(b"\x30"):
+        hdr = AvbRSAPublicKeyHeader.from_buffer_copy(data)
+        n = data[sizeof(hdr):sizeof(hdr) + hdr.key_num_bits // 8]
+        return {"n": int.from_bytes(n, "big"), "e": 65537, "d": None}
+    key = _parse_der_key(data, 0, len(data))
+    if key is None:
+        raise ValueError("Unsupported key format [%s]" % path)
+    return key
+
+def encode_public_key(n: int):
+    # avbtool 的 AvbRSAPublicKeyHeader + n + rr
+    bits = n.bit_length()
+    n0inv = (1 << 32) - pow(n, -1, 1 << 32)
+    rr = (1 << (2 * bits)) % n
+    hdr = AvbRSAPublicKeyHeader(bits, n0inv)
+    return bytes(hdr) + n.to_bytes(bits // 8, "big") + rr.to_bytes(bits // 8, "big")
+
+def _pkcs1_pad(algorithm: str, digest: bytes, bits: int):
+    t = DIGEST_INFO[algorithm] + digest
+    return b"\x00\x01" + b"\xff" * (bits // 8 - len(t) - 3) + b"\x00" + t
+
+class VBMeta:
+    # vbmeta 各个块在 buf 中的位置; buf 可以是 BootImage.map 或 repack 输出的 mmap
+    def __init__(self, buf, offset: int, hdr: AvbVBMetaImageHeader = None):
+        self.buf = buf
+        self.offset = offset
+        self.hdr = hdr if hdr is not None else AvbVBMetaImageHeader.from_buffer_copy(buf, offset)
+        self.auth = offset + sizeof(AvbVBMetaImageHeader)
+        self.aux = self.auth + self.hdr.authentication_data_block_size
+        self.algorithm, self.key_bits = AVB_ALGORITHMS.get(self.hdr.algorithm_type, (None, 0))
+
+    def public_key(self):
+        start = self.aux + self.hdr.public_key_offset
+        return bytes(self.buf[start:start + self.hdr.public_key_size])
+
+    def hash_descriptors(self):
+        # [(描述符偏移, AvbHashDescriptor 副本, partition_name, salt, digest), ...]
+        result = []
+        pos = self.aux + self.hdr.descriptors_offset
+        end = pos + self.hdr.descriptors_size
+        while pos + sizeof(AvbDescriptor) <= end:
+            desc = AvbDescriptor.from_buffer_copy(self.buf, pos)
+            if desc.tag == AVB_DESCRIPTOR_TAG_HASH:
+                h = AvbHashDescriptor.from_buffer_copy(self.buf, pos)
+                p = pos + sizeof(AvbHashDescriptor)
+                name = bytes(self.buf[p:p + h.partition_name_len])
+                p += h.partition_name_len
+                salt = bytes(self.buf[p:p + h.salt_len])
+                p += h.salt_len
+                digest = bytes(self.buf[p:p + h.digest_len])
+                result.append((pos, h, name, salt, digest))
+            pos += sizeof(AvbDescriptor) + desc.num_bytes_following
+        return result
+
+    def compute_hash(self):
+        # H(vbmeta 头 + 辅助数据块)
+        ctx = hashlib.new(self.algorithm)
+        ctx.update(self.buf[self.offset:self.auth])
+        ctx.update(self.buf[self.aux:self.aux + self.hdr.auxiliary_data_block_size])
+        return ctx.digest()
+
+    def stored(self, offset: int, size: int):
+        start = self.auth + offset
+        return bytes(self.buf[start:start + size])
+
+    def verify_signature(self, key=None):
+        # key 为 load_key 的结果; 不提供时使用 vbmeta 中嵌入的公钥 (只能证明完整性)
+        if self.algorithm is None:
+            return True
+        digest = self.compute_hash()
+        if digest != self.stored(self.hdr.hash_offset, self.hdr.hash_size):
+            return False
+        embedded = self.public_key()
+        if key is None:
+            hdr = AvbRSAPublicKeyHeader.from_buffer_copy(embedded)
+            n = int.from_bytes(embedded[sizeof(hdr):sizeof(hdr) + hdr.key_num_bits // 8], "big")
+            e = 65537
+        else:
+            n, e = key["n"], key["e"]
+            if encode_public_key(n) != embedded:
+                return False
+        sig = int.from_bytes(self.stored(self.hdr.signature_offset, self.hdr.signature_size), "big")
+        em = pow(sig, e, n).to_bytes(self.key_bits // 8, "big")
+        return em == _pkcs1_pad(self.algorithm, digest, self.key_bits)
+
+    def sign(self, key):
+        # 重新计算 vbmeta 哈希, 有私钥时重新签名; buf 必须可写
+        if self.algorithm is None:
+            return True
+        digest = self.compute_hash()
+        start = self.auth + self.hdr.hash_offset
+        self.buf[start:start + len(digest)] = digest
+        if key is None or key.get("d") is None or encode_public_key(key["n"]) != self.public_key():
+            return False
+        em = int.from_bytes(_pkcs1_pad(self.algorithm, digest, self.key_bits), "big")
+        sig = pow(em, key["d"], key["n"]).to_bytes(self.key_bits // 8, "big")
+        start = self.auth + self.hdr.signature_offset
+        self.buf[start:start + len(sig)] = sig
+        return True
+
+def verify_vbmeta(buf, vbmeta: VBMeta, key=None):
+    ok = True
+    for _, h, name, salt, digest in vbmeta.hash_descriptors():
+        algorithm = bytes(h.hash_algorithm).rstrip(b"\0").decode()
+        match = stream_digest(algorithm, buf, 0, h.image_size, salt) == digest
+        print("%-*s [%s] [%s]" % (PADDING, "AVB_HASH", name.decode(errors="replace"), "ok" if match else "mismatch"))
+        ok = ok and match
+    if vbmeta.algorithm is not None:
+        match = vbmeta.verify_signature(key)
+        print("%-*s [%s]" % (PADDING, "AVB_SIGNATURE", "ok" if match else "mismatch"))
+        ok = ok and match
+    return ok
+
+def update_hash_footer(buf, vbmeta: VBMeta, image_size: int, key=None):
+    # 原地更新 hash 描述符 (image_size 与 digest), 然后重算 vbmeta 哈希 / 签名
+    # 返回 False 表示签名未能更新 (没有对应的私钥)
+    for pos, h, name, salt, digest in vbmeta.hash_descriptors():
+        algorithm = bytes(h.hash_algorithm).rstrip(b"\0").decode()
+        h.image_size = image_size
+        buf[pos:pos + sizeof(h)] = bytes(h)
+        start = pos + sizeof(h) + h.partition_name_len + h.salt_len
+        buf[start:start + h.digest_len] = stream_digest(algorithm, buf, 0, image_size, salt)
+    return vbmeta.sign(key)
@@ -0,0 +1,110 @@
+import contextlib
+import io
+import os
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from .bootimg import info, repack, unpack
+from .hexpatch import hexpatch_batch, hexpatch_compressed
+
+# manifest 中每一项:
+#   {"op": "unpack", "image": "boot.img", "workdir": "out/boot", "skip_decomp": False, "hdr": True}
+#   {"op": "repack", "image": "boot.img", "workdir": "out/boot", "out": "new-boot.img", "skip_comp": False,
+#    "workers": 0, "size_limit": 0}
+#   {"op": "hexpatch", "image": "out/boot/kernel", "patches": [["from_hex", "to_hex"], ...], "dry_run": False,
+#    "compressed": False}
+#   {"op": "info", "image": "boot.img"}
+# 相对路径以 workdir 为基准, 与单独运行 magiskboot 时一样在 workdir 中读写组件文件
+# 任务之间没有先后依赖, 先 unpack 再 repack 同一 workdir 需要分两批提交
+
+def _op_unpack(job):
+    return unpack(job["image"], job.get("skip_decomp", False), job.get("hdr", False))
+
+def _op_repack(job):
+    repack(job["image"], job.get("out", "new-boot.img"), job.get("skip_comp", False),
+           workers=job.get("workers", 0), size_limit=job.get("size_limit", 0))
+    return 0
+
+def _op_info(job):
+    return info(job["image"])
+
+def _op_hexpatch(job):
+    # compressed 为 True 时压缩文件解压后打补丁, 再按原格式 (包括 LZ4_LG) 重新压缩
+    patch = hexpatch_compressed if job.get("compressed", False) else hexpatch_batch
+    return patch(job["image"], [tuple(p) for p in job["patches"]], job.get("dry_run", False))
+
+OPS = {
+    "unpack": _op_unpack,
+    "repack": _op_repack,
+    "hexpatch": _op_hexpatch,
+    "info": _op_info,
+}
+
+def _warmup():
+    # 子进程启动时预先导入编解码模块, 之后的任务不再付出导入开销
+    import bz2, lzma, zlib
+    try:
+        import lz4.frame, lz4.block
+    except ImportError:
+        pass
+
+def run_job(job: dict):
+    # 在 worker 进程中执行一个任务, 输出和异常都以数据形式返回
+    result = {"image": job.get("image"), "op": job.get("op"), "ok": False, "result": None, "error": None, "log": ""}
+    log = io.StringIO()
+    cwd = os.getcwd()
+    try:
+        workdir = job.get("workdir")
+        if workdir:
+            os.makedirs(workdir, exist_ok=True)
+            os.chdir(workdir)
+        with contextlib.redirect_stdout(log):
+            result["result"] = OPS[job["op"]](job)
+        result["ok"] = True
+    except Exception as e:
+        result["error"] = {"type": type(e).__name__, "message": str(e), "traceback": traceback.format_exc()}
+    finally:
+        os.chdir(cwd)
+        result["log"] = log.getvalue()
+    return result
+
+def run_batch(manifest, workers: int = 0, max_in_flight: int = 0, max_tasks_per_child: int = None):
+    # 按 manifest 顺序返回每个任务的结果
+    # workers <= 0 使用全部 CPU; 同时在途的镜像数不超过 max_in_flight (默认等于 workers), 用来限制总内存
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    if max_in_flight <= 0:
+        max_in_flight = workers
+    jobs = [dict(job) for job in manifest]
+    for job in jobs:
+        if job.get("image") and job.get("workdir") and not os.path.isabs(job["image"]):
+            # image 相对于调用者的 cwd, 而任务在 workdir 中执行
+            job["image"] = os.path.abspath(job["image"])
+    results = [None] * len(jobs)
+
+    kwargs = {"max_workers": workers, "initializer": _warmup}
+    if max_tasks_per_child:
+        kwargs["max_tasks_per_child"] = max_tasks_per_child
+    with ProcessPoolExecutor(**kwargs) as pool:
+        pending = {}
+        it = iter(enumerate(jobs))
+        for index, job in it:
+            pending[pool.submit(run_job, job)] = index
+            if len(pending) >= max_in_flight:
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    # worker 进程异常退出等
+                    job = jobs[index]
+                    results[index] = {"image": job.get("image"), "op": job.get("op"), "ok": False, "result": None,
+                                      "error": {"type": type(e).__name__, "message": str(e), "traceback": ""}, "log": ""}
+            for index, job in it:
+                pending[pool.submit(run_job, job)] = index
+                if len(pending) >= max_in_flight:
+                    break
+    return results
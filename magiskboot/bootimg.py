@@ -1,6 +1,7 @@
 from ctypes import (
     Union,
     Structure,
+    BigEndianStructure,
     Array,
     c_uint8,
     c_uint16,
@@ -20,14 +21,50 @@ from ctypes import (
     c_ulonglong,
 
     memset,
-    memmove
+    memmove,
+    sizeof,
+    addressof,
+    string_at
 )
 from io import BytesIO
+import errno
+import hashlib
 import mmap
+import os
+import re
+import struct
+import threading
 from enum import Enum, auto
-from .format import Format, check_fmt
+from .format import (
+    Format,
+    check_fmt,
+    fmt2name,
+    BOOT_MAGIC,
+    VENDOR_BOOT_MAGIC,
+    CHROMEOS_MAGIC,
+    DHTB_MAGIC,
+    TEGRABLOB_MAGIC,
+    GZIP1_MAGIC,
+    DTB_MAGIC,
+    LG_BUMP_MAGIC,
+    SEANDROID_MAGIC,
+    NOOKHD_RL_MAGIC,
+    NOOKHD_GL_MAGIC,
+    NOOKHD_GR_MAGIC,
+    NOOKHD_EB_MAGIC,
+    NOOKHD_ER_MAGIC,
+    ACCLAIM_MAGIC,
+    AMONET_MICROLOADER_MAGIC,
+    AVB_FOOTER_MAGIC,
+    AVB_MAGIC,
+    COMPRESSED,
+    COMPRESSED_ANY
+)
+from . import cache, trace
+from .compress import DEFAULT_LEVEL, encode, iter_chunks
 from io import (
     IOBase,
+    UnsupportedOperation,
     SEEK_CUR, 
     SEEK_END, 
     SEEK_SET
@@ -85,7 +122,7 @@ AVB_FOOTER_MAGIC_LEN = 4
 AVB_MAGIC_LEN = 4
 AVB_RELEASE_STRING_SIZE = 48
 
-class AvbFooter(Structure):
+class AvbFooter(BigEndianStructure):
     _fields_ = [
         ("magic", c_uint8 * AVB_FOOTER_MAGIC_LEN),  # uint8_t[4]
         ("version_major", c_uint32),  # uint32_t
@@ -97,7 +134,7 @@ class AvbFooter(Structure):
     ]
     _pack_ = 1
 
-class AvbVBMetaImageHeader(Structure):
+class AvbVBMetaImageHeader(BigEndianStructure):
     _fields_ = [
         ("magic", c_uint8 * AVB_MAGIC_LEN),  # uint8_t[4]
         ("required_libavb_version_major", c_uint32),  # uint32_t
@@ -174,7 +211,7 @@ class BootImgHdrV1(Structure):
     _fields_ = [
         ("v0", BootImgHdrV0),
         ("recovery_dtbo_size", c_uint32),
-        ("recovery_debo_offset", c_uint64),
+        ("recovery_dtbo_offset", c_uint64),
         ("header_size", c_uint32)
     ]
     _pack_ = 1
@@ -260,63 +297,176 @@ class VendorRamdiskTableEntryV4(Structure):
 
 PADDING = 15
 
+SHA_DIGEST_SIZE = 20
+SHA256_DIGEST_SIZE = 32
+
+NOOKHD_PRE_HEADER_SZ = 1048576
+ACCLAIM_PRE_HEADER_SZ = 262144
+AMONET_MICROLOADER_SZ = 1024
+
+FDT_BEGIN_NODE = 0x00000001
+
+def align_to(v: int, a: int):
+    return (v + a - 1) // a * a
+
+def align_padding(v: int, a: int):
+    return align_to(v, a) - v
+
+_INT_CODES = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+class _HdrField:
+    # 头部字段描述符: 类创建时按 hdr_type 的 ctypes 布局算出偏移并预编译 struct.Struct,
+    # 访问时直接从缓冲区解码, 赋值时原地写回, 不再为每个字段创建 ctypes 对象
+    __slots__ = ("path", "raw", "st", "off", "cstr")
+
+    def __init__(self, path: str, raw: bool = False):
+        self.path = path
+        self.raw = raw
+        self.st = None
+
+    def __set_name__(self, owner, name):
+        ctype, off = owner.hdr_type, 0
+        for n in self.path.split("."):
+            field = getattr(ctype, n)
+            off += field.offset
+            ctype = dict(ctype._fields_)[n]
+        self.off = off
+        if issubclass(ctype, Array):
+            # c_char 数组与 ctypes 一样在 NUL 处截断; raw 时返回完整字节 (如 checksum)
+            self.st = struct.Struct("%ds" % sizeof(ctype))
+            self.cstr = ctype._type_ is c_char and not self.raw
+        else:
+            self.st = struct.Struct("<" + _INT_CODES[sizeof(ctype)])
+            self.cstr = False
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        value = self.st.unpack_from(obj.buf, obj.off + self.off)[0]
+        if self.cstr:
+            n = value.find(b"\0")
+            if n >= 0:
+                return value[:n]
+        return value
+
+    def __set__(self, obj, value):
+        # s 格式会截断过长的值并以 NUL 填充剩余部分
+        self.st.pack_into(obj.buf, obj.off + self.off, value)
+
+def _hdr_field(path: str):
+    return _HdrField(path)
+
+def _hdr_bytes(path: str):
+    # c_char 数组字段会在 NUL 处截断, checksum 之类需要原始字节
+    return _HdrField(path, raw=True)
+
 class DynImgHdr:
-    def __init__(self, is_vendor: bool):
-        self.is_vendor = c_bool(is_vendor)
-        self.kernel_size = c_uint32()
-        self.ramdisk_size = c_uint32()
-        self.second_size = c_uint32()
-        self.page_size = c_uint32(0)
-        self.header_version = c_uint32(0)
-        self.extra_size = c_uint32()
-        self.os_version = c_uint32()
-        self.name = c_char_p(None)
-        self.cmdline = c_char_p(None)
-        self.id = c_char_p(None)
-        self.extra_cmdline = c_char_p(None)
-        self.kernel_dt_size = c_uint32(0)
-        self.recovery_dtbo_size = c_uint32()
-        self.recovery_dtbo_offset = c_uint64()
-        self.header_size = c_uint32()
-        self.dtb_size = c_uint32()
-        self.signature_size = c_uint32(0)
-        self.vendor_ramdisk_table_size = c_uint32(0)
-        self.bootconfig_size = c_uint32(0)
-
-        self.v2_hdr = BootImgHdrV2()
-        self.v4_hdr = BootImgHdrV4()
-        self.v4_vnd = BootImgHdrVndV4()
-        self.raw = None
+    # 头部视图: 只保存缓冲区和偏移, 字段在访问时才解码
+    __slots__ = ("buf", "off", "kernel_dt_size")
+    is_vendor = False
+    hdr_type = None
+
+    def __init__(self, buf=None, off: int = 0):
+        # buf 为 mmap (ACCESS_COPY) / bytearray 时可以原地修改; bytes 只能读取
+        if buf is None:
+            buf = bytearray(self.hdr_size())
+        elif len(buf) < off + self.hdr_size():
+            raise ValueError("Header exceeds buffer")
+        self.buf = buf
+        self.off = off
+        self.kernel_dt_size = 0
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # 所有字段合成一个 Struct, fields() 一次解码整个头部
+        fields = {}
+        for klass in reversed(cls.__mro__):
+            for name, attr in vars(klass).items():
+                if isinstance(attr, _HdrField):
+                    fields[name] = attr
+                elif name in fields:
+                    del fields[name]
+        layout, names, pos = "<", [], 0
+        for name, f in sorted(fields.items(), key=lambda item: item[1].off):
+            if f.off < pos:
+                continue
+            layout += "%dx%s" % (f.off - pos, f.st.format.lstrip("<"))
+            names.append((name, f.cstr))
+            pos = f.off + f.st.size
+        cls._layout = struct.Struct(layout)
+        cls._layout_names = tuple(names)
+
+    def fields(self):
+        result = {}
+        for (name, cstr), value in zip(self._layout_names, self._layout.unpack_from(self.buf, self.off)):
+            if cstr:
+                value = value.split(b"\0", 1)[0]
+            result[name] = value
+        return result
+
+    @staticmethod
+    def j32():
+        return 0
+
+    @staticmethod
+    def j64():
+        return 0
+
+    _j32 = property(lambda self: self.j32(), lambda self, v: None)
+    _j64 = property(lambda self: self.j64(), lambda self, v: None)
+    _none = property(lambda self: None, lambda self, v: None)
+
+    kernel_size = _j32
+    ramdisk_size = _j32
+    second_size = _j32
+    page_size = _j32
+    header_version = _j32
+    extra_size = _j32
+    os_version = _j32
+    name = _none
+    cmdline = _none
+    id = _none
+    extra_cmdline = _none
+    recovery_dtbo_size = _j32
+    recovery_dtbo_offset = _j64
+    header_size = _j32
+    dtb_size = _j32
+    signature_size = _j32
+    vendor_ramdisk_table_size = _j32
+    vendor_ramdisk_table_entry_num = _j32
+    vendor_ramdisk_table_entry_size = _j32
+    bootconfig_size = _j32
 
     def hdr_size(self):
-        # 根据需要实现此方法
-        pass
+        return sizeof(self.hdr_type)
 
     def hdr_space(self):
-        return self.page_size.value
+        return self.page_size
 
     def clone(self):
-        # 根据需要实现此方法
-        pass
+        hdr = type(self)(bytearray(self.raw_hdr()))
+        hdr.kernel_dt_size = self.kernel_dt_size
+        return hdr
 
     def raw_hdr(self):
-        return self.raw
+        return bytes(self.buf[self.off:self.off + self.hdr_size()])
 
     def print(self):
-        ver = self.header_version.value
+        ver = self.header_version
         print("%-*s [%u]" %(PADDING, "HEADER_VER", ver))
-        if not self.is_vendor.value:
-            print("%-*s [%u]" %(PADDING, "KERNEL_SZ", self.kernel_size.value))
+        if not self.is_vendor:
+            print("%-*s [%u]" %(PADDING, "KERNEL_SZ", self.kernel_size))
+        print("%-*s [%u]" %(PADDING, "RAMDISK_SZ", self.ramdisk_size))
         if ver < 3:
-            print("%-*s [%u]" %(PADDING, "SECOND_SZ", self.second_size.value))
+            print("%-*s [%u]" %(PADDING, "SECOND_SZ", self.second_size))
         if ver == 0:
-            print("%-*s [%u]" %(PADDING, "EXTRA_SZ", self.extra_size.value))
+            print("%-*s [%u]" %(PADDING, "EXTRA_SZ", self.extra_size))
         if ver ==  1 or ver ==2:
-            print("%-*s [%u]" %(PADDING, "RECOV_DTBO_SZ", self.recovery_dtbo_size.value))
-        if ver == 2 or self.is_vendor.value:
-            print("%-*s [%u]" %(PADDING, "DTB_SZ", self.dtb_size.value))
-        
-        os_ver = self.os_version.value
+            print("%-*s [%u]" %(PADDING, "RECOV_DTBO_SZ", self.recovery_dtbo_size))
+        if ver == 2 or self.is_vendor:
+            print("%-*s [%u]" %(PADDING, "DTB_SZ", self.dtb_size))
+
+        os_ver = self.os_version
         if (os_ver):
             a,b,c,y,m = [0] * 5
             version = os_ver >> 11
@@ -325,31 +475,34 @@ class DynImgHdr:
             a = (version >> 14) & 0x7f
             b = (version >> 7) & 0x7f
             c = version & 0x7f
-            print("%-s [%d.%d.%d]" %(PADDING, "OS_VERSION", a, b, c))
+            print("%-*s [%d.%d.%d]" %(PADDING, "OS_VERSION", a, b, c))
 
             y = (patch_level >> 4) + 2000
             m = patch_level & 0xf
             print("%-*s [%d-%02d]" %(PADDING, "OS_PATCH_LEVEL", y, m))
 
-        print("%-*s [%u]" %(PADDING, "PAGESIZE", self.page_size.value))
-        n = self.name.value
+        print("%-*s [%u]" %(PADDING, "PAGESIZE", self.page_size))
+        n = self.name
         if n:
-            print("%-*s [%s]" %(PADDING, "NAME", n))
-        
-        print("%-*s [%.*s%.*s]" %(PADDING, "CMDLINE", BOOT_ARGS_SIZE, self.cmdline.value, BOOT_EXTRA_ARGS_SIZE, self.extra_cmdline.value))
-        checksum = self.id.value
+            print("%-*s [%s]" %(PADDING, "NAME", n.decode(errors="replace")))
+
+        print("%-*s [%s]" %(PADDING, "CMDLINE", self._full_cmdline().decode(errors="replace")))
+        checksum = self.id
         if checksum:
             print("%-*s [" %(PADDING, "CHECKSUM"), end='')
-            for i in range(16):
+            for i in range(BOOT_ID_SIZE):
                 print("%02x" %(checksum[i]), end='')
             print("]")
 
-    def dump_hdr_file(self):
-        with open(HEADER_FILE, 'w') as fp:
-            if self.name.value:
-                print("name=%s" %self.name.value, file=fp)
-            print("cmdline=%.*s%.*s" %(BOOT_ARGS_SIZE, self.cmdline.value, BOOT_EXTRA_ARGS_SIZE, self.extra_cmdline.value), file=fp)
-            ver = self.os_version.value
+    def _full_cmdline(self):
+        return (self.cmdline or b"")[:BOOT_ARGS_SIZE] + (self.extra_cmdline or b"")[:BOOT_EXTRA_ARGS_SIZE]
+
+    def dump_hdr_file(self, path: str = HEADER_FILE):
+        with open(path, 'w') as fp:
+            if self.name:
+                print("name=%s" %self.name.decode(errors="replace"), file=fp)
+            print("cmdline=%s" %self._full_cmdline().decode(errors="replace"), file=fp)
+            ver = self.os_version
             if ver:
                 version = ver >> 11
                 patch_level = ver & 0x7ff
@@ -366,178 +519,182 @@ class DynImgHdr:
     def load_hdr_file(self):
         with open(HEADER_FILE, 'r') as fp:
             for line in iter(fp.readline, ""):
-                buf = line.rstrip("\n").split("=")
+                buf = line.rstrip("\n").split("=", 1)
                 if buf.__len__() == 2:
                     key, value = buf[0], buf[1]
-                    if key == "name" and self.name.value:
-                        memset(self.name, 0, 16)
-                        memmove(self.name, c_char_p(value.encode()), 15 if value.__len__() > 15 else value.__len__())
+                    if key == "name" and self.name is not None:
+                        self.name = value.encode()[:BOOT_NAME_SIZE - 1]
                     elif key == "cmdline":
-                        memset(self.cmdline, 0, BOOT_ARGS_SIZE)
-                        memset(self.extra_cmdline, 0, BOOT_EXTRA_ARGS_SIZE)
-                        if value.__len__() > BOOT_ARGS_SIZE:
-                            memmove(self.cmdline,c_char_p(value.encode()), BOOT_ARGS_SIZE)
-                            len = min(value.__len__() - BOOT_ARGS_SIZE, BOOT_EXTRA_ARGS_SIZE)
-                            memmove(self.extra_cmdline, c_char_p(bytes(value[BOOT_ARGS_SIZE:])), len)
+                        value = value.encode()
+                        if self.extra_cmdline is None or self.header_version >= 3:
+                            # v3 以后 cmdline 与 extra_cmdline 连续存放
+                            self.cmdline = value
                         else:
-                            memmove(self.cmdline, c_char_p(value.encode()), value.__len__())
+                            self.cmdline = value[:BOOT_ARGS_SIZE]
+                            self.extra_cmdline = value[BOOT_ARGS_SIZE:BOOT_ARGS_SIZE + BOOT_EXTRA_ARGS_SIZE]
                     elif key == "os_version":
-                        patch_level = self.os_version.value & 0x7ff
+                        patch_level = self.os_version & 0x7ff
                         buf = [int(i) for i in value.split(".")]
                         a, b, c = buf[0], buf[1], buf[2]
-                        self.os_version.value = (((a << 14) | (b << 7) | c) << 11) | patch_level
+                        self.os_version = (((a << 14) | (b << 7) | c) << 11) | patch_level
                     elif key == "os_patch_level":
-                        os_ver = self.os_version.value >> 11
+                        os_ver = self.os_version >> 11
                         buf = [int(i) for i in value.split("-")]
                         y, m = buf[0], buf[1]
                         y -= 2000
-                        self.os_version.value = (os_ver << 11) | (y << 4) | m
-
-    @staticmethod
-    def j32():
-        return 0
-
-    @staticmethod
-    def j64():
-        return 0
+                        self.os_version = (os_ver << 11) | (y << 4) | m
 
 class DynImgHdrBoot(DynImgHdr):
-    def __init__(self):
-        super().__init__(False)
+    __slots__ = ()
+    is_vendor = False
 
 class DynImgCommon(DynImgHdrBoot):
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
+    hdr_type = BootImgHdrV2
 
-    def kernel_size(self):
-        return self.v2_hdr.v1.v0.base.kernel_size
-
-    def ramdisk_size(self):
-        return self.v2_hdr.v1.v0.base.ramdisk_size
-
-    def second_size(self):
-        return self.v2_hdr.v1.v0.base.second_size
+    kernel_size = _hdr_field("v1.v0.base.kernel_size")
+    ramdisk_size = _hdr_field("v1.v0.base.ramdisk_size")
+    second_size = _hdr_field("v1.v0.base.second_size")
 
 class DynImgV0(DynImgCommon):
-    def __init__(self):
-        super().__init__()
-        self.v0_hdr = BootImgHdrV0()
-
-    def page_size(self):
-        return self.v0_hdr.u1.page_size
-
-    def extra_size(self):
-        return self.v0_hdr.u2.extra_size
-
-    def os_version(self):
-        return self.v0_hdr.os_version
-
-    def name(self):
-        return self.v0_hdr.name
-
-    def cmdline(self):
-        return self.v0_hdr.cmdline
-
-    def id(self):
-        return self.v0_hdr.id
-
-    def extra_cmdline(self):
-        return self.v0_hdr.extra_cmdline
+    __slots__ = ()
+    hdr_type = BootImgHdrV0
+
+    kernel_size = _hdr_field("base.kernel_size")
+    ramdisk_size = _hdr_field("base.ramdisk_size")
+    second_size = _hdr_field("base.second_size")
+    page_size = _hdr_field("u1.page_size")
+    extra_size = _hdr_field("u2.extra_size")
+    os_version = _hdr_field("os_version")
+    name = _hdr_field("name")
+    cmdline = _hdr_field("cmdline")
+    id = _hdr_bytes("id")
+    extra_cmdline = _hdr_field("extra_cmdline")
 
 class DynImgV1(DynImgV0):
-    def __init__(self):
-        super().__init__()
-        self.v1_hdr = BootImgHdrV1()
-
-    def header_version(self):
-        return self.v1_hdr.v0.u2.header_version
-
-    def recovery_dtbo_size(self):
-        return self.v1_hdr.recovery_dtbo_size
-
-    def recovery_dtbo_offset(self):
-        return self.v1_hdr.recovery_dtbo_offset
-
-    def header_size(self):
-        return self.v1_hdr.header_size
-
-    def extra_size(self):
-        return self.j32()
+    __slots__ = ()
+    hdr_type = BootImgHdrV1
+
+    kernel_size = _hdr_field("v0.base.kernel_size")
+    ramdisk_size = _hdr_field("v0.base.ramdisk_size")
+    second_size = _hdr_field("v0.base.second_size")
+    page_size = _hdr_field("v0.u1.page_size")
+    header_version = _hdr_field("v0.u2.header_version")
+    extra_size = DynImgHdr._j32
+    os_version = _hdr_field("v0.os_version")
+    name = _hdr_field("v0.name")
+    cmdline = _hdr_field("v0.cmdline")
+    id = _hdr_bytes("v0.id")
+    extra_cmdline = _hdr_field("v0.extra_cmdline")
+    recovery_dtbo_size = _hdr_field("recovery_dtbo_size")
+    recovery_dtbo_offset = _hdr_field("recovery_dtbo_offset")
+    header_size = _hdr_field("header_size")
 
 class DynImgV2(DynImgV1):
-    def __init__(self):
-        super().__init__()
-        self.v2_hdr = BootImgHdrV2()
-
-    def dtb_size(self):
-        return self.v2_hdr.dtb_size
+    __slots__ = ()
+    hdr_type = BootImgHdrV2
+
+    kernel_size = _hdr_field("v1.v0.base.kernel_size")
+    ramdisk_size = _hdr_field("v1.v0.base.ramdisk_size")
+    second_size = _hdr_field("v1.v0.base.second_size")
+    page_size = _hdr_field("v1.v0.u1.page_size")
+    header_version = _hdr_field("v1.v0.u2.header_version")
+    os_version = _hdr_field("v1.v0.os_version")
+    name = _hdr_field("v1.v0.name")
+    cmdline = _hdr_field("v1.v0.cmdline")
+    id = _hdr_bytes("v1.v0.id")
+    extra_cmdline = _hdr_field("v1.v0.extra_cmdline")
+    recovery_dtbo_size = _hdr_field("v1.recovery_dtbo_size")
+    recovery_dtbo_offset = _hdr_field("v1.recovery_dtbo_offset")
+    header_size = _hdr_field("v1.header_size")
+    dtb_size = _hdr_field("dtb_size")
 
 class DynImgPxa(DynImgCommon):
-    def __init__(self):
-        super().__init__()
-        self.hdr_pxa = BootImgHdrPxa()
-
-    def extra_size(self):
-        return self.hdr_pxa.extra_size
-
-    def page_size(self):
-        return self.hdr_pxa.page_size
-
-    def name(self):
-        return self.hdr_pxa.name
-
-    def cmdline(self):
-        return self.hdr_pxa.cmdline
-
-    def id(self):
-        return self.hdr_pxa.id
-
-    def extra_cmdline(self):
-        return self.hdr_pxa.extra_cmdline
+    __slots__ = ()
+    hdr_type = BootImgHdrPxa
+
+    kernel_size = _hdr_field("base.kernel_size")
+    ramdisk_size = _hdr_field("base.ramdisk_size")
+    second_size = _hdr_field("base.second_size")
+    extra_size = _hdr_field("extra_size")
+    page_size = _hdr_field("page_size")
+    name = _hdr_field("name")
+    cmdline = _hdr_field("cmdline")
+    id = _hdr_bytes("id")
+    extra_cmdline = _hdr_field("extra_cmdline")
 
 class DynImgV3(DynImgHdrBoot):
-    def __init__(self):
-        super().__init__()
-        self.v4_hdr = BootImgHdrV4()
-
-    def kernel_size(self):
-        return self.v4_hdr.v3.kernel_size
-
-    def ramdisk_size(self):
-        return self.v4_hdr.v3.ramdisk_size
+    __slots__ = ()
+    hdr_type = BootImgHdrV3
+
+    kernel_size = _hdr_field("kernel_size")
+    ramdisk_size = _hdr_field("ramdisk_size")
+    os_version = _hdr_field("os_version")
+    header_size = _hdr_field("header_size")
+    header_version = _hdr_field("header_version")
+    cmdline = _hdr_field("cmdline")
+    page_size = property(lambda self: 4096, lambda self, v: None)
+
+    @property
+    def extra_cmdline(self):
+        return self.cmdline[BOOT_ARGS_SIZE:]
 
-    def os_version(self):
-        return self.v4_hdr.v3.os_version
+    @extra_cmdline.setter
+    def extra_cmdline(self, value):
+        pass
 
-    def header_size(self):
-        return self.v4_hdr.v3.header_size
+    def hdr_space(self):
+        return align_to(self.hdr_size(), self.page_size)
 
-    def header_version(self):
-        return self.v4_hdr.v3.header_version
+class DynImgV4(DynImgV3):
+    __slots__ = ()
+    hdr_type = BootImgHdrV4
 
-    def cmdline(self):
-        return self.v4_hdr.v3.cmdline
+    kernel_size = _hdr_field("v3.kernel_size")
+    ramdisk_size = _hdr_field("v3.ramdisk_size")
+    os_version = _hdr_field("v3.os_version")
+    header_size = _hdr_field("v3.header_size")
+    header_version = _hdr_field("v3.header_version")
+    cmdline = _hdr_field("v3.cmdline")
+    signature_size = _hdr_field("signature_size")
 
-    def page_size(self):
-        return 4096
+class DynImgHdrVendor(DynImgHdr):
+    __slots__ = ()
+    is_vendor = True
 
-    def extra_cmdline(self):
-        return self.v4_hdr.cmdline[BOOT_ARGS_SIZE:]
+class DynImgVndV3(DynImgHdrVendor):
+    __slots__ = ()
+    hdr_type = BootImgHdrVndV3
 
-class DynImgV4(DynImgV3):
-    def __init__(self,):
-        super().__init__()
-        self.v4_hdr = BootImgHdrV4()
+    header_version = _hdr_field("header_version")
+    page_size = _hdr_field("page_size")
+    ramdisk_size = _hdr_field("ramdisk_size")
+    cmdline = _hdr_field("cmdline")
+    name = _hdr_field("name")
+    header_size = _hdr_field("header_size")
+    dtb_size = _hdr_field("dtb_size")
 
-    def signature_size(self):
-        return self.v4_hdr.signature_size
+    def _full_cmdline(self):
+        return self.cmdline
 
-class DynImgHdrVendor(DynImgHdr):
-    def __init__(self):
-        super().__init__(True)
-
-    def is_vendor(self):
-        return True
+    def hdr_space(self):
+        return align_to(self.hdr_size(), self.page_size)
+
+class DynImgVndV4(DynImgVndV3):
+    __slots__ = ()
+    hdr_type = BootImgHdrVndV4
+
+    header_version = _hdr_field("v3.header_version")
+    page_size = _hdr_field("v3.page_size")
+    ramdisk_size = _hdr_field("v3.ramdisk_size")
+    cmdline = _hdr_field("v3.cmdline")
+    name = _hdr_field("v3.name")
+    header_size = _hdr_field("v3.header_size")
+    dtb_size = _hdr_field("v3.dtb_size")
+    vendor_ramdisk_table_size = _hdr_field("vendor_ramdisk_table_size")
+    vendor_ramdisk_table_entry_num = _hdr_field("vendor_ramdisk_table_entry_num")
+    vendor_ramdisk_table_entry_size = _hdr_field("vendor_ramdisk_table_entry_size")
+    bootconfig_size = _hdr_field("bootconfig_size")
 
 class BootFlag(Enum):
     MTK_KERNEL = auto()
@@ -556,73 +713,1097 @@ class BootFlag(Enum):
     ZIMAGE_KERNEL =  auto()
     BOOT_FLAGS_MAX =  auto()
 
+def find_dtb_offset(buf, start: int, size: int):
+    end = start + size
+    curr = start
+    while curr < end:
+        curr = buf.find(DTB_MAGIC, curr, end)
+        if curr == -1:
+            return -1
+        if curr + 12 > end:
+            return -1
+        totalsize, off_dt_struct = struct.unpack_from(">II", buf, curr + 4)
+        # totalsize 与 off_dt_struct 不能越界, 且第一个节点必须是 FDT_BEGIN_NODE
+        if (totalsize <= end - curr and off_dt_struct + 4 <= end - curr
+                and struct.unpack_from(">I", buf, curr + off_dt_struct)[0] == FDT_BEGIN_NODE):
+            return curr - start
+        curr += 40 # sizeof(fdt_header)
+    return -1
+
+def check_fmt_lg(buf, size: int):
+    fmt = check_fmt(buf, size)
+    if fmt == Format.LZ4_LEGACY:
+        # 区分 LZ4_LG: 最后一个块的大小越界
+        off = 4
+        while off + 4 <= size:
+            block_sz = int.from_bytes(buf[off:off + 4], "little")
+            off += 4
+            if off + block_sz > size:
+                return Format.LZ4_LG
+            off += block_sz
+    return fmt
+
+def pre_header(hp: DynImgHdr):
+    # NookHD / Acclaim 的 loader 放在真正的头部之前; 返回 (BootFlag, 头部偏移增量)
+    cmdline = hp.cmdline
+    if (cmdline.startswith(NOOKHD_RL_MAGIC) or cmdline.startswith(NOOKHD_GL_MAGIC)
+            or cmdline.startswith(NOOKHD_GR_MAGIC) or cmdline.startswith(NOOKHD_EB_MAGIC)
+            or cmdline.startswith(NOOKHD_ER_MAGIC)):
+        return BootFlag.NOOKHD_FLAG, NOOKHD_PRE_HEADER_SZ
+    if hp.name.startswith(ACCLAIM_MAGIC):
+        return BootFlag.ACCLAIM_FLAG, ACCLAIM_PRE_HEADER_SZ
+    return None, 0
+
+def hdr_class(buf, addr: int, type: Format):
+    # 根据 magic 与 header_version 选择头部类 (不含 PXA 与 loader 的判断)
+    if type == Format.AOSP_VENDOR:
+        return DynImgVndV4 if DynImgVndV3(buf, addr).header_version == 4 else DynImgVndV3
+    # v0 头中 extra_size 与 header_version 是同一个 union
+    match DynImgV0(buf, addr).extra_size:
+        case 1:
+            return DynImgV1
+        case 2:
+            return DynImgV2
+        case 3:
+            return DynImgV3
+        case 4:
+            return DynImgV4
+        case _:
+            return DynImgV0
+
 class BootImage:
+    # 所有组件都是 self.map 上的 memoryview 切片, 头部结构体通过 from_buffer 覆盖在映射上
+    _HDR_RE = re.compile(b"|".join(re.escape(m) for m in (
+        BOOT_MAGIC, VENDOR_BOOT_MAGIC, CHROMEOS_MAGIC, DHTB_MAGIC, TEGRABLOB_MAGIC)))
+
     def __init__(self, image_path):
         print("Parsing image [%s]" %image_path)
+        self.map = None
         with open(image_path, 'rb') as image_file:
-            self.map = mmap.mmap(image_file.fileno(), 0)
-            fmt: Format = check_fmt(self.map, self.map.size())
-        self.hdr = DynImgHdr(False)
+            # ACCESS_COPY: 私有写时复制映射, from_buffer 需要可写 buffer, 但不会写回文件
+            self.map = mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.buf = memoryview(self.map)
+        self.hdr: DynImgHdr = None
+        self.hdr_addr = 0
         self.flags = [False] * BootFlag.BOOT_FLAGS_MAX.value
         self.k_fmt = Format.UNKNOWN
         self.r_fmt = Format.UNKNOWN
         self.e_fmt = Format.UNKNOWN
-        self.payload: BytesIO
-        self.tail: BytesIO
-        self.k_hdr = MtkHdr()
-        self.r_hdr = MtkHdr()
-        self.z_hdr = ZimageHdr()
-        self.z_info = {"hdr_sz": 0, "tail": None}
-        self.avb_footer = AvbFooter()
-        self.vbmeta = AvbVBMetaImageHeader()
-        self.kernel = None
-        self.ramdisk = None
-        self.second = None
-        self.extra = None
-        self.recovery_dtbo = None
-        self.dtb = None
-        self.kernel_dtb: BytesIO
-        self.ignore: BytesIO
+        self.payload = self.buf[0:0]
+        self.tail = self.buf[0:0]
+        self.k_hdr: MtkHdr = None
+        self.r_hdr: MtkHdr = None
+        self.z_hdr: ZimageHdr = None
+        self.z_info = {"hdr_sz": 0, "tail": self.buf[0:0]}
+        self.avb_footer: AvbFooter = None
+        self.vbmeta: AvbVBMetaImageHeader = None
+        self.vbmeta_addr = 0
+        self.kernel = self.buf[0:0]
+        self.ramdisk = self.buf[0:0]
+        self.second = self.buf[0:0]
+        self.extra = self.buf[0:0]
+        self.recovery_dtbo = self.buf[0:0]
+        self.dtb = self.buf[0:0]
+        self.signature = self.buf[0:0]
+        self.vendor_ramdisk_table = self.buf[0:0]
+        self.bootconfig = self.buf[0:0]
+        self.kernel_dtb = self.buf[0:0]
+        self.ignore = self.buf[0:0]
+        # v4 vendor ramdisk 表项 (拷贝, 不引用映射) 以及表在 ignore 中的偏移
+        self.vendor_ramdisks = []
+        self.vrt_off = 0
+
+        size = self.map.size()
+        addr = 0
+        with trace.span("parse_image", image=image_path, bytes_in=size):
+            while addr < size:
+                fmt = check_fmt(self.buf[addr:], size - addr)
+                if fmt == Format.CHROMEOS:
+                    # chromeos require external signing
+                    self.flags[BootFlag.CHROMEOS_FLAG.value] = True
+                    addr += 65535
+                elif fmt == Format.DHTB:
+                    self.flags[BootFlag.DHTB_FLAG.value] = True
+                    self.flags[BootFlag.SEANDROID_FLAG.value] = True
+                    print("DHTB_HDR")
+                    addr += sizeof(DhtbHdr) - 1
+                elif fmt == Format.BLOB:
+                    self.flags[BootFlag.BLOB_FLAG.value] = True
+                    print("TEGRA_BLOB")
+                    addr += sizeof(BlobHdr) - 1
+                elif fmt in (Format.AOSP, Format.AOSP_VENDOR):
+                    if self.parse_image(addr, fmt):
+                        return
+                addr = self._next_magic(addr + 1)
+        raise ValueError("Invalid boot image [%s]" %image_path)
+
+    def _next_magic(self, addr):
+        # 跳过不可能是头部的字节, 效果等同于逐字节 check_fmt
+        m = self._HDR_RE.search(self.map, addr)
+        return m.start() if m else self.map.size()
 
     def __del__(self):
-        del self.hdr
-        self.map.close()
-
-    def parse_image(self, addr, type):
-        # Implement image parsing logic here
-        pass
+        self.close()
+
+    def close(self):
+        if getattr(self, "map", None) is None:
+            return
+        # 必须先释放所有指向映射的视图, 否则 mmap.close() 会抛 BufferError
+        for k, v in list(self.__dict__.items()):
+            if k != "map" and (isinstance(v, (memoryview, Structure, DynImgHdr))):
+                setattr(self, k, None)
+        self.z_info = {}
+        try:
+            self.map.close()
+        except BufferError:
+            # 调用者仍持有组件视图, 映射在最后一个引用释放时回收
+            pass
+        self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _view(self, off, size):
+        return self.buf[off:min(off + size, len(self.buf))]
+
+    def vendor_ramdisk(self, entry):
+        # 表项中的偏移相对于 vendor ramdisk 区域的起点
+        return self.ramdisk[entry.ramdisk_offset:entry.ramdisk_offset + entry.ramdisk_size]
 
     def create_hdr(self, addr, type):
-        # Implement header creation logic here
-        pass
-
-    def verify(self, cert=None):
-        # Implement verification logic here
-        pass
-
-def decompress(format: Format, fd, i, size):
-    pass
+        if type == Format.AOSP_VENDOR:
+            print("VENDOR_BOOT_HDR")
+            return hdr_class(self.map, addr, type)(self.map, addr)
+
+        hp = DynImgV0(self.map, addr)
+        if hp.page_size >= 0x02000000:
+            print("PXA_BOOT_HDR")
+            return DynImgPxa(self.map, addr)
+
+        flag, shift = pre_header(hp)
+        if flag is not None:
+            self.flags[flag.value] = True
+            print("NOOKHD_LOADER" if flag == BootFlag.NOOKHD_FLAG else "ACCLAIM_LOADER")
+            addr += shift
+        del hp
+
+        if addr + sizeof(BootImgHdrV0) > self.map.size():
+            return None
+        self.hdr_addr = addr
+        return hdr_class(self.map, addr, type)(self.map, addr)
 
-def compress(format: Format, fd, i, size):
-    pass
+    def parse_image(self, addr, type):
+        self.hdr_addr = addr
+        try:
+            self.hdr = self.create_hdr(addr, type)
+        except ValueError:
+            # 头部超出文件末尾
+            return False
+        if self.hdr is None:
+            return False
+        addr = self.hdr_addr
+        hdr = self.hdr
+
+        if hdr.page_size == 0 or addr + hdr.hdr_space() > self.map.size():
+            return False
+
+        hdr.print()
+
+        checksum = hdr.id
+        if checksum and any(checksum[SHA_DIGEST_SIZE + 4:SHA256_DIGEST_SIZE]):
+            self.flags[BootFlag.SHA256_FLAG.value] = True
+
+        off = hdr.hdr_space()
+        page_size = hdr.page_size
+        blocks = {}
+        for name in ("kernel", "ramdisk", "second", "extra", "recovery_dtbo", "dtb",
+                     "signature", "vendor_ramdisk_table", "bootconfig"):
+            size = getattr(hdr, name + "_size")
+            blocks[name] = (addr + off, size)
+            setattr(self, name, self._view(addr + off, size))
+            off += size
+            off = align_to(off, page_size)
+        # signature / vendor ramdisk table / bootconfig 在 repack 时原样复制
+        ignore_off = blocks["signature"][0]
+        self.ignore = self._view(ignore_off, addr + off - ignore_off)
+
+        if hdr.kernel_size:
+            koff, ksize = blocks["kernel"]
+            dtb_off = find_dtb_offset(self.map, koff, ksize)
+            if dtb_off > 0:
+                self.kernel_dtb = self._view(koff + dtb_off, ksize - dtb_off)
+                hdr.kernel_dt_size = ksize - dtb_off
+                hdr.kernel_size = ksize = dtb_off
+                self.kernel = self._view(koff, ksize)
+                print("%-*s [%u]" %(PADDING, "KERNEL_DTB_SZ", hdr.kernel_dt_size))
+
+            if self.kernel[:len(AMONET_MICROLOADER_MAGIC)] == AMONET_MICROLOADER_MAGIC:
+                self.flags[BootFlag.AMONET_FLAG.value] = True
+                print("AMONET_MICROLOADER")
+                koff += AMONET_MICROLOADER_SZ
+                hdr.kernel_size = ksize = ksize - AMONET_MICROLOADER_SZ
+                self.kernel = self._view(koff, ksize)
+
+            self.k_fmt = check_fmt_lg(self.kernel, ksize)
+            if self.k_fmt == Format.MTK:
+                print("MTK_KERNEL_HDR")
+                self.flags[BootFlag.MTK_KERNEL.value] = True
+                self.k_hdr = MtkHdr.from_buffer(self.map, koff)
+                print("%-*s [%u]" %(PADDING, "SIZE", self.k_hdr.size))
+                print("%-*s [%s]" %(PADDING, "NAME", self.k_hdr.name.decode(errors="replace")))
+                koff += sizeof(MtkHdr)
+                hdr.kernel_size = ksize = ksize - sizeof(MtkHdr)
+                self.kernel = self._view(koff, ksize)
+                self.k_fmt = check_fmt_lg(self.kernel, ksize)
+            if self.k_fmt == Format.ZIMAGE:
+                self.z_hdr = ZimageHdr.from_buffer(self.map, koff)
+                gzip = self.map.find(GZIP1_MAGIC + b"\x08\x00", koff, koff + ksize)
+                if gzip >= 0:
+                    print("ZIMAGE_KERNEL")
+                    self.z_info["hdr_sz"] = gzip - koff
+
+                    # Find end of piggy
+                    zimage_size = self.z_hdr.end - self.z_hdr.start
+                    piggy_end = zimage_size
+                    offsets = struct.unpack_from("<16I", self.map, koff + zimage_size - 64)
+                    for i in range(15, -1, -1):
+                        if offsets[i] > (zimage_size - 0xFF) and offsets[i] < zimage_size:
+                            piggy_end = offsets[i]
+                            break
+
+                    if piggy_end == zimage_size:
+                        print("! Could not find end of zImage piggy, keeping raw kernel")
+                    else:
+                        self.flags[BootFlag.ZIMAGE_KERNEL.value] = True
+                        self.z_info["tail"] = self._view(koff + piggy_end, ksize - piggy_end)
+                        koff += self.z_info["hdr_sz"]
+                        hdr.kernel_size = ksize = piggy_end - self.z_info["hdr_sz"]
+                        self.kernel = self._view(koff, ksize)
+                        self.k_fmt = check_fmt_lg(self.kernel, ksize)
+                else:
+                    print("! Could not find zImage gzip piggy, keeping raw kernel")
+            print("%-*s [%s]" %(PADDING, "KERNEL_FMT", fmt2name(self.k_fmt)))
+
+        if hdr.ramdisk_size:
+            roff, rsize = blocks["ramdisk"]
+            if hdr.is_vendor and hdr.header_version >= 4:
+                # v4 vendor boot contains multiple ramdisks
+                self.r_fmt = Format.UNKNOWN
+            else:
+                self.r_fmt = check_fmt_lg(self.ramdisk, rsize)
+            if self.r_fmt == Format.MTK:
+                print("MTK_RAMDISK_HDR")
+                self.flags[BootFlag.MTK_RAMDISK.value] = True
+                self.r_hdr = MtkHdr.from_buffer(self.map, roff)
+                print("%-*s [%u]" %(PADDING, "SIZE", self.r_hdr.size))
+                print("%-*s [%s]" %(PADDING, "NAME", self.r_hdr.name.decode(errors="replace")))
+                roff += sizeof(MtkHdr)
+                hdr.ramdisk_size = rsize = rsize - sizeof(MtkHdr)
+                self.ramdisk = self._view(roff, rsize)
+                self.r_fmt = check_fmt_lg(self.ramdisk, rsize)
+            print("%-*s [%s]" %(PADDING, "RAMDISK_FMT", fmt2name(self.r_fmt)))
+
+        if hdr.is_vendor and hdr.header_version >= 4 and hdr.vendor_ramdisk_table_size:
+            toff, _ = blocks["vendor_ramdisk_table"]
+            self.vrt_off = toff - ignore_off
+            esize = hdr.vendor_ramdisk_table_entry_size
+            for i in range(hdr.vendor_ramdisk_table_entry_num):
+                entry = VendorRamdiskTableEntryV4.from_buffer_copy(self.map, toff + i * esize)
+                frag = self.vendor_ramdisk(entry)
+                print("%-*s [%s] type=[%u] size=[%u] fmt=[%s]" %(PADDING, "VND_RAMDISK",
+                      vendor_ramdisk_name(entry), entry.ramdisk_type, entry.ramdisk_size,
+                      fmt2name(check_fmt_lg(frag, len(frag)))))
+                self.vendor_ramdisks.append(entry)
+
+        if hdr.extra_size:
+            self.e_fmt = check_fmt_lg(self.extra, hdr.extra_size)
+            print("%-*s [%s]" %(PADDING, "EXTRA_FMT", fmt2name(self.e_fmt)))
+
+        self.payload = self._view(addr, off)
+        if addr + off < self.map.size():
+            self.tail = self.buf[addr + off:]
+            tail_size = len(self.tail)
+
+            # Check special flags
+            if tail_size >= 16 and self.tail[:16] == SEANDROID_MAGIC:
+                print("SAMSUNG_SEANDROID")
+                self.flags[BootFlag.SEANDROID_FLAG.value] = True
+            elif tail_size >= 16 and self.tail[:16] == LG_BUMP_MAGIC:
+                print("LG_BUMP_IMAGE")
+                self.flags[BootFlag.LG_BUMP_FLAG.value] = True
+
+            # Find AVB footer
+            footer = self.map.size() - sizeof(AvbFooter)
+            if tail_size >= sizeof(AvbFooter) and self.buf[footer:footer + 4] == AVB_FOOTER_MAGIC:
+                self.avb_footer = AvbFooter.from_buffer(self.map, footer)
+                # Double check if meta header exists
+                meta = addr + self.avb_footer.vbmeta_offset
+                if (meta + sizeof(AvbVBMetaImageHeader) <= self.map.size()
+                        and self.buf[meta:meta + 4] == AVB_MAGIC):
+                    print("VBMETA")
+                    self.flags[BootFlag.AVB_FLAG.value] = True
+                    self.vbmeta = AvbVBMetaImageHeader.from_buffer(self.map, meta)
+                    self.vbmeta_addr = meta
+        return True
 
-def dump(buf: bytes, size: int, filename: str):
+    def verify(self, cert=None):
+        # 校验 AVB hash footer: 各 hash 描述符的镜像摘要 (流式计算) 以及 vbmeta 签名
+        # cert 为公钥 / 证书路径, 不提供时只用 vbmeta 中嵌入的公钥校验
+        from .avb import VBMeta, load_key, verify_vbmeta
+        if not self.flags[BootFlag.AVB_FLAG.value]:
+            print("! No AVB footer found")
+            return False
+        key = load_key(cert) if cert else None
+        with trace.span("avb_verify", bytes_in=self.avb_footer.original_image_size):
+            return verify_vbmeta(self.map, VBMeta(self.map, self.vbmeta_addr, self.vbmeta), key)
+
+# info() 读取的文件开头大小, 足以覆盖 DHTB / blob 前置头和最大的头部 (一页)
+INFO_HEAD_SZ = 0x4000
+# 检测组件格式时读取的字节数 (包含 MTK 头)
+INFO_PROBE_SZ = 0x400
+
+def vendor_ramdisk_name(entry):
+    name = bytes(entry.ramdisk_name).split(b"\0", 1)[0].decode(errors="replace")
+    return name or "ramdisk"
+
+def vendor_ramdisk_file(entry):
+    return os.path.join(VND_RAMDISK_DIR, vendor_ramdisk_name(entry) + ".cpio")
+
+def _pool_map(func, items, workers: int):
+    # 各 vendor ramdisk 片段互相独立, zlib / lzma 编解码时会释放 GIL, 用线程池并行处理
+    items = list(items)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items))
+
+def _pread(f, off: int, size: int):
+    f.seek(off, SEEK_SET)
+    return f.read(size)
+
+def _os_version(os_ver: int):
+    version = os_ver >> 11
+    patch_level = os_ver & 0x7ff
+    return ("%d.%d.%d" %((version >> 14) & 0x7f, (version >> 7) & 0x7f, version & 0x7f),
+            "%d-%02d" %((patch_level >> 4) + 2000, patch_level & 0xf))
+
+def info(image: str):
+    # 只读取头部所在的页, 组件开头的少量字节, 以及尾部标记与 AVB footer, 不映射整个镜像
+    # 返回与 DynImgHdr.print 对应的结构化记录
+    with open(image, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        flags = set()
+        # head 是文件中 [base, base + len(head)) 的窗口
+        base, head = 0, b""
+        addr = 0
+        while True:
+            if addr >= size:
+                raise ValueError("Invalid boot image [%s]" %image)
+            if addr < base or (addr + INFO_HEAD_SZ // 2 > base + len(head) and base + len(head) < size):
+                base, head = addr, _pread(f, addr, INFO_HEAD_SZ)
+            m = BootImage._HDR_RE.search(head, addr - base)
+            if m is None:
+                if base + len(head) >= size:
+                    raise ValueError("Invalid boot image [%s]" %image)
+                # magic 可能跨越窗口边界
+                addr = base + len(head) - 0x20
+                continue
+            if base + m.start() != addr:
+                addr = base + m.start()
+                continue
+            fmt = check_fmt(head[addr - base:], len(head) - addr + base)
+            if fmt == Format.CHROMEOS:
+                flags.add(BootFlag.CHROMEOS_FLAG)
+                addr += 65536
+            elif fmt == Format.DHTB:
+                flags.update((BootFlag.DHTB_FLAG, BootFlag.SEANDROID_FLAG))
+                addr += sizeof(DhtbHdr)
+            elif fmt == Format.BLOB:
+                flags.add(BootFlag.BLOB_FLAG)
+                addr += sizeof(BlobHdr)
+            elif fmt in (Format.AOSP, Format.AOSP_VENDOR):
+                try:
+                    if fmt == Format.AOSP_VENDOR:
+                        cls = hdr_class(head, addr - base, fmt)
+                    elif DynImgV0(head, addr - base).page_size >= 0x02000000:
+                        cls = DynImgPxa
+                    else:
+                        flag, shift = pre_header(DynImgV0(head, addr - base))
+                        if flag is not None:
+                            flags.add(flag)
+                            addr += shift
+                            base, head = addr, _pread(f, addr, INFO_HEAD_SZ)
+                        cls = hdr_class(head, addr - base, fmt)
+                    hdr = cls(head, addr - base)
+                except ValueError:
+                    # 头部超出文件末尾
+                    hdr = None
+                if hdr is not None and hdr.page_size and addr + hdr.hdr_space() <= size:
+                    break
+                addr += 1
+            else:
+                addr += 1
+
+        ver = hdr.header_version
+        record = {
+            "image": image,
+            "size": size,
+            "header_addr": addr,
+            "header_type": cls.__name__,
+            "header_version": ver,
+            "vendor": hdr.is_vendor,
+            "page_size": hdr.page_size,
+        }
+        for name in ("kernel", "ramdisk", "second", "extra", "recovery_dtbo", "dtb",
+                     "signature", "vendor_ramdisk_table", "bootconfig"):
+            record[name + "_size"] = getattr(hdr, name + "_size")
+        os_ver = hdr.os_version
+        record["os_version"], record["os_patch_level"] = _os_version(os_ver) if os_ver else (None, None)
+        record["name"] = hdr.name.decode(errors="replace") if hdr.name else None
+        record["cmdline"] = hdr._full_cmdline().decode(errors="replace")
+        checksum = hdr.id
+        record["id"] = checksum.hex() if checksum else None
+        if checksum and any(checksum[SHA_DIGEST_SIZE + 4:SHA256_DIGEST_SIZE]):
+            flags.add(BootFlag.SHA256_FLAG)
+
+        # 各组件位置与 parse_image 相同: 头部之后按页对齐依次排列
+        off = hdr.hdr_space()
+        for name in ("kernel", "ramdisk", "second", "extra", "recovery_dtbo", "dtb",
+                     "signature", "vendor_ramdisk_table", "bootconfig"):
+            comp = record[name + "_size"]
+            if name in ("kernel", "ramdisk", "extra") and comp:
+                probe = _pread(f, addr + off, min(comp, INFO_PROBE_SZ))
+                if name == "ramdisk" and hdr.is_vendor and ver >= 4:
+                    fmt = Format.UNKNOWN
+                else:
+                    fmt = check_fmt_lg(probe, len(probe))
+                if fmt == Format.MTK and len(probe) > sizeof(MtkHdr):
+                    flags.add(BootFlag.MTK_KERNEL if name == "kernel" else BootFlag.MTK_RAMDISK)
+                    fmt = check_fmt_lg(probe[sizeof(MtkHdr):], len(probe) - sizeof(MtkHdr))
+                record[name + "_fmt"] = fmt2name(fmt)
+            off = align_to(off + comp, hdr.page_size)
+
+        # 尾部标记紧跟在最后一个组件之后, AVB footer 位于文件末尾
+        tail = _pread(f, addr + off, 16) if addr + off < size else b""
+        if tail == SEANDROID_MAGIC:
+            flags.add(BootFlag.SEANDROID_FLAG)
+        elif tail == LG_BUMP_MAGIC:
+            flags.add(BootFlag.LG_BUMP_FLAG)
+
+        record["avb"] = None
+        if size - (addr + off) >= sizeof(AvbFooter):
+            footer = _pread(f, size - sizeof(AvbFooter), sizeof(AvbFooter))
+            if footer[:4] == AVB_FOOTER_MAGIC:
+                footer = AvbFooter.from_buffer_copy(footer)
+                meta = addr + footer.vbmeta_offset
+                vbmeta = _pread(f, meta, sizeof(AvbVBMetaImageHeader)) if meta < size else b""
+                if len(vbmeta) == sizeof(AvbVBMetaImageHeader) and vbmeta[:4] == AVB_MAGIC:
+                    flags.add(BootFlag.AVB_FLAG)
+                    vbmeta = AvbVBMetaImageHeader.from_buffer_copy(vbmeta)
+                    record["avb"] = {
+                        "original_image_size": footer.original_image_size,
+                        "vbmeta_offset": footer.vbmeta_offset,
+                        "vbmeta_size": footer.vbmeta_size,
+                        "algorithm_type": vbmeta.algorithm_type,
+                        "rollback_index": vbmeta.rollback_index,
+                        "flags": vbmeta.flags,
+                        "release_string": bytes(vbmeta.release_string).rstrip(b"\0").decode(errors="replace"),
+                    }
+
+        record["flags"] = sorted(flag.name for flag in flags)
+        return record
+
+def decompress(format: Format, fd, i, size, workers: int = 1):
+    # 流式解压 i[:size] 到 fd, 返回写入的字节数; 启用了组件缓存时经过缓存
+    total = 0
+    for chunk in cache.decode(format, memoryview(i)[:size], workers):
+        fd.write(chunk)
+        total += len(chunk)
+    return total
+
+def compress(format: Format, fd, i, size, workers: int = 1, level: int = DEFAULT_LEVEL):
+    # 流式压缩 i[:size] 到 fd, 返回写入的字节数
+    total = 0
+    for chunk in encode(format, iter_chunks(i, size), workers, level):
+        fd.write(chunk)
+        total += len(chunk)
+    return total
+
+def dump(buf, size: int, filename: str):
+    # buf 通常是 mmap 上的 memoryview, 切片不会复制数据
     if size == 0:
         return
     with open(filename, 'wb') as fd:
         fd.write(buf[:size])
     return
 
+XSENDFILE_CHUNK = 0x100000
+
+_copy_buf = threading.local()
+_ZEROS = memoryview(bytes(0x10000))
+
+def _kernel_copy(out_fd: int, in_fd: int, offset: int, size: int):
+    # 优先 copy_file_range (同一文件系统上可以是 reflink / 内核内复制), 其次 sendfile
+    # 返回已复制的字节数, 两者都不可用时返回 0
+    done = 0
+    for func in ("copy_file_range", "sendfile"):
+        if not hasattr(os, func):
+            continue
+        try:
+            while done < size:
+                if func == "copy_file_range":
+                    n = os.copy_file_range(in_fd, out_fd, size - done, offset + done)
+                else:
+                    n = os.sendfile(out_fd, in_fd, offset + done, size - done)
+                if n == 0:
+                    break
+                done += n
+            return done
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP):
+                raise
+    return done
+
 def xsendfile(fd: IOBase, ifd: IOBase, offset: int, size: int):
-    chunk = 4096
-    ifd.seek(SEEK_SET, offset)
-    for i in range(0, size, chunk):
-        fd.write(ifd.read(i))
+    # 两端都是真实文件时交给内核复制, 否则用每个线程复用的缓冲区 readinto
+    done = 0
+    hashing = isinstance(fd, HashedWriter) and fd.ctx is not None
+    if not hashing:
+        try:
+            out_fd, in_fd = fd.fileno(), ifd.fileno()
+        except (AttributeError, OSError, UnsupportedOperation):
+            out_fd = in_fd = -1
+        if out_fd >= 0 and in_fd >= 0:
+            fd.flush()
+            pos = fd.tell()
+            done = _kernel_copy(out_fd, in_fd, offset, size)
+            # 内核直接推进了 fd 的偏移, 同步 Python 缓冲层的位置
+            fd.seek(pos + done, SEEK_SET)
+            trace.count("xsendfile.kernel_bytes", done)
+    if done < size:
+        buf = getattr(_copy_buf, "buf", None)
+        if buf is None:
+            buf = _copy_buf.buf = memoryview(bytearray(XSENDFILE_CHUNK))
+        ifd.seek(offset + done, SEEK_SET)
+        while done < size:
+            n = ifd.readinto(buf[:min(len(buf), size - done)])
+            if not n:
+                break
+            fd.write(buf[:n])
+            done += n
+            trace.count("xsendfile.copy_bytes", n)
+    return done
 
 def restore(fd: IOBase, filename: str):
     with open(filename, 'rb') as ifd:
-        size = ifd.seek(0, SEEK_END)
-        ifd.seek(0, SEEK_SET)
-        xsendfile(fd, ifd, 0, size)
+        size = os.fstat(ifd.fileno()).st_size
+        with trace.span("restore", component=filename, bytes_in=size, bytes_out=size):
+            xsendfile(fd, ifd, 0, size)
     return size
 
+class HashedWriter:
+    # 写文件的同时计算摘要, 避免写完再读一遍; ctx 为 None 时只写不算
+    # 其余文件方法 (tell/seek/fileno ...) 直接转发
+    def __init__(self, fd, ctx):
+        self.fd = fd
+        self.ctx = ctx
+
+    def write(self, data):
+        if self.ctx is not None:
+            self.ctx.update(data)
+        return self.fd.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fd, name)
+
+def file_digest(filename: str):
+    ctx = hashlib.sha1()
+    with open(filename, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size:
+            with trace.span("hash", component=filename, bytes_in=size), \
+                    mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                ctx.update(m)
+    return ctx.hexdigest()
+
+def load_checksums():
+    # 每行: <组件文件名>=<解包后内容的 sha1> <原镜像中该组件 (压缩后) 的 sha1>
+    sums = {}
+    if not os.access(CHECKSUM_FILE, os.R_OK):
+        return sums
+    with open(CHECKSUM_FILE, 'r') as fp:
+        for line in iter(fp.readline, ""):
+            buf = line.rstrip("\n").split("=", 1)
+            if buf.__len__() == 2 and buf[1].count(" ") == 1:
+                sums[buf[0]] = tuple(buf[1].split(" "))
+    return sums
+
+def unpack(image: str, skip_decomp: bool = False, hdr: bool = False, workers: int = 0):
+    sums = {}
+
+    def dump_component(buf, size, filename, fmt=Format.UNKNOWN):
+        if size == 0:
+            return
+        ctx = hashlib.sha1()
+        with trace.span("dump", component=filename, format=fmt2name(fmt), bytes_in=size) as sp, \
+                open(filename, 'wb') as fd:
+            if not skip_decomp and COMPRESSED(fmt):
+                decompress(fmt, HashedWriter(fd, ctx), buf, size, workers)
+            else:
+                HashedWriter(fd, ctx).write(buf[:size])
+            sp.set("bytes_out", fd.tell())
+        sums[filename] = (ctx.hexdigest(), hashlib.sha1(buf[:size]).hexdigest())
+
+    with trace.span("unpack", image=image), BootImage(image) as boot:
+        if hdr:
+            boot.hdr.dump_hdr_file()
+
+        # Dump kernel
+        dump_component(boot.kernel, boot.hdr.kernel_size, KERNEL_FILE, boot.k_fmt)
+
+        # Dump kernel_dtb
+        dump_component(boot.kernel_dtb, boot.hdr.kernel_dt_size, KER_DTB_FILE)
+
+        # Dump ramdisk
+        if boot.vendor_ramdisks:
+            # v4 vendor boot: 每个片段单独解压到 vendor_ramdisk/<name>.cpio
+            os.makedirs(VND_RAMDISK_DIR, exist_ok=True)
+
+            def dump_fragment(entry):
+                frag = boot.vendor_ramdisk(entry)
+                dump_component(frag, len(frag), vendor_ramdisk_file(entry), check_fmt_lg(frag, len(frag)))
+
+            _pool_map(dump_fragment, boot.vendor_ramdisks, workers)
+        else:
+            dump_component(boot.ramdisk, boot.hdr.ramdisk_size, RAMDISK_FILE, boot.r_fmt)
+
+        # Dump second
+        dump_component(boot.second, boot.hdr.second_size, SECOND_FILE)
+
+        # Dump extra
+        dump_component(boot.extra, boot.hdr.extra_size, EXTRA_FILE, boot.e_fmt)
+
+        # Dump recovery_dtbo
+        dump_component(boot.recovery_dtbo, boot.hdr.recovery_dtbo_size, RECV_DTBO_FILE)
+
+        # Dump dtb
+        dump_component(boot.dtb, boot.hdr.dtb_size, DTB_FILE)
+
+        # 记录各组件摘要, repack 时内容未变的组件直接复制原始 (压缩后) 数据
+        with open(CHECKSUM_FILE, 'w') as fp:
+            for name, (raw, src) in sums.items():
+                print("%s=%s %s" %(name, raw, src), file=fp)
+
+        return 2 if boot.flags[BootFlag.CHROMEOS_FLAG.value] else 0
+
+def write_zero(fd, size: int):
+    # 复用同一块只读零页, 不为每次对齐构造新的 bytes
+    while size > 0:
+        n = min(size, len(_ZEROS))
+        fd.write(_ZEROS[:n])
+        size -= n
+
+def _tune_plan(boot: BootImage, size_limit: int, workers: int):
+    # 可调的组件: kernel 和 v4 vendor ramdisk 片段只调等级 (引导程序 / 合并要求格式不变),
+    # ramdisk 在所有格式中搜索 (v4 boot 固定为 lz4_legacy); 已经是压缩数据的文件原样写出, 不参与
+    hdr = boot.hdr
+    components = []
+    # 可调组件所在的节 (kernel / ramdisk), 每节写完后按页对齐: [节中其余数据的大小, 组件下标...]
+    sections = []
+    origs = []
+
+    def add(section, filename, buf, formats):
+        if not os.access(filename, os.R_OK) or os.path.getsize(filename) == 0:
+            return
+        with open(filename, 'rb') as f:
+            head = f.read(0x1000)
+        if COMPRESSED_ANY(check_fmt(head, len(head))):
+            return
+        section[0] -= len(buf)
+        section.append(len(components))
+        components.append((filename, formats))
+        origs.append(len(buf))
+
+    from .tune import DECODE_ORDER, tune
+    if COMPRESSED(boot.k_fmt) and not boot.flags[BootFlag.ZIMAGE_KERNEL.value]:
+        section = [len(boot.kernel) + len(boot.kernel_dtb)
+                   + (sizeof(MtkHdr) if boot.flags[BootFlag.MTK_KERNEL.value] else 0)]
+        add(section, KERNEL_FILE, boot.kernel, (boot.k_fmt,))
+        sections.append(section)
+    section = [len(boot.ramdisk) + (sizeof(MtkHdr) if boot.flags[BootFlag.MTK_RAMDISK.value] else 0)]
+    if boot.vendor_ramdisks:
+        if os.path.isdir(VND_RAMDISK_DIR):
+            for entry in boot.vendor_ramdisks:
+                frag = boot.vendor_ramdisk(entry)
+                fmt = check_fmt_lg(frag, len(frag))
+                if COMPRESSED(fmt):
+                    add(section, vendor_ramdisk_file(entry), frag, (fmt,))
+    elif not hdr.is_vendor and hdr.header_version == 4:
+        add(section, RAMDISK_FILE, boot.ramdisk, (Format.LZ4_LEGACY,))
+    elif COMPRESSED(boot.r_fmt):
+        add(section, RAMDISK_FILE, boot.ramdisk, DECODE_ORDER)
+    sections = [s for s in sections + [section] if len(s) > 1]
+    if not components:
+        return {}
+
+    def cost(sizes):
+        # 可调组件所在各节对齐后的总大小
+        return sum(align_to(s[0] + sum(sizes[i] for i in s[1:]), hdr.page_size) for s in sections)
+
+    # 其余部分的大小按原镜像计算: 有效数据的末尾减去这些节原来对齐后的大小
+    used = boot.hdr_addr + len(boot.payload)
+    if boot.flags[BootFlag.SEANDROID_FLAG.value]:
+        used += len(SEANDROID_MAGIC) + (4 if boot.flags[BootFlag.DHTB_FLAG.value] else 0)
+    elif boot.flags[BootFlag.LG_BUMP_FLAG.value]:
+        used += len(LG_BUMP_MAGIC)
+    if boot.flags[BootFlag.AVB_FLAG.value]:
+        used = align_to(used, 4096) + boot.avb_footer.vbmeta_size + sizeof(AvbFooter)
+    budget = size_limit - (used - cost(origs))
+    return tune(components, budget, workers, cost=cost)
+
+def repack(src_img: str, out_img: str, skip_comp: bool = False, update_avb: bool = False, avb_key: str = None,
+           workers: int = 0, size_limit: int = 0):
+    # size_limit > 0 时为组件自动选择压缩格式和等级, 使输出不超过 size_limit 字节
+    with trace.span("repack", image=src_img, out=out_img), BootImage(src_img) as boot:
+        print("Repack to boot image: [%s]" %out_img)
+        sums = load_checksums()
+        plan = _tune_plan(boot, size_limit, workers) if size_limit and not skip_comp else {}
+
+        off = {"header": 0, "kernel": 0, "ramdisk": 0, "second": 0,
+               "extra": 0, "dtb": 0, "ignore": 0, "total": 0, "vbmeta": 0}
+
+        # Create a new boot header and reset sizes
+        hdr = boot.hdr.clone()
+        hdr.kernel_size = 0
+        hdr.ramdisk_size = 0
+        hdr.second_size = 0
+        hdr.dtb_size = 0
+        hdr.kernel_dt_size = 0
+
+        if os.access(HEADER_FILE, os.R_OK):
+            hdr.load_hdr_file()
+
+        def unchanged(filename, orig):
+            # 文件内容与解包时一致, 且源镜像中的组件也是当初解包的那一份
+            if filename not in sums or len(orig) == 0:
+                return False
+            raw, src = sums[filename]
+            return file_digest(filename) == raw and hashlib.sha1(orig).hexdigest() == src
+
+        def write_component(fd, filename, orig, fmt):
+            with trace.span("write", component=filename, format=fmt2name(fmt)) as sp:
+                size, reused = _write_component(fd, filename, orig, fmt)
+                sp.set("bytes_out", size)
+                sp.set("reused", reused)
+            return size, reused
+
+        def _write_component(fd, filename, orig, fmt):
+            # 返回 (写入大小, 是否复用了原始数据)
+            if filename in plan:
+                data = plan[filename]["data"]
+                fd.write(data)
+                return len(data), False
+            if unchanged(filename, orig):
+                fd.write(orig)
+                return len(orig), True
+            with open(filename, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    return 0, False
+                if not COMPRESSED(fmt):
+                    return restore(fd, filename), False
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    if not skip_comp and not COMPRESSED_ANY(check_fmt(m, size)):
+                        return compress(fmt, fd, m, size), False
+                    fd.write(m)
+                    return size, False
+
+        # id 校验和 (AOSP 顺序: kernel, ramdisk, second, extra, recovery_dtbo, dtb, 各自后跟 u32 大小)
+        # 在写入各组件时增量计算, 对齐填充不计入
+        id_ctx = None
+        if hdr.id is not None:
+            id_ctx = hashlib.sha256() if boot.flags[BootFlag.SHA256_FLAG.value] else hashlib.sha1()
+        # MTK 头中的 size 写完才知道, 这类镜像只能写完后重新读一遍计算
+        rehash = boot.flags[BootFlag.MTK_KERNEL.value] or boot.flags[BootFlag.MTK_RAMDISK.value]
+
+        with open(out_img, 'w+b') as raw_fd:
+            fd = HashedWriter(raw_fd, None)
+
+            def file_align():
+                # 相对于头部对齐, DHTB / blob 等前置头不影响组件位置
+                write_zero(fd, align_padding(fd.tell() - off["header"], hdr.page_size))
+
+            def begin_hash(enable=True):
+                if enable:
+                    fd.ctx = id_ctx
+
+            def end_hash(size):
+                if fd.ctx is not None:
+                    fd.ctx.update(struct.pack("<I", size))
+                fd.ctx = None
+
+            if boot.flags[BootFlag.DHTB_FLAG.value]:
+                # Skip DHTB header
+                write_zero(fd, sizeof(DhtbHdr))
+            elif boot.flags[BootFlag.BLOB_FLAG.value]:
+                fd.write(boot.buf[:sizeof(BlobHdr)])
+            elif boot.flags[BootFlag.NOOKHD_FLAG.value]:
+                fd.write(boot.buf[:NOOKHD_PRE_HEADER_SZ])
+            elif boot.flags[BootFlag.ACCLAIM_FLAG.value]:
+                fd.write(boot.buf[:ACCLAIM_PRE_HEADER_SZ])
+
+            # Copy raw header
+            off["header"] = fd.tell()
+            fd.write(boot.buf[boot.hdr_addr:boot.hdr_addr + hdr.hdr_space()])
+
+            # kernel
+            off["kernel"] = fd.tell()
+            begin_hash()
+            if boot.flags[BootFlag.MTK_KERNEL.value]:
+                # Copy MTK headers
+                fd.write(bytes(boot.k_hdr))
+            if boot.flags[BootFlag.ZIMAGE_KERNEL.value]:
+                # Copy zImage headers
+                fd.write(string_at(addressof(boot.z_hdr), boot.z_info["hdr_sz"]))
+            if os.access(KERNEL_FILE, os.R_OK):
+                # Always use zopfli for zImage compression
+                fmt = Format.ZOPFLI if (boot.flags[BootFlag.ZIMAGE_KERNEL.value] and boot.k_fmt == Format.GZIP) else boot.k_fmt
+                hdr.kernel_size, reused = write_component(fd, KERNEL_FILE, boot.kernel, fmt)
+
+                if boot.flags[BootFlag.ZIMAGE_KERNEL.value]:
+                    if hdr.kernel_size > boot.hdr.kernel_size:
+                        print("! Recompressed kernel is too large, using original kernel")
+                        rehash = True
+                        fd.seek(-hdr.kernel_size, SEEK_CUR)
+                        fd.truncate()
+                        fd.write(boot.kernel)
+                    elif not skip_comp and not reused:
+                        # Pad zeros to make sure the zImage file size does not change
+                        # Also ensure the last 4 bytes are the uncompressed vmlinux size
+                        write_zero(fd, boot.hdr.kernel_size - hdr.kernel_size - 4)
+                        fd.write(struct.pack("<I", os.path.getsize(KERNEL_FILE)))
+
+                    # zImage size shall remain the same
+                    hdr.kernel_size = boot.hdr.kernel_size
+            elif boot.hdr.kernel_size != 0:
+                fd.write(boot.kernel)
+                hdr.kernel_size = boot.hdr.kernel_size
+            if boot.flags[BootFlag.ZIMAGE_KERNEL.value]:
+                # Copy zImage tail and adjust size accordingly
+                hdr.kernel_size += boot.z_info["hdr_sz"]
+                hdr.kernel_size += fd.write(boot.z_info["tail"])
+
+            # kernel dtb
+            if os.access(KER_DTB_FILE, os.R_OK):
+                hdr.kernel_size += write_component(fd, KER_DTB_FILE, boot.kernel_dtb, Format.UNKNOWN)[0]
+            end_hash(hdr.kernel_size)
+            file_align()
+
+            # ramdisk
+            off["ramdisk"] = fd.tell()
+            begin_hash()
+            if boot.flags[BootFlag.MTK_RAMDISK.value]:
+                # Copy MTK headers
+                fd.write(bytes(boot.r_hdr))
+            vnd_table = []
+            if boot.vendor_ramdisks and os.path.isdir(VND_RAMDISK_DIR):
+                # 各片段在线程池中分别压缩到内存, 再按表中顺序写出并重新计算偏移
+                def pack_fragment(entry):
+                    filename = vendor_ramdisk_file(entry)
+                    if not os.access(filename, os.R_OK):
+                        raise ValueError("Missing vendor ramdisk [%s]" % filename)
+                    frag = boot.vendor_ramdisk(entry)
+                    out = BytesIO()
+                    write_component(out, filename, frag, check_fmt_lg(frag, len(frag)))
+                    return out.getbuffer()
+
+                for entry, data in zip(boot.vendor_ramdisks, _pool_map(pack_fragment, boot.vendor_ramdisks, workers)):
+                    entry = VendorRamdiskTableEntryV4.from_buffer_copy(entry)
+                    entry.ramdisk_offset = hdr.ramdisk_size
+                    entry.ramdisk_size = len(data)
+                    fd.write(data)
+                    hdr.ramdisk_size += len(data)
+                    vnd_table.append(entry)
+            elif os.access(RAMDISK_FILE, os.R_OK):
+                r_fmt = boot.r_fmt
+                if not skip_comp and not hdr.is_vendor and hdr.header_version == 4 and r_fmt != Format.LZ4_LEGACY:
+                    # A v4 boot image ramdisk will have to be merged with other vendor ramdisks,
+                    # and they have to use the exact same compression method. v4 GKIs are required to
+                    # use lz4 (legacy), so hardcode the format here.
+                    print("RAMDISK_FMT: [%s] -> [%s]" %(fmt2name(r_fmt), fmt2name(Format.LZ4_LEGACY)))
+                    r_fmt = Format.LZ4_LEGACY
+                # 换了压缩格式就不能复用原始数据
+                orig = boot.ramdisk if r_fmt == boot.r_fmt else boot.ramdisk[0:0]
+                hdr.ramdisk_size = write_component(fd, RAMDISK_FILE, orig, r_fmt)[0]
+            end_hash(hdr.ramdisk_size)
+            file_align()
+
+            # second
+            off["second"] = fd.tell()
+            begin_hash()
+            if os.access(SECOND_FILE, os.R_OK):
+                hdr.second_size = write_component(fd, SECOND_FILE, boot.second, Format.UNKNOWN)[0]
+            end_hash(hdr.second_size)
+            file_align()
+
+            # extra
+            off["extra"] = fd.tell()
+            begin_hash()
+            if os.access(EXTRA_FILE, os.R_OK):
+                hdr.extra_size = write_component(fd, EXTRA_FILE, boot.extra, boot.e_fmt)[0]
+            if hdr.extra_size:
+                end_hash(hdr.extra_size)
+            fd.ctx = None
+            file_align()
+
+            ver = hdr.header_version
+            # recovery_dtbo
+            if os.access(RECV_DTBO_FILE, os.R_OK):
+                hdr.recovery_dtbo_offset = fd.tell()
+                begin_hash(ver == 1 or ver == 2)
+                hdr.recovery_dtbo_size = write_component(fd, RECV_DTBO_FILE, boot.recovery_dtbo, Format.UNKNOWN)[0]
+            if ver == 1 or ver == 2:
+                begin_hash()
+                end_hash(hdr.recovery_dtbo_size)
+            file_align()
+
+            # dtb
+            off["dtb"] = fd.tell()
+            begin_hash(ver == 2)
+            if os.access(DTB_FILE, os.R_OK):
+                hdr.dtb_size = write_component(fd, DTB_FILE, boot.dtb, Format.UNKNOWN)[0]
+            if ver == 2:
+                end_hash(hdr.dtb_size)
+            fd.ctx = None
+            file_align()
+
+            # Directly copy ignored blobs
+            off["ignore"] = fd.tell()
+            if len(boot.ignore):
+                # ignore_size should already be aligned
+                fd.write(boot.ignore)
+
+            # Proprietary stuffs
+            if boot.flags[BootFlag.SEANDROID_FLAG.value]:
+                fd.write(SEANDROID_MAGIC)
+                if boot.flags[BootFlag.DHTB_FLAG.value]:
+                    fd.write(b"\xFF\xFF\xFF\xFF")
+            elif boot.flags[BootFlag.LG_BUMP_FLAG.value]:
+                fd.write(LG_BUMP_MAGIC)
+
+            off["total"] = fd.tell()
+            file_align()
+
+            # vbmeta
+            if boot.flags[BootFlag.AVB_FLAG.value]:
+                # According to avbtool.py, if the input is not an Android sparse image
+                # (which boot images are not), the default block size is 4096
+                write_zero(fd, align_padding(fd.tell(), 4096))
+                off["vbmeta"] = fd.tell()
+                fd.write(boot.buf[boot.vbmeta_addr:boot.vbmeta_addr + boot.avb_footer.vbmeta_size])
+
+            if size_limit:
+                needed = fd.tell() + (sizeof(AvbFooter) if boot.flags[BootFlag.AVB_FLAG.value] else 0)
+                if needed > size_limit:
+                    raise ValueError("Repacked image needs [%u] bytes, over the size limit [%u]" %(needed, size_limit))
+
+            # Pad image to original size if not chromeos (as it requires post processing)
+            if not boot.flags[BootFlag.CHROMEOS_FLAG.value]:
+                current = fd.tell()
+                if current < boot.map.size():
+                    # 由文件系统补零 (通常是稀疏的), 不经过 Python
+                    fd.flush()
+                    fd.truncate(boot.map.size())
+                    fd.seek(0, SEEK_END)
+
+            fd.flush()
+
+            # Patch the image
+            with mmap.mmap(fd.fileno(), 0) as out:
+                # MTK headers
+                if boot.flags[BootFlag.MTK_KERNEL.value]:
+                    m_hdr = MtkHdr.from_buffer(out, off["kernel"])
+                    m_hdr.size = hdr.kernel_size
+                    hdr.kernel_size += sizeof(MtkHdr)
+                    del m_hdr
+                if boot.flags[BootFlag.MTK_RAMDISK.value]:
+                    m_hdr = MtkHdr.from_buffer(out, off["ramdisk"])
+                    m_hdr.size = hdr.ramdisk_size
+                    hdr.ramdisk_size += sizeof(MtkHdr)
+                    del m_hdr
+
+                # vendor ramdisk 表随 ignore 原样复制, 这里写入新的偏移和大小
+                esize = hdr.vendor_ramdisk_table_entry_size
+                for i, entry in enumerate(vnd_table):
+                    start = off["ignore"] + boot.vrt_off + i * esize
+                    out[start:start + sizeof(entry)] = bytes(entry)
+
+                # Make sure header size matches
+                hdr.header_size = hdr.hdr_size()
+
+                # Update checksum
+                if id_ctx is not None:
+                    if rehash:
+                        id_ctx = hashlib.new(id_ctx.name)
+                        for name in ("kernel", "ramdisk", "second", "extra", "recovery_dtbo", "dtb"):
+                            if name == "extra" and not hdr.extra_size:
+                                continue
+                            if name == "recovery_dtbo" and ver not in (1, 2):
+                                continue
+                            if name == "dtb" and ver != 2:
+                                continue
+                            start = hdr.recovery_dtbo_offset if name == "recovery_dtbo" else off[name]
+                            size = getattr(hdr, name + "_size")
+                            id_ctx.update(out[start:start + size])
+                            id_ctx.update(struct.pack("<I", size))
+                    hdr.id = id_ctx.digest()
+
+                # Print new header info
+                hdr.print()
+
+                # Copy main header
+                if boot.flags[BootFlag.AMONET_FLAG.value]:
+                    real_hdr_sz = min(hdr.hdr_space() - AMONET_MICROLOADER_SZ, hdr.hdr_size())
+                else:
+                    real_hdr_sz = hdr.hdr_size()
+                out[off["header"]:off["header"] + real_hdr_sz] = hdr.raw_hdr()[:real_hdr_sz]
+
+                if boot.flags[BootFlag.AVB_FLAG.value]:
+                    # Copy and patch AVB structures
+                    footer = AvbFooter.from_buffer(out, len(out) - sizeof(AvbFooter))
+                    memmove(addressof(footer), addressof(boot.avb_footer), sizeof(AvbFooter))
+                    footer.original_image_size = off["total"]
+                    # 与解析时相同, vbmeta_offset 相对于启动头
+                    footer.vbmeta_offset = off["vbmeta"] - off["header"]
+                    if os.environ.get("PATCHVBMETAFLAG") == "true":
+                        vbmeta = AvbVBMetaImageHeader.from_buffer(out, off["vbmeta"])
+                        vbmeta.flags = 3
+                        del vbmeta
+                    del footer
+
+                if boot.flags[BootFlag.DHTB_FLAG.value]:
+                    # DHTB header
+                    d_hdr = DhtbHdr.from_buffer(out, 0)
+                    d_hdr.magic = DHTB_MAGIC
+                    d_hdr.size = off["total"] - sizeof(DhtbHdr)
+                    d_hdr.checksum[:32] = hashlib.sha256(out[sizeof(DhtbHdr):off["total"]]).digest()
+                    del d_hdr
+                elif boot.flags[BootFlag.BLOB_FLAG.value]:
+                    # Blob header
+                    b_hdr = BlobHdr.from_buffer(out, 0)
+                    b_hdr.size = off["total"] - sizeof(BlobHdr)
+                    del b_hdr
+
+                if boot.flags[BootFlag.AVB_FLAG.value] and update_avb:
+                    # 在输出映射上原地重写 hash 描述符, 不需要 avbtool 再读写整个分区
+                    from .avb import VBMeta, load_key, update_hash_footer
+                    key = load_key(avb_key) if avb_key else None
+                    if not update_hash_footer(out, VBMeta(out, off["vbmeta"]), off["total"], key):
+                        print("! vbmeta signature not updated, a matching private key is required")
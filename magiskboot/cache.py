@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from . import compress, trace
+from .compress import CHUNK, iter_chunks
+from .format import Format, fmt2name
+
+# 解压结果的持久缓存 (默认关闭), 同一份官方镜像反复解包时不再重复解压
+#   cache.enable("/var/cache/magiskboot", 4 << 30)
+#   unpack("boot.img")   # 第二次起 kernel / ramdisk 直接从缓存复制
+# 键为 (格式, 压缩数据的 sha256), 与来源镜像无关
+# 目录结构: <root>/<摘要末两位>/<key> 为解压后的数据, <key>.json 为元数据 (最后写入, 作为完成标记)
+# 所有写入都先写到临时文件再 os.replace, 多个进程同时写同一个键时结果相同, 不会读到半个文件
+# 解压入口为 decode(fmt, buf): 需要完整的压缩数据计算键, 只能顺序读取的输入 (STDIN, unpack_stream)
+# 以及需要压缩流之后剩余数据的 hexpatch_compressed 直接使用 compress.decode, 不经过缓存
+
+# 当前启用的缓存; 为 None 时 decompress 不查缓存, 调用方只多一次全局变量判断
+active = None
+
+CACHE_MAX_SIZE = 1 << 30
+# 超过这个时间的临时文件视为写入者已经崩溃, 淘汰时一并删除
+TMP_MAX_AGE = 3600
+_TMP_PREFIX = ".tmp-"
+
+class _Writer:
+    # 边解压边写入缓存; commit() 之前其他进程看不到
+    def __init__(self, cache, key: str):
+        self.cache = cache
+        self.key = key
+        fd, self.tmp = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=cache.root)
+        self.fp = os.fdopen(fd, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        if self.fp is None:
+            return
+        if self.size + len(data) > self.cache.max_size:
+            # 单个结果就超出上限, 不缓存
+            self.abort()
+            return
+        self.fp.write(data)
+        self.size += len(data)
+
+    def commit(self, meta: dict):
+        if self.fp is None:
+            return False
+        self.fp.close()
+        self.fp = None
+        path = self.cache.path(self.key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.tmp, path)
+        self.cache._write_json(path + ".json", dict(meta, size=self.size))
+        self.cache.evict()
+        return True
+
+    def abort(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        try:
+            os.remove(self.tmp)
+        except FileNotFoundError:
+            pass
+
+class ComponentCache:
+    def __init__(self, root: str, max_size: int = CACHE_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(fmt: Format, payload):
+        return "%s-%s" % (fmt2name(fmt), hashlib.sha256(payload).hexdigest())
+
+    def path(self, key: str):
+        return os.path.join(self.root, key[-2:], key)
+
+    def _write_json(self, path: str, obj: dict):
+        fd, tmp = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=self.root)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(obj, fp)
+        os.replace(tmp, path)
+
+    def open(self, key: str):
+        # 命中时返回 (已打开的数据文件, 元数据), 否则返回 None
+        # 返回的是打开的文件: 之后即使被其他进程淘汰删除, 读取也不受影响
+        path = self.path(key)
+        try:
+            with open(path + ".json", 'r') as fp:
+                meta = json.load(fp)
+            f = open(path, 'rb')
+        except (OSError, ValueError):
+            trace.count("cache.miss", 1)
+            return None
+        if os.fstat(f.fileno()).st_size != meta.get("size"):
+            f.close()
+            trace.count("cache.miss", 1)
+            return None
+        try:
+            # 最近使用时间记录在 mtime 上, 淘汰时按它排序
+            os.utime(path)
+        except OSError:
+            pass
+        trace.count("cache.hit", 1)
+        return f, meta
+
+    def writer(self, key: str):
+        return _Writer(self, key)
+
+    def entries(self):
+        # [(mtime, 大小, 数据路径), ...]; 数据文件已被删除的 .json 按自身大小计
+        result = []
+        now = time.time()
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                if sub.name.startswith(_TMP_PREFIX):
+                    self._remove_stale(sub, now)
+                continue
+            for entry in os.scandir(sub.path):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith(".json"):
+                    base = entry.path[:-5]
+                    if not os.path.exists(base):
+                        result.append((st.st_mtime, st.st_size, base))
+                    continue
+                result.append((st.st_mtime, st.st_size, entry.path))
+        return result
+
+    def _remove_stale(self, entry, now: float):
+        try:
+            if now - entry.stat().st_mtime > TMP_MAX_AGE:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        # LRU: 总大小超过 max_size 时从最久未使用的开始删除
+        # 其他进程可能同时在淘汰, 找不到的文件直接跳过
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_size:
+            return 0
+        removed = 0
+        with trace.span("cache_evict", bytes_in=total) as sp:
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                # 先删元数据, 读者随即视为未命中
+                for name in (path + ".json", path):
+                    try:
+                        os.remove(name)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+                removed += 1
+            sp.set("removed", removed)
+        return removed
+
+def decode(fmt: Format, buf, workers: int = 1):
+    # 解压完整的压缩数据 buf (bytes / mmap / memoryview), 产出解压后的数据块
+    # 启用了缓存时先按 (格式, 压缩数据摘要) 查找, 未命中则解压的同时写入缓存;
+    # 出错或调用者中途放弃时丢弃写了一半的缓存
+    c = active
+    if c is None:
+        yield from compress.decode(fmt, iter_chunks(buf), workers)
+        return
+    key = c.key(fmt, buf)
+    hit = c.open(key)
+    if hit is not None:
+        f, meta = hit
+        with f, trace.span("cache_hit", key=key, bytes_out=meta["size"]):
+            yield from iter(lambda: f.read(CHUNK), b"")
+        return
+    writer = c.writer(key)
+    try:
+        for chunk in compress.decode(fmt, iter_chunks(buf), workers):
+            writer.write(chunk)
+            yield chunk
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit({"format": fmt2name(fmt), "compressed_size": len(buf)})
+
+def enable(root: str, max_size: int = CACHE_MAX_SIZE):
+    global active
+    active = ComponentCache(root, max_size)
+    return active
+
+def disable():
+    global active
+    active = None
+
+def _from_env():
+    # MAGISKBOOT_CACHE=<目录> 时整个进程启用缓存; MAGISKBOOT_CACHE_SIZE 为大小上限 (字节, 可用 0x 前缀)
+    root = os.environ.get("MAGISKBOOT_CACHE")
+    if root:
+        enable(root, int(os.environ.get("MAGISKBOOT_CACHE_SIZE", str(CACHE_MAX_SIZE)), 0))
+
+_from_env()
@@ -0,0 +1,273 @@
+import os
+import sys
+
+# 命令行入口: python -m magiskboot <action> ...
+# 这里只导入 os / sys, 每个子命令在执行时才导入自己需要的模块
+
+USAGE = """MagiskBoot - Boot Image Modification Tool
+
+Usage: magiskboot <action> [args...]
+
+Supported actions:
+  unpack [-n] [-h] [-m SIZE] <bootimg>
+    Unpack <bootimg> to its individual components, each component to
+    a file with its corresponding file name in the current directory.
+    If '-n' is provided, all decompression operations will be skipped;
+    If '-h' is provided, the boot image header information will be
+    dumped to the file 'header'.
+    <bootimg> can be '-' to be STDIN; the image is then read sequentially
+    and buffers are kept within SIZE bytes of memory (64M by default).
+    If '-m' is provided, <bootimg> is read the same way.
+
+  repack [-n] [-s SIZE] <origbootimg> [outbootimg]
+    Repack boot image components using files from the current directory
+    to [outbootimg], or 'new-boot.img' if not specified.
+    If '-n' is provided, all compression operations will be skipped.
+    If '-s' is provided, compression format and level are chosen per
+    component so that the image fits in SIZE bytes; the choice is
+    cached in 'tune.json'.
+
+  info <bootimg>
+    Print the boot image header, trailer and AVB footer information as
+    JSON, reading only the header page and the end of the file.
+
+  hexpatch [-c] <file> <hexpattern1> <hexpattern2>
+    Search <hexpattern1> in <file>, and replace it with <hexpattern2>
+    If '-c' is provided and <file> is compressed, the decompressed data
+    is patched and written back with the same format.
+
+  cpio <incpio> [commands...]
+    Do cpio commands to <incpio> (modifications are done in-place).
+    Each command is a single argument; add quotes for each command.
+    A compressed <incpio> is written back with the same format.
+    Supported commands:
+      exists ENTRY
+        Return 0 if ENTRY exists, else return 1
+      ls [-r] [PATH]
+        List PATH ("/" by default); specify [-r] to list recursively
+      rm [-r] ENTRY
+        Remove ENTRY, specify [-r] to remove recursively
+      mkdir MODE ENTRY
+        Create directory ENTRY with permissions MODE
+      ln TARGET ENTRY
+        Create a symlink to TARGET with the name ENTRY
+      mv SOURCE DEST
+        Move SOURCE to DEST
+      add MODE ENTRY INFILE
+        Add INFILE as ENTRY with permissions MODE; replaces ENTRY if exists
+      extract [ENTRY OUT]
+        Extract ENTRY to OUT, or extract all entries to current directory
+      backup ORIG [-n]
+        Create ramdisk backups from ORIG, only the changed entries are
+        stored; specify [-n] to skip compressing ORIG entries
+      restore
+        Restore ramdisk from ramdisk backup stored within incpio
+
+  dtb <file> <action> [args...]
+    Do dtb related actions to <file>.
+    Supported actions:
+      print [-f]
+        Print all contents of dtb for debugging
+        Specify [-f] to only print fstab nodes
+      patch
+        Search for fstab and remove verity/avb, and replace
+        skip_initramfs with want_initramfs in bootargs
+        Modifications are done directly to the file in-place
+        Configure with env variables: KEEPVERITY
+
+  compress[=format] <infile> [outfile]
+    Compress <infile> with [format] to [outfile].
+    <infile>/[outfile] can be '-' to be STDIN/STDOUT.
+    If [format] is not specified, then gzip will be used.
+    If [outfile] is not specified, then <infile> will be replaced
+    with another file suffixed with a matching file extension.
+    Supported formats: gzip zopfli xz lzma bzip2 lz4 lz4_legacy lz4_lg
+
+  decompress <infile> [outfile]
+    Detect format and decompress <infile> to [outfile].
+    <infile>/[outfile] can be '-' to be STDIN/STDOUT.
+    If [outfile] is not specified, then <infile> will be replaced
+    with another file removing its archive format file extension.
+"""
+
+def usage():
+    print(USAGE, file=sys.stderr, end="")
+    return 1
+
+def _open_in(path: str):
+    from contextlib import nullcontext
+    # 不关闭 STDIN/STDOUT
+    return nullcontext(sys.stdin.buffer) if path == "-" else open(path, 'rb')
+
+def _open_out(path: str):
+    from contextlib import nullcontext
+    return nullcontext(sys.stdout.buffer) if path == "-" else open(path, 'wb')
+
+def _read_chunks(fp):
+    from .compress import CHUNK
+    return iter(lambda: fp.read(CHUNK), b"")
+
+def cmd_unpack(args):
+    skip_decomp = hdr = False
+    mem_limit = 0
+    while args and args[0] in ("-n", "-h", "-m"):
+        opt = args.pop(0)
+        if opt == "-n":
+            skip_decomp = True
+        elif opt == "-h":
+            hdr = True
+        elif args:
+            mem_limit = int(args.pop(0), 0)
+        else:
+            return usage()
+    if len(args) != 1:
+        return usage()
+    if args[0] == "-" or mem_limit:
+        from .stream import STREAM_MEM_LIMIT, unpack_stream
+        with _open_in(args[0]) as fp:
+            return unpack_stream(fp, skip_decomp, hdr, mem_limit or STREAM_MEM_LIMIT)
+    from .bootimg import unpack
+    return unpack(args[0], skip_decomp, hdr)
+
+def cmd_repack(args):
+    skip_comp = False
+    size_limit = 0
+    while args and args[0] in ("-n", "-s"):
+        if args.pop(0) == "-n":
+            skip_comp = True
+        elif args:
+            size_limit = int(args.pop(0), 0)
+        else:
+            return usage()
+    if len(args) not in (1, 2):
+        return usage()
+    from .bootimg import repack
+    from .magiskboot import NEW_BOOT
+    repack(args[0], args[1] if len(args) == 2 else NEW_BOOT, skip_comp, size_limit=size_limit)
+    return 0
+
+def cmd_info(args):
+    if len(args) != 1:
+        return usage()
+    import json
+    from .bootimg import info
+    print(json.dumps(info(args[0]), indent=2))
+    return 0
+
+def cmd_hexpatch(args):
+    compressed = bool(args) and args[0] == "-c"
+    if compressed:
+        args = args[1:]
+    if len(args) != 3:
+        return usage()
+    from .hexpatch import hexpatch
+    return hexpatch(*args, compressed=compressed)
+
+def cmd_cpio(args):
+    if not args:
+        return usage()
+    from .cpio import cpio_commands
+    return cpio_commands(args[0], args[1:])
+
+def cmd_dtb(args):
+    if len(args) < 2:
+        return usage()
+    from .dtb import dtb_commands
+    return dtb_commands(args[0], args[1], args[2:])
+
+def cmd_compress(args, method: str = "gzip"):
+    if len(args) not in (1, 2):
+        return usage()
+    from .compress import encode
+    from .format import Format, fmt2ext, name2fmt
+    fmt = name2fmt(method)
+    if fmt == Format.UNKNOWN:
+        print("Unsupported compression method [%s]" % method, file=sys.stderr)
+        return 1
+    infile = args[0]
+    rm_in = len(args) == 1
+    if rm_in:
+        if infile == "-":
+            return usage()
+        outfile = infile + fmt2ext(fmt)
+    else:
+        outfile = args[1]
+    with _open_in(infile) as fin, _open_out(outfile) as fout:
+        for chunk in encode(fmt, _read_chunks(fin)):
+            fout.write(chunk)
+    if rm_in:
+        os.remove(infile)
+    return 0
+
+def cmd_decompress(args):
+    if len(args) not in (1, 2):
+        return usage()
+    from itertools import chain
+    from .compress import CHUNK, decode
+    from .format import COMPRESSED, check_fmt, fmt2ext, fmt2name
+    infile = args[0]
+    rm_in = len(args) == 1
+    with _open_in(infile) as fin:
+        head = fin.read(CHUNK)
+        fmt = check_fmt(head, len(head))
+        if not COMPRESSED(fmt):
+            print("Input file is not a supported compressed type!", file=sys.stderr)
+            return 1
+        if rm_in:
+            ext = fmt2ext(fmt)
+            if infile == "-" or not infile.endswith(ext):
+                print("Input file is not a supported type!", file=sys.stderr)
+                return 1
+            outfile = infile[:-len(ext)]
+            print("Detected format: [%s]" % fmt2name(fmt), file=sys.stderr)
+        else:
+            outfile = args[1]
+        with _open_out(outfile) as fout:
+            if infile == "-":
+                # STDIN 只能顺序读取, 不经过组件缓存
+                for chunk in decode(fmt, chain((head,), _read_chunks(fin))):
+                    fout.write(chunk)
+            else:
+                import mmap
+                from .cache import decode as cached_decode
+                buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for chunk in cached_decode(fmt, buf):
+                        fout.write(chunk)
+                finally:
+                    try:
+                        buf.close()
+                    except BufferError:
+                        # 出错时 traceback 仍引用映射上的视图, 由垃圾回收关闭
+                        pass
+    if rm_in:
+        os.remove(infile)
+    return 0
+
+ACTIONS = {
+    "unpack": cmd_unpack,
+    "repack": cmd_repack,
+    "info": cmd_info,
+    "hexpatch": cmd_hexpatch,
+    "cpio": cmd_cpio,
+    "dtb": cmd_dtb,
+    "compress": cmd_compress,
+    "decompress": cmd_decompress,
+}
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else list(argv)
+    if not args:
+        return usage()
+    action = args.pop(0)
+    extra = ()
+    if action.startswith("compress="):
+        action, extra = "compress", (action[len("compress="):],)
+    func = ACTIONS.get(action)
+    if func is None:
+        return usage()
+    try:
+        return func(args, *extra) or 0
+    except (ValueError, RuntimeError, OSError) as e:
+        print("! %s" % e, file=sys.stderr)
+        return 1
@@ -1,3 +1,673 @@
-from .format import Format
+import os
+import zlib
+from collections import deque
 
-def get_encoder(type: Format)
\ No newline at end of file
+from . import trace
+from .format import Format, fmt2name
+
+# 每次喂给/吐出编解码器的块大小, 内存占用与负载大小无关
+CHUNK = 0x40000
+
+LZ4_LEGACY_MAGIC = 0x184C2102
+LZ4_LEGACY_BLOCKSZ = 0x800000
+# LZ4_COMPRESSBOUND(LZ4_LEGACY_BLOCKSZ), 单个压缩块的最大大小
+LZ4_BLOCK_BOUND = LZ4_LEGACY_BLOCKSZ + LZ4_LEGACY_BLOCKSZ // 255 + 16
+LZ4F_BLOCKSZ = 0x400000
+
+# 并行压缩时每块的输入大小
+PARALLEL_BLOCKSZ = 0x200000
+
+# 默认压缩等级 (与 magiskboot 一致); lz4 的等级小于 3 时使用快速模式
+DEFAULT_LEVEL = 9
+
+def _lz4():
+    try:
+        import lz4.frame
+        import lz4.block
+    except ImportError:
+        raise RuntimeError("lz4 support requires the 'lz4' package") from None
+    return lz4
+
+def _lz4_block(lz4, data, level: int):
+    if level < 3:
+        return lz4.block.compress(data, mode="default", store_size=False)
+    return lz4.block.compress(data, mode="high_compression", compression=level, store_size=False)
+
+def iter_chunks(buf, size: int = -1, chunk: int = CHUNK):
+    # buf 为 bytes / mmap / memoryview, 切片 memoryview 不会复制
+    view = memoryview(buf)
+    if size < 0:
+        size = len(view)
+    for off in range(0, size, chunk):
+        yield view[off:min(off + chunk, size)]
+
+class Stream:
+    # 流式编解码器: feed() 每次接受一块输入并产出若干输出块, finish() 产出剩余数据
+    def feed(self, data):
+        raise NotImplementedError
+
+    def finish(self):
+        return iter(())
+
+    def close(self):
+        # 释放线程池等资源; transform() 正常结束、出错或被调用者放弃时都会调用
+        pass
+
+    def transform(self, chunks):
+        try:
+            for chunk in chunks:
+                yield from self.feed(chunk)
+            yield from self.finish()
+        finally:
+            self.close()
+
+class _ObjEncoder(Stream):
+    # zlib / lzma / bz2 风格的 compressobj
+    def __init__(self, obj):
+        self.obj = obj
+
+    def feed(self, data):
+        out = self.obj.compress(data)
+        if out:
+            yield out
+
+    def finish(self):
+        out = self.obj.flush()
+        if out:
+            yield out
+
+class _ObjDecoder(Stream):
+    # 通过 max_length 限制每次输出, 避免一次性解出整个负载
+    # 支持多个串联的流 (gzip 多 member, bzip2 多 stream 等)
+    def __init__(self, factory, magic: bytes = b""):
+        self.factory = factory
+        self.magic = magic
+        self.obj = factory()
+        self.done = False
+        # 流结束之后的数据 (填充, 附加的 dtb 等), 原样保留给调用者
+        self.unused = bytearray()
+        # 已结束的流个数, 以及当前流开头的字节 (不超过 magic 的长度) 和已输入的字节数;
+        # 流恰好在输入块末尾结束时先开始下一个流 (fed 为 0), 收到数据后再判断是新的流还是填充
+        self.members = 0
+        self.head = b""
+        self.fed = 0
+
+    def _next(self, rest):
+        self.members += 1
+        self.obj = self.factory()
+        self.head = rest[:len(self.magic)]
+        self.fed = len(rest)
+
+    def _drain(self, data):
+        while True:
+            out = self.obj.decompress(data, CHUNK)
+            data = b""
+            if out:
+                yield out
+            if self.obj.eof:
+                rest = self.obj.unused_data or b""
+                if not rest.startswith(self.magic[:len(rest)]):
+                    # 剩下的是填充数据
+                    self.done = True
+                    self.unused += rest
+                    return
+                self._next(rest)
+                if not rest:
+                    return
+                data = rest
+            elif self.obj.needs_input:
+                return
+
+    def feed(self, data):
+        if self.done:
+            self.unused += data
+            return
+        data = bytes(data)
+        if self.members and not self.fed and not data.startswith(self.magic[:len(data)]):
+            # 上一个流恰好在块边界结束, 之后的数据不是新的流: 填充
+            self.done = True
+            self.unused += data
+            return
+        if len(self.head) < len(self.magic):
+            self.head += data[:len(self.magic) - len(self.head)]
+        self.fed += len(data)
+        yield from self._drain(data)
+
+    def _check(self):
+        # 输入结束时流必须完整, 否则截断的数据会被当成成功解压
+        if self.done or self.obj.eof:
+            return
+        if self.members and self.fed <= len(self.magic) and self.magic.startswith(self.head):
+            # 末尾只是与 magic 开头相同的填充, 不是新的流
+            self.done = True
+            self.unused += self.head
+            return
+        raise ValueError("Truncated compressed stream")
+
+    def finish(self):
+        self._check()
+        return iter(())
+
+class _ZlibDecoder(_ObjDecoder):
+    # zlib.decompressobj 没有 eof/needs_input 的 max_length 语义, 单独处理
+    def __init__(self):
+        super().__init__(lambda: zlib.decompressobj(16 + zlib.MAX_WBITS), b"\x1f\x8b")
+
+    def _drain(self, data):
+        while True:
+            out = self.obj.decompress(data, CHUNK)
+            if out:
+                yield out
+            if self.obj.eof:
+                rest = self.obj.unused_data
+                if not rest.startswith(self.magic[:len(rest)]):
+                    self.done = True
+                    self.unused += rest
+                    return
+                self._next(rest)
+                if not rest:
+                    return
+                data = rest
+                continue
+            data = self.obj.unconsumed_tail
+            if not data:
+                return
+
+    def finish(self):
+        if not self.done:
+            out = self.obj.flush()
+            if out:
+                yield out
+        self._check()
+
+class _ZopfliEncoder(_ObjEncoder):
+    def __init__(self):
+        try:
+            import zopfli
+        except ImportError:
+            raise RuntimeError("zopfli support requires the 'zopfli' package") from None
+        super().__init__(zopfli.ZopfliCompressor(zopfli.ZOPFLI_FORMAT_GZIP))
+
+class _LZ4FEncoder(Stream):
+    def __init__(self, level: int = DEFAULT_LEVEL):
+        lz4 = _lz4()
+        self.obj = lz4.frame.LZ4FrameCompressor(
+            block_size=lz4.frame.BLOCKSIZE_MAX4MB,
+            block_linked=False,
+            compression_level=level,
+            content_checksum=True
+        )
+        self.begun = False
+
+    def feed(self, data):
+        if not self.begun:
+            self.begun = True
+            yield self.obj.begin()
+        out = self.obj.compress(data)
+        if out:
+            yield out
+
+    def finish(self):
+        if not self.begun:
+            self.begun = True
+            yield self.obj.begin()
+        yield self.obj.flush()
+
+class _LZ4FDecoder(_ObjDecoder):
+    def __init__(self):
+        lz4 = _lz4()
+        super().__init__(lz4.frame.LZ4FrameDecompressor, b"\x04\x22\x4d\x18")
+
+class _BlockBatch:
+    # 按批处理独立的块: 一批最多 workers 块, workers > 1 时在线程池中并行 (lz4 处理块时释放 GIL)
+    # 输入块放在预先分配并循环使用的槽位中, 每块不再单独拷贝成 bytes
+    def __init__(self, workers: int, slot_size: int):
+        self.workers = max(workers, 1)
+        self.slot_size = slot_size
+        self.slots = []
+        self.sizes = []
+        self.pool = None
+
+    def slot(self):
+        # 当前待填充的槽位, 第一次用到时才分配
+        i = len(self.sizes)
+        if i == len(self.slots):
+            self.slots.append(bytearray(self.slot_size))
+        return self.slots[i]
+
+    def commit(self, size: int):
+        self.sizes.append(size)
+        return len(self.sizes) >= self.workers
+
+    def run(self, func):
+        views = [memoryview(slot)[:size] for slot, size in zip(self.slots, self.sizes)]
+        self.sizes = []
+        if len(views) > 1:
+            if self.pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.pool = ThreadPoolExecutor(self.workers)
+            results = list(self.pool.map(func, views))
+        else:
+            results = [func(v) for v in views]
+        for v in views:
+            v.release()
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+class _LZ4Encoder(Stream):
+    # legacy 格式: magic + 若干 [u32 压缩块大小][块], 每块解压后 8MB, 块之间互相独立
+    # LG 变体在末尾额外写入 u32 解压后总大小
+    def __init__(self, lg: bool, level: int = DEFAULT_LEVEL, workers: int = 1):
+        self.lz4 = _lz4()
+        self.lg = lg
+        self.level = level
+        self.batch = _BlockBatch(workers, LZ4_LEGACY_BLOCKSZ)
+        self.fill = 0
+        self.in_total = 0
+        self.begun = False
+
+    def _block(self, data):
+        block = _lz4_block(self.lz4, data, self.level)
+        return len(block).to_bytes(4, "little") + block
+
+    def _flush(self):
+        yield from self.batch.run(self._block)
+
+    def feed(self, data):
+        if not self.begun:
+            self.begun = True
+            yield LZ4_LEGACY_MAGIC.to_bytes(4, "little")
+        view = memoryview(data).cast("B")
+        self.in_total += len(view)
+        pos = 0
+        while pos < len(view):
+            slot = self.batch.slot()
+            n = min(LZ4_LEGACY_BLOCKSZ - self.fill, len(view) - pos)
+            slot[self.fill:self.fill + n] = view[pos:pos + n]
+            self.fill += n
+            pos += n
+            if self.fill == LZ4_LEGACY_BLOCKSZ:
+                self.fill = 0
+                if self.batch.commit(LZ4_LEGACY_BLOCKSZ):
+                    yield from self._flush()
+
+    def finish(self):
+        if not self.begun:
+            self.begun = True
+            yield LZ4_LEGACY_MAGIC.to_bytes(4, "little")
+        if self.fill:
+            self.batch.slot()
+            self.batch.commit(self.fill)
+            self.fill = 0
+        yield from self._flush()
+        self.batch.close()
+        if self.lg:
+            yield (self.in_total & 0xffffffff).to_bytes(4, "little")
+
+    def close(self):
+        self.batch.close()
+
+def lz4_block_decompress(src, limit: int = LZ4_LEGACY_BLOCKSZ):
+    # 没有 lz4 模块时使用的纯 Python LZ4 块解码, 只用于解压 (legacy 格式的内核 / ramdisk)
+    src = bytes(src)
+    n = len(src)
+    out = bytearray()
+    pos = 0
+    while pos < n:
+        token = src[pos]
+        pos += 1
+        lit = token >> 4
+        if lit == 15:
+            while True:
+                b = src[pos]
+                pos += 1
+                lit += b
+                if b != 255:
+                    break
+        if lit:
+            out += src[pos:pos + lit]
+            pos += lit
+        if pos >= n:
+            # 最后一个序列只有字面量
+            break
+        offset = src[pos] | (src[pos + 1] << 8)
+        pos += 2
+        mlen = token & 15
+        if mlen == 15:
+            while True:
+                b = src[pos]
+                pos += 1
+                mlen += b
+                if b != 255:
+                    break
+        mlen += 4
+        start = len(out) - offset
+        if offset == 0 or start < 0 or len(out) + mlen > limit:
+            raise ValueError("Corrupted lz4 block")
+        if mlen <= offset:
+            out += out[start:start + mlen]
+        else:
+            # 匹配与输出重叠, 相当于重复最近 offset 字节
+            pattern = out[start:]
+            q, r = divmod(mlen, offset)
+            out += pattern * q + pattern[:r]
+    return bytes(out)
+
+class _LZ4Decoder(Stream):
+    # 逐块解析 legacy 帧, 块读入复用的槽位后按批解压 (可并行)
+    # 块大小为 0 或超过 LZ4_BLOCK_BOUND 时视为结束: LZ4_LG 的总大小字段或结尾填充
+    def __init__(self, workers: int = 1):
+        try:
+            self.lz4 = _lz4()
+            self.decompress = self._decompress
+        except RuntimeError:
+            self.decompress = lz4_block_decompress
+        self.batch = _BlockBatch(workers, LZ4_BLOCK_BOUND)
+        self.head = bytearray()
+        self.need = 0
+        self.fill = 0
+        self.done = False
+        self.unused = bytearray()
+
+    def _decompress(self, block):
+        return self.lz4.block.decompress(block, uncompressed_size=LZ4_LEGACY_BLOCKSZ)
+
+    def feed(self, data):
+        view = memoryview(data).cast("B")
+        pos = 0
+        while pos < len(view):
+            if self.done:
+                self.unused += view[pos:]
+                return
+            if not self.need:
+                n = min(4 - len(self.head), len(view) - pos)
+                self.head += view[pos:pos + n]
+                pos += n
+                if len(self.head) < 4:
+                    break
+                size = int.from_bytes(self.head, "little")
+                if size == LZ4_LEGACY_MAGIC:
+                    # 文件头或多段串联
+                    self.head.clear()
+                    continue
+                if size == 0 or size > LZ4_BLOCK_BOUND:
+                    self.done = True
+                    self.unused += self.head
+                    self.head.clear()
+                    continue
+                self.head.clear()
+                self.need = size
+                self.fill = 0
+                continue
+            slot = self.batch.slot()
+            n = min(self.need - self.fill, len(view) - pos)
+            slot[self.fill:self.fill + n] = view[pos:pos + n]
+            self.fill += n
+            pos += n
+            if self.fill == self.need:
+                self.need = 0
+                if self.batch.commit(self.fill):
+                    yield from self.batch.run(self.decompress)
+
+    def finish(self):
+        # 输入在块中间或块头中间结束: 截断的数据
+        # 例外是末尾恰好 4 字节且后面没有数据的 "块头": LZ4_LG 较小的总大小字段, 与较大时一样留在 unused 中
+        if self.head or (self.need and self.fill):
+            raise ValueError("Truncated compressed stream")
+        if self.need:
+            self.done = True
+            self.unused += self.need.to_bytes(4, "little")
+            self.need = 0
+        yield from self.batch.run(self.decompress)
+        self.batch.close()
+
+    def close(self):
+        self.batch.close()
+
+class _ParallelEncoder(Stream):
+    # 类似 pigz / pxz: 输入按块切分后在线程池里压缩 (zlib/lzma/lz4 压缩时都会释放 GIL),
+    # 按顺序拼接成单个合法的流. 同时在途的块数有上限, 内存不随负载增长
+    def __init__(self, workers: int, block_size: int, level: int = DEFAULT_LEVEL):
+        self.workers = workers
+        self.block_size = block_size
+        self.level = level
+        from concurrent.futures import ThreadPoolExecutor
+        self.pool = ThreadPoolExecutor(workers)
+        self.pending = deque()
+        self.buf = bytearray()
+        self.begun = False
+        self.index = 0
+
+    def header(self):
+        return b""
+
+    def trailer(self):
+        return b""
+
+    def compress_block(self, index: int, data: bytes):
+        raise NotImplementedError
+
+    def _submit(self, data: bytes):
+        self.pending.append(self.pool.submit(self.compress_block, self.index, data))
+        self.index += 1
+
+    def _collect(self, limit: int):
+        while len(self.pending) > limit:
+            yield self.pending.popleft().result()
+
+    def feed(self, data):
+        if not self.begun:
+            self.begun = True
+            yield self.header()
+        self.buf += data
+        while len(self.buf) >= self.block_size:
+            self._submit(bytes(self.buf[:self.block_size]))
+            del self.buf[:self.block_size]
+            yield from self._collect(self.workers * 2)
+
+    def finish(self):
+        if not self.begun:
+            self.begun = True
+            yield self.header()
+        if self.buf:
+            self._submit(bytes(self.buf))
+            self.buf = bytearray()
+        yield from self._collect(0)
+        self.pool.shutdown()
+        yield self.trailer()
+
+    def close(self):
+        # 生成器被放弃时还有在途的块: 取消未开始的, 只等待正在压缩的块结束
+        self.pool.shutdown(cancel_futures=True)
+
+class _ParallelGzipEncoder(_ParallelEncoder):
+    # 每块为独立的 raw deflate, 以前一块末尾 32K 作为字典并以 Z_SYNC_FLUSH 结束,
+    # 最后追加一个空的 final block, 得到与串行压缩等价的单个 gzip member
+    def __init__(self, workers: int, block_size: int = PARALLEL_BLOCKSZ, level: int = DEFAULT_LEVEL):
+        super().__init__(workers, block_size, level)
+        self.crc = 0
+        self.size = 0
+        self.dict = b""
+
+    def header(self):
+        return b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\x03"
+
+    def _submit(self, data: bytes):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.pending.append(self.pool.submit(self.compress_block, self.dict, data))
+        self.dict = data[-0x8000:]
+
+    def compress_block(self, zdict: bytes, data: bytes):
+        if zdict:
+            obj = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+        else:
+            obj = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return obj.compress(data) + obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def trailer(self):
+        return (b"\x03\x00" + self.crc.to_bytes(4, "little")
+                + (self.size & 0xffffffff).to_bytes(4, "little"))
+
+def _xz_varint(n: int):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def _xz_dict_props(dict_size: int):
+    # LZMA2 的字典大小属性字节: 2^n 或 3*2^(n-1)
+    for b in range(40):
+        if (2 | (b & 1)) << (b // 2 + 11) >= dict_size:
+            return b
+    return 40
+
+class _ParallelXzEncoder(_ParallelEncoder):
+    # 类似 pxz: 每块独立编码为 raw LZMA2, 自己写 xz 的 block header / index / footer,
+    # 结果是一个包含多个 block 的单个 xz stream (CRC32 check, 与串行编码器一致)
+    STREAM_FLAGS = b"\x00\x01"
+
+    def __init__(self, workers: int, block_size: int = PARALLEL_BLOCKSZ * 4, level: int = DEFAULT_LEVEL):
+        super().__init__(workers, block_size, level)
+        self.dict_size = max(block_size, 0x1000)
+        self.records = []
+
+    def header(self):
+        return b"\xfd7zXZ\x00" + self.STREAM_FLAGS + zlib.crc32(self.STREAM_FLAGS).to_bytes(4, "little")
+
+    def compress_block(self, index: int, data: bytes):
+        import lzma
+        filters = [{"id": lzma.FILTER_LZMA2, "preset": self.level, "dict_size": self.dict_size}]
+        comp = lzma.compress(data, lzma.FORMAT_RAW, filters=filters)
+        hdr = bytes([0x00, 0x21, 0x01, _xz_dict_props(self.dict_size)])
+        hdr += b"\x00" * ((-(len(hdr) + 1 + 4)) % 4)
+        hdr = bytes([(len(hdr) + 1 + 4) // 4 - 1]) + hdr
+        hdr += zlib.crc32(hdr).to_bytes(4, "little")
+        block = (hdr + comp + b"\x00" * ((-len(comp)) % 4)
+                 + zlib.crc32(data).to_bytes(4, "little"))
+        return len(hdr) + len(comp) + 4, len(data), block
+
+    def _collect(self, limit: int):
+        for unpadded, size, block in super()._collect(limit):
+            self.records.append((unpadded, size))
+            yield block
+
+    def trailer(self):
+        index = b"\x00" + _xz_varint(len(self.records))
+        for unpadded, size in self.records:
+            index += _xz_varint(unpadded) + _xz_varint(size)
+        index += b"\x00" * ((-len(index)) % 4)
+        index += zlib.crc32(index).to_bytes(4, "little")
+        footer = (len(index) // 4 - 1).to_bytes(4, "little") + self.STREAM_FLAGS
+        return index + zlib.crc32(footer).to_bytes(4, "little") + footer + b"YZ"
+
+class _ParallelLZ4FEncoder(_ParallelEncoder):
+    # 独立块 (block_linked=False) 的 LZ4 frame, 块数据由 lz4.block 并行生成
+    def __init__(self, workers: int, level: int = DEFAULT_LEVEL):
+        super().__init__(workers, LZ4F_BLOCKSZ, level)
+        self.lz4 = _lz4()
+
+    def header(self):
+        return self.lz4.frame.LZ4FrameCompressor(
+            block_size=self.lz4.frame.BLOCKSIZE_MAX4MB,
+            block_linked=False,
+            compression_level=self.level,
+            content_checksum=False
+        ).begin()
+
+    def compress_block(self, index: int, data: bytes):
+        block = _lz4_block(self.lz4, data, self.level)
+        if len(block) >= len(data):
+            # 不可压缩的块原样存放, 最高位置 1
+            return (len(data) | 0x80000000).to_bytes(4, "little") + data
+        return len(block).to_bytes(4, "little") + block
+
+    def trailer(self):
+        return b"\x00\x00\x00\x00"
+
+def get_parallel_encoder(type: Format, workers: int = 0, level: int = DEFAULT_LEVEL):
+    # workers <= 0 时使用全部 CPU
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    match type:
+        case Format.GZIP:
+            return _ParallelGzipEncoder(workers, level=level)
+        case Format.XZ:
+            return _ParallelXzEncoder(workers, level=level)
+        case Format.LZ4:
+            return _ParallelLZ4FEncoder(workers, level)
+        case Format.LZ4_LEGACY:
+            return _LZ4Encoder(False, level, workers)
+        case Format.LZ4_LG:
+            return _LZ4Encoder(True, level, workers)
+        case _:
+            return None
+
+def get_encoder(type: Format, workers: int = 1, level: int = DEFAULT_LEVEL):
+    # workers != 1 时对支持的格式 (gzip/xz/lz4) 使用多线程分块压缩
+    # level: gzip / bzip2 为 1-9, xz / lzma 为 preset 0-9, lz4 为 1-12; zopfli 忽略
+    if workers != 1:
+        encoder = get_parallel_encoder(type, workers, level)
+        if encoder is not None:
+            return encoder
+    # lzma / bz2 / lz4 在第一次用到时才导入, 只处理 gzip 的命令不需要付出导入开销
+    match type:
+        case Format.XZ:
+            import lzma
+            return _ObjEncoder(lzma.LZMACompressor(lzma.FORMAT_XZ, check=lzma.CHECK_CRC32, preset=level))
+        case Format.LZMA:
+            import lzma
+            return _ObjEncoder(lzma.LZMACompressor(lzma.FORMAT_ALONE, preset=level))
+        case Format.BZIP2:
+            import bz2
+            return _ObjEncoder(bz2.BZ2Compressor(level))
+        case Format.LZ4:
+            return _LZ4FEncoder(level)
+        case Format.LZ4_LEGACY:
+            return _LZ4Encoder(False, level)
+        case Format.LZ4_LG:
+            return _LZ4Encoder(True, level)
+        case Format.ZOPFLI:
+            return _ZopfliEncoder()
+        case Format.GZIP:
+            return _ObjEncoder(zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS))
+        case _:
+            raise ValueError("Unsupported compression format [%s]" % fmt2name(type))
+
+def get_decoder(type: Format, workers: int = 1):
+    # workers 只对 lz4 legacy 有效 (块互相独立, 可以并行解压); <= 0 时使用全部 CPU
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    match type:
+        case Format.XZ | Format.LZMA:
+            import lzma
+            return _ObjDecoder(lambda: lzma.LZMADecompressor(lzma.FORMAT_AUTO), b"\xfd7zXZ" if type == Format.XZ else b"\x5d")
+        case Format.BZIP2:
+            import bz2
+            return _ObjDecoder(bz2.BZ2Decompressor, b"BZh")
+        case Format.LZ4:
+            return _LZ4FDecoder()
+        case Format.LZ4_LEGACY | Format.LZ4_LG:
+            return _LZ4Decoder(workers)
+        case Format.GZIP | Format.ZOPFLI:
+            return _ZlibDecoder()
+        case _:
+            raise ValueError("Unsupported compression format [%s]" % fmt2name(type))
+
+def encode(type: Format, chunks, workers: int = 1, level: int = DEFAULT_LEVEL):
+    if trace.tracer is None:
+        return get_encoder(type, workers, level).transform(chunks)
+    return trace.tracer.stream("encode", get_encoder(type, workers, level), chunks,
+                               {"format": fmt2name(type), "workers": workers, "level": level})
+
+def decode(type: Format, chunks, workers: int = 1):
+    if trace.tracer is None:
+        return get_decoder(type, workers).transform(chunks)
+    return trace.tracer.stream("decode", get_decoder(type, workers), chunks,
+                               {"format": fmt2name(type), "workers": workers})
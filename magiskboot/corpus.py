@@ -0,0 +1,340 @@
+import hashlib
+import random
+import struct
+from ctypes import addressof, memmove, sizeof
+
+from .bootimg import (
+    AvbFooter,
+    AvbVBMetaImageHeader,
+    BootImgHdrPxa,
+    BootImgHdrV0,
+    BootImgHdrV1,
+    BootImgHdrV2,
+    BootImgHdrV3,
+    BootImgHdrV4,
+    BootImgHdrVndV3,
+    BootImgHdrVndV4,
+    DhtbHdr,
+    MtkHdr,
+    VendorRamdiskTableEntryV4,
+    align_to
+)
+from .compress import encode
+from .format import (
+    BOOT_MAGIC,
+    DHTB_MAGIC,
+    Format,
+    LG_BUMP_MAGIC,
+    SEANDROID_MAGIC,
+    VENDOR_BOOT_MAGIC
+)
+
+# 生成各种布局的合成 boot 镜像, 用于基准测试和回归测试
+LAYOUTS = ("v0", "v1", "v2", "pxa", "v3", "v4", "vendor_v3", "vendor_v4")
+WRAPPERS = ("mtk", "dhtb", "lg_bump", "seandroid", "avb")
+
+MTK_MAGIC_U32 = 0x58881688
+KERNEL_MARKERS = b"skip_initramfs\x00want_initramfs\x00androidboot.selinux\x00"
+
+def payload(size: int, seed: int = 0):
+    # 一半随机, 一半重复文本, 压缩率接近真实 kernel
+    rnd = random.Random(seed)
+    half = size // 2
+    text = (b"Linux version 4.19.157 (build@host) " + KERNEL_MARKERS) * 8
+    body = (text * (half // len(text) + 1))[:half]
+    return rnd.randbytes(size - half) + body
+
+def cpio_newc(files):
+    # files: [(name, mode, data), ...]
+    out = bytearray()
+    entries = list(files) + [("TRAILER!!!", 0, b"")]
+    for ino, (name, mode, data) in enumerate(entries, 300000):
+        name = name.encode() + b"\0"
+        out += b"070701" + b"".join(b"%08x" % v for v in (
+            ino if mode else 0, mode, 0, 0, 1, 0, len(data), 0, 0, 0, 0, len(name), 0))
+        out += name
+        out += b"\0" * ((-len(out)) % 4)
+        out += data
+        out += b"\0" * ((-len(out)) % 4)
+    return bytes(out)
+
+def ramdisk_cpio(size: int, seed: int = 0):
+    files = [
+        ("init", 0o100750, payload(max(size // 2, 16), seed + 1)),
+        ("system", 0o40755, b""),
+        ("system/etc", 0o40755, b""),
+        ("system/etc/init.rc", 0o100644, b"on early-init\n    start ueventd\n" * max(size // 64, 1)),
+        ("fstab.qcom", 0o100644, b"/dev/block/by-name/system /system ext4 ro wait,avb,verify\n"),
+        ("sbin", 0o120777, b"/system/bin"),
+    ]
+    return cpio_newc(files)
+
+def _fdt_node(name: str, props: dict, strings: bytearray):
+    out = struct.pack(">I", 1) + name.encode() + b"\0"
+    out += b"\0" * ((-len(out)) % 4)
+    children = []
+    for k, v in props.items():
+        if isinstance(v, dict):
+            children.append((k, v))
+            continue
+        off = strings.find(k.encode() + b"\0")
+        if off < 0:
+            off = len(strings)
+            strings += k.encode() + b"\0"
+        out += struct.pack(">III", 3, len(v), off) + v
+        out += b"\0" * ((-len(out)) % 4)
+    for k, v in children:
+        out += _fdt_node(k, v, strings)
+    return out + struct.pack(">I", 2)
+
+def make_dtb(tree: dict = None):
+    # 最小的合法 FDT (version 17), 根节点的属性与子节点由 tree 描述
+    if tree is None:
+        tree = {
+            "compatible": b"qcom,synthetic\0",
+            "chosen": {"bootargs": b"console=ttyMSM0 skip_initramfs\0"},
+            "firmware": {"android": {"fstab": {
+                "system": {"dev": b"/dev/block/by-name/system\0", "fsmgr_flags": b"wait,slotselect,avb\0"},
+                "vendor": {"dev": b"/dev/block/by-name/vendor\0", "fsmgr_flags": b"wait,verify\0"},
+            }}},
+        }
+    strings = bytearray()
+    dt_struct = _fdt_node("", tree, strings) + struct.pack(">I", 9)
+    off_rsvmap = 40
+    off_struct = off_rsvmap + 16
+    off_strings = off_struct + len(dt_struct)
+    total = off_strings + len(strings)
+    hdr = struct.pack(">10I", 0xd00dfeed, total, off_struct, off_strings, off_rsvmap,
+                      17, 16, 0, len(strings), len(dt_struct))
+    return hdr + bytes(16) + dt_struct + bytes(strings)
+
+def _compress(data: bytes, codec: Format):
+    if codec in (None, Format.UNKNOWN):
+        return data
+    return b"".join(encode(codec, [data]))
+
+def _mtk(data: bytes, name: bytes):
+    hdr = MtkHdr()
+    hdr.magic = MTK_MAGIC_U32
+    hdr.size = len(data)
+    hdr.name = name
+    hdr.padding = b"\xff" * 472
+    return bytes(hdr) + data
+
+def _os_version(version=(13, 0, 0), patch=(2023, 5)):
+    a, b, c = version
+    return (((a << 14) | (b << 7) | c) << 11) | ((patch[0] - 2000) << 4) | patch[1]
+
+def _pad(data: bytes, page: int):
+    return data + b"\0" * ((-len(data)) % page)
+
+def _boot_id(blocks, ver: int):
+    ctx = hashlib.sha1()
+    for i, block in enumerate(blocks):
+        name = ("kernel", "ramdisk", "second", "extra", "recovery_dtbo", "dtb")[i]
+        if name == "extra" and not block:
+            continue
+        if name == "recovery_dtbo" and ver not in (1, 2):
+            continue
+        if name == "dtb" and ver != 2:
+            continue
+        ctx.update(block)
+        ctx.update(struct.pack("<I", len(block)))
+    return ctx.digest()
+
+def _set_id(hdr, digest: bytes):
+    # c_char 数组赋值会在 NUL 处截断, 摘要需要按原始字节写入
+    memmove(addressof(hdr) + type(hdr).id.offset, digest, len(digest))
+
+def build_image(layout: str = "v2", kernel_size: int = 0x100000, ramdisk_size: int = 0x80000,
+                codec: Format = Format.GZIP, ramdisk_codec: Format = None, wrappers=(),
+                page_size: int = 2048, fragments: int = 3, seed: int = 0):
+    # 返回镜像内容 (bytes)
+    ramdisk_codec = codec if ramdisk_codec is None else ramdisk_codec
+    kernel = _compress(payload(kernel_size, seed), codec) if kernel_size else b""
+    ramdisk = _compress(ramdisk_cpio(ramdisk_size, seed), ramdisk_codec) if ramdisk_size else b""
+    if "mtk" in wrappers:
+        kernel = _mtk(kernel, b"KERNEL")
+        ramdisk = _mtk(ramdisk, b"ROOTFS")
+    second = payload(0x1000, seed + 2) if layout in ("v0", "v1", "v2", "pxa") else b""
+    recovery_dtbo = payload(0x800, seed + 3) if layout in ("v1", "v2") else b""
+    dtb = make_dtb() if layout in ("v2", "vendor_v3", "vendor_v4") else b""
+    cmdline = b"console=ttyMSM0,115200n8 androidboot.hardware=qcom buildvariant=user"
+
+    if layout in ("v0", "v1", "v2"):
+        ver = int(layout[1])
+        hdr = (BootImgHdrV0, BootImgHdrV1, BootImgHdrV2)[ver]()
+        v0 = hdr if ver == 0 else (hdr.v0 if ver == 1 else hdr.v1.v0)
+        v0.base.magic = BOOT_MAGIC
+        v0.base.kernel_size, v0.base.ramdisk_size, v0.base.second_size = len(kernel), len(ramdisk), len(second)
+        v0.base.kernel_addr, v0.base.ramdisk_addr, v0.base.second_addr = 0x10008000, 0x11000000, 0x10f00000
+        v0.tags_addr = 0x10000100
+        v0.u1.page_size = page_size
+        v0.u2.header_version = ver
+        v0.os_version = _os_version()
+        v0.name = b"synthetic"
+        v0.cmdline = cmdline
+        blocks = [kernel, ramdisk, second, b"", recovery_dtbo, dtb]
+        _set_id(v0, _boot_id(blocks, ver))
+        if ver >= 1:
+            v1 = hdr if ver == 1 else hdr.v1
+            v1.recovery_dtbo_size = len(recovery_dtbo)
+            v1.header_size = sizeof(hdr)
+            # 与 magiskboot repack 一致, 记录的是文件中的绝对偏移
+            v1.recovery_dtbo_offset = (sizeof(DhtbHdr) if "dhtb" in wrappers else 0) + page_size * (1 + sum(len(_pad(b, page_size)) // page_size for b in blocks[:3]))
+        if ver == 2:
+            hdr.dtb_size = len(dtb)
+            hdr.dtb_addr = 0x11f00000
+        img = _pad(bytes(hdr), page_size) + b"".join(_pad(b, page_size) for b in blocks if b)
+    elif layout == "pxa":
+        hdr = BootImgHdrPxa()
+        hdr.base.magic = BOOT_MAGIC
+        hdr.base.kernel_size, hdr.base.ramdisk_size, hdr.base.second_size = len(kernel), len(ramdisk), len(second)
+        hdr.unknown = 0x02000000
+        hdr.page_size = page_size
+        hdr.name = b"pxa"
+        hdr.cmdline = cmdline
+        _set_id(hdr, _boot_id([kernel, ramdisk, second], 0))
+        img = _pad(bytes(hdr), page_size) + b"".join(_pad(b, page_size) for b in (kernel, ramdisk, second) if b)
+    elif layout in ("v3", "v4"):
+        hdr = BootImgHdrV3() if layout == "v3" else BootImgHdrV4()
+        v3 = hdr if layout == "v3" else hdr.v3
+        v3.magic[:] = list(BOOT_MAGIC)
+        v3.kernel_size, v3.ramdisk_size = len(kernel), len(ramdisk)
+        v3.os_version = _os_version()
+        v3.header_size = sizeof(hdr)
+        v3.header_version = int(layout[1])
+        v3.cmdline = cmdline
+        signature = b""
+        if layout == "v4":
+            signature = payload(0x1000, seed + 4)
+            hdr.signature_size = len(signature)
+        img = _pad(bytes(hdr), 4096) + b"".join(_pad(b, 4096) for b in (kernel, ramdisk, signature) if b)
+    elif layout in ("vendor_v3", "vendor_v4"):
+        hdr = BootImgHdrVndV3() if layout == "vendor_v3" else BootImgHdrVndV4()
+        v3 = hdr if layout == "vendor_v3" else hdr.v3
+        v3.magic[:] = list(VENDOR_BOOT_MAGIC)
+        v3.header_version = 3 if layout == "vendor_v3" else 4
+        v3.page_size = 4096
+        v3.kernel_addr, v3.ramdisk_addr, v3.tags_addr = 0x10008000, 0x11000000, 0x10000100
+        v3.cmdline = cmdline
+        v3.name = b"synthetic"
+        v3.header_size = sizeof(hdr)
+        v3.dtb_size = len(dtb)
+        v3.dtb_addr = 0x11f00000
+        table = b""
+        bootconfig = b""
+        if layout == "vendor_v4":
+            # 多个独立压缩的 vendor ramdisk 片段, 外加 ramdisk 表和 bootconfig
+            parts = [_compress(ramdisk_cpio(ramdisk_size // fragments, seed + 10 + i), ramdisk_codec)
+                     for i in range(fragments)]
+            entries = b""
+            off = 0
+            for i, part in enumerate(parts):
+                entry = VendorRamdiskTableEntryV4()
+                entry.ramdisk_size = len(part)
+                entry.ramdisk_offset = off
+                entry.ramdisk_type = 1 if i == 0 else 3
+                name = b"" if i == 0 else b"dlkm_%d" % i
+                entry.ramdisk_name[:len(name)] = list(name)
+                entries += bytes(entry)
+                off += len(part)
+            ramdisk = b"".join(parts)
+            table = entries
+            bootconfig = b"androidboot.hardware=qcom\nandroidboot.serialno=0123456789\n"
+            hdr.vendor_ramdisk_table_size = len(table)
+            hdr.vendor_ramdisk_table_entry_num = len(parts)
+            hdr.vendor_ramdisk_table_entry_size = sizeof(VendorRamdiskTableEntryV4)
+            hdr.bootconfig_size = len(bootconfig)
+        v3.ramdisk_size = len(ramdisk)
+        img = _pad(bytes(hdr), 4096) + b"".join(_pad(b, 4096) for b in (ramdisk, dtb, table, bootconfig) if b)
+    else:
+        raise ValueError("Unknown layout [%s]" % layout)
+
+    # 尾部标记之后同样按页对齐, 与 magiskboot repack 的输出一致
+    page = page_size if layout in ("v0", "v1", "v2", "pxa") else 4096
+    # total 为尾部标记之后、对齐之前的大小, 即 repack 写入 AVB footer 的 original_image_size
+    total = len(img)
+    if "dhtb" in wrappers:
+        img += SEANDROID_MAGIC + b"\xff" * 4
+        dhtb = DhtbHdr()
+        dhtb.magic = DHTB_MAGIC
+        dhtb.size = len(img)
+        dhtb.checksum[:32] = hashlib.sha256(img).digest()
+        total = sizeof(dhtb) + len(img)
+        img = bytes(dhtb) + _pad(img, page)
+    elif "seandroid" in wrappers:
+        total = len(img) + len(SEANDROID_MAGIC)
+        img = _pad(img + SEANDROID_MAGIC, page)
+    elif "lg_bump" in wrappers:
+        total = len(img) + len(LG_BUMP_MAGIC)
+        img = _pad(img + LG_BUMP_MAGIC, page)
+    if "avb" in wrappers:
+        # vbmeta_offset 与 BootImage 的解析一致, 相对于启动头 (DHTB 之后) 而不是文件开头
+        hdr_addr = sizeof(DhtbHdr) if "dhtb" in wrappers else 0
+        img = add_avb_footer(img, align_to(len(img) + 0x10000, 0x10000), hdr_addr=hdr_addr,
+                             original_size=total)
+    return img
+
+def add_avb_footer(img: bytes, partition_size: int, partition_name: bytes = b"boot", seed: int = 0,
+                   hdr_addr: int = 0, original_size: int = 0):
+    # 未签名 (algorithm NONE) 的 vbmeta + 单个 hash 描述符, 结构与 avbtool add_hash_footer 相同
+    # hdr_addr 为启动头在镜像中的偏移 (DHTB 等前置头的大小), vbmeta_offset 相对于它
+    # original_size 为 footer 中记录的原始大小, 默认 len(img)
+    from .avb import AvbHashDescriptor
+    salt = random.Random(seed).randbytes(32)
+    digest = hashlib.sha256(salt + img).digest()
+    desc = AvbHashDescriptor()
+    desc.parent_descriptor.tag = 2
+    body = sizeof(desc) - 16 + len(partition_name) + len(salt) + len(digest)
+    body += (-body) % 8
+    desc.parent_descriptor.num_bytes_following = body
+    desc.image_size = len(img)
+    desc.hash_algorithm[:6] = list(b"sha256")
+    desc.partition_name_len, desc.salt_len, desc.digest_len = len(partition_name), len(salt), len(digest)
+    aux = bytes(desc) + partition_name + salt + digest
+    aux += b"\0" * ((-len(aux)) % 64)
+
+    vbmeta = AvbVBMetaImageHeader()
+    vbmeta.magic[:] = list(b"AVB0")
+    vbmeta.required_libavb_version_major = 1
+    vbmeta.auxiliary_data_block_size = len(aux)
+    vbmeta.descriptors_size = len(aux)
+    vbmeta.release_string[:13] = list(b"avbtool 1.2.0")
+    vbmeta = bytes(vbmeta) + aux
+
+    out = _pad(img, 4096)
+    vbmeta_offset = len(out) - hdr_addr
+    out += vbmeta
+    footer = AvbFooter()
+    footer.magic[:] = list(b"AVBf")
+    footer.version_major = 1
+    footer.original_image_size = original_size or len(img)
+    footer.vbmeta_offset = vbmeta_offset
+    footer.vbmeta_size = len(vbmeta)
+    out += b"\0" * (partition_size - len(out) - sizeof(AvbFooter))
+    return out + bytes(footer)
+
+def make_image(path: str, layout: str = "v2", **kwargs):
+    img = build_image(layout, **kwargs)
+    with open(path, 'wb') as f:
+        f.write(img)
+    return len(img)
+
+def make_corpus(directory: str, kernel_size: int = 0x100000, ramdisk_size: int = 0x80000,
+                codecs=(Format.GZIP,), wrappers=((),) + tuple((w,) for w in WRAPPERS)):
+    # 每种布局 x 压缩格式 x 包装组合各生成一个镜像, 返回 [(文件路径, 参数), ...]
+    import os
+    os.makedirs(directory, exist_ok=True)
+    result = []
+    for layout in LAYOUTS:
+        for codec in codecs:
+            for wrap in wrappers:
+                if "mtk" in wrap and layout.startswith("vendor"):
+                    continue
+                name = "%s-%s%s.img" % (layout, codec.name.lower(), "".join("-" + w for w in wrap))
+                path = os.path.join(directory, name)
+                make_image(path, layout, kernel_size=kernel_size, ramdisk_size=ramdisk_size,
+                           codec=codec, wrappers=wrap)
+                result.append((path, {"layout": layout, "codec": codec.name, "wrappers": list(wrap)}))
+    return result
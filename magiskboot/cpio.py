@@ -0,0 +1,464 @@
+import binascii
+import hashlib
+import mmap
+import os
+import stat
+import struct
+
+from . import trace
+from .compress import CHUNK, decode, encode, iter_chunks
+from .format import COMPRESSED, XZ_MAGIC, Format, check_fmt, fmt2name
+
+# newc 格式: "070701" + 13 个 8 位十六进制字段, 名字和数据都按 4 字节对齐
+CPIO_MAGIC = (b"070701", b"070702")
+CPIO_HDR_SZ = 110
+CPIO_TRAILER = "TRAILER!!!"
+# backup 写入的目录: 被修改 / 删除条目的原始内容, 以及 .rmlist (新增条目名, 以 NUL 分隔)
+BACKUP_DIR = ".backup"
+BACKUP_RMLIST = ".backup/.rmlist"
+_NEWC = struct.Struct(">13I")
+
+def norm_path(path: str):
+    # "/system//etc/" -> "system/etc"
+    return "/".join(p for p in path.split("/") if p and p != ".")
+
+def _encode_name(name: str):
+    return name.encode("utf-8", "surrogateescape")
+
+def _newc_hdr(ino: int, mode: int, uid: int, gid: int, size: int,
+              rdevmajor: int, rdevminor: int, name: bytes):
+    # nlink 固定为 1, mtime / devmajor / devminor / check 为 0 (与 magiskboot 一致)
+    hdr = b"070701%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x" % (
+        ino, mode, uid, gid, 1, 0, size, 0, 0, rdevmajor, rdevminor, len(name) + 1, 0)
+    return hdr + name + b"\0" * (1 + (-(CPIO_HDR_SZ + len(name) + 1)) % 4)
+
+class CpioEntry:
+    # data 为源映射上的 memoryview 切片 (未修改的条目不复制) 或 bytes (新增 / 修改的条目)
+    # offset 是数据在源档案中的偏移, 不来自源档案时为 -1
+    # 条目创建后数据不再改变 (修改总是换成新的 CpioEntry), 所以摘要只算一次
+    __slots__ = ("mode", "uid", "gid", "rdevmajor", "rdevminor", "data", "offset", "_digest")
+
+    def __init__(self, mode: int, data=b"", uid: int = 0, gid: int = 0,
+                 rdevmajor: int = 0, rdevminor: int = 0, offset: int = -1):
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.rdevmajor = rdevmajor
+        self.rdevminor = rdevminor
+        self.data = data
+        self.offset = offset
+        self._digest = None
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.data).digest()
+        return self._digest
+
+    def same(self, other):
+        # 先比较元数据和大小, 都相同时才需要计算摘要
+        if (self.mode, self.uid, self.gid, self.rdevmajor, self.rdevminor) != \
+                (other.mode, other.uid, other.gid, other.rdevmajor, other.rdevminor):
+            return False
+        if len(self.data) != len(other.data):
+            return False
+        return self.data is other.data or self.digest == other.digest
+
+class _BufReader:
+    # 映射上的读取: read() 返回 memoryview 切片, 不复制数据
+    def __init__(self, buf):
+        self.view = memoryview(buf)
+        self.pos = 0
+
+    def read(self, n: int):
+        data = self.view[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+    def skip(self, n: int):
+        self.pos = min(self.pos + n, len(self.view))
+
+class _StreamReader:
+    # 管道 / 解码器输出上的顺序读取, 只缓存尚未消费的数据
+    def __init__(self, chunks):
+        self.it = iter(chunks)
+        self.buf = bytearray()
+        self.pos = 0
+
+    def read(self, n: int):
+        while len(self.buf) < n:
+            chunk = next(self.it, None)
+            if chunk is None:
+                break
+            self.buf += chunk
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        self.pos += len(data)
+        return data
+
+    def skip(self, n: int):
+        self.read(n)
+
+class Cpio:
+    # 内存中的条目索引: 名字 -> CpioEntry, 查找为 O(1)
+    # 未改动的条目始终是源映射上的视图, 写出时按名字排序流式生成新档案
+    def __init__(self):
+        self.entries = {}
+        self.map = None
+        self.fmt = Format.UNKNOWN
+
+    @classmethod
+    def load(cls, path: str):
+        # 未压缩的档案直接映射; 压缩的 ramdisk 边解码边建立索引, 写出时默认沿用原格式
+        print("Loading cpio: [%s]" % path)
+        self = cls()
+        with open(path, 'rb') as f:
+            head = f.read(CHUNK)
+            fmt = check_fmt(head, len(head))
+            if COMPRESSED(fmt):
+                self.fmt = fmt
+                with trace.span("cpio_load", path=path, format=fmt2name(fmt)):
+                    self._parse(_StreamReader(decode(fmt, _chain(head, f))))
+                return self
+            if not head:
+                return self
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with trace.span("cpio_load", path=path, bytes_in=self.map.size()):
+            self._parse(_BufReader(self.map))
+        return self
+
+    @classmethod
+    def from_buffer(cls, buf):
+        # buf 为 bytes / mmap / memoryview, 条目数据引用 buf 本身
+        self = cls()
+        self._parse(_BufReader(buf))
+        return self
+
+    @classmethod
+    def from_stream(cls, fp, fmt: Format = Format.UNKNOWN):
+        # 从不可 seek 的流 (管道) 读取; fmt 为压缩格式时先解码
+        self = cls()
+        chunks = iter(lambda: fp.read(CHUNK), b"")
+        if COMPRESSED(fmt):
+            self.fmt = fmt
+            chunks = decode(fmt, chunks)
+        self._parse(_StreamReader(chunks))
+        return self
+
+    def _parse(self, r):
+        entries = self.entries
+        while True:
+            off = r.pos
+            hdr = bytes(r.read(CPIO_HDR_SZ))
+            if len(hdr) < CPIO_HDR_SZ:
+                if not hdr.strip(b"\0"):
+                    # 没有 TRAILER!!! 的档案, 或结尾的 0 填充
+                    break
+                raise ValueError("Truncated cpio header at [0x%x]" % off)
+            if hdr[:6] not in CPIO_MAGIC:
+                raise ValueError("Invalid cpio magic at [0x%x]" % off)
+            (_, mode, uid, gid, _, _, filesize, _, _,
+             rdevmajor, rdevminor, namesize, _) = _NEWC.unpack(binascii.unhexlify(hdr[6:]))
+            name = bytes(r.read(namesize))[:-1].decode("utf-8", "surrogateescape")
+            r.skip((-r.pos) % 4)
+            doff = r.pos
+            data = r.read(filesize)
+            if len(data) < filesize:
+                raise ValueError("Truncated cpio entry [%s]" % name)
+            r.skip((-r.pos) % 4)
+            if name == CPIO_TRAILER:
+                break
+            if name in (".", ".."):
+                continue
+            entries[name] = CpioEntry(mode, data, uid, gid, rdevmajor, rdevminor, doff)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if getattr(self, "map", None) is None:
+            return
+        # 先丢掉指向映射的视图, 否则 mmap.close() 会抛 BufferError
+        self.entries = {}
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+        self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, name: str):
+        return norm_path(name) in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, name: str):
+        return self.entries.get(norm_path(name))
+
+    def exists(self, name: str):
+        return norm_path(name) in self.entries
+
+    def ls(self, path: str = "/", recursive: bool = False):
+        path = norm_path(path)
+        prefix = path + "/" if path else ""
+        for name in sorted(self.entries):
+            if name == path:
+                continue
+            if prefix and not name.startswith(prefix):
+                continue
+            if not recursive and "/" in name[len(prefix):]:
+                continue
+            e = self.entries[name]
+            print("%s %5u %5u %10u %s" % (stat.filemode(e.mode), e.uid, e.gid, e.size, name))
+
+    def rm(self, name: str, recursive: bool = False):
+        name = norm_path(name)
+        if self.entries.pop(name, None) is not None:
+            print("Removed entry [%s]" % name)
+        if recursive:
+            prefix = name + "/"
+            for sub in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[sub]
+                print("Removed entry [%s]" % sub)
+
+    def mkdir(self, mode: int, name: str):
+        name = norm_path(name)
+        self.entries[name] = CpioEntry(stat.S_IFDIR | mode)
+        print("Create directory [%s] (%04o)" % (name, mode))
+
+    def ln(self, target: str, name: str):
+        name = norm_path(name)
+        self.entries[name] = CpioEntry(stat.S_IFLNK | 0o777, _encode_name(target))
+        print("Create symlink [%s] -> [%s]" % (name, target))
+
+    def add(self, mode: int, name: str, file):
+        # file 为路径或 bytes; 已存在的同名条目会被替换
+        name = norm_path(name)
+        if isinstance(file, (bytes, bytearray, memoryview)):
+            data = bytes(file)
+        else:
+            if os.path.isdir(file):
+                raise ValueError("Cannot add directory [%s] as entry" % file)
+            with open(file, 'rb') as f:
+                data = f.read()
+        self.entries[name] = CpioEntry(stat.S_IFREG | mode, data)
+        print("Add entry [%s] (%04o)" % (name, mode))
+
+    def mv(self, src: str, dst: str):
+        src, dst = norm_path(src), norm_path(dst)
+        entry = self.entries.pop(src, None)
+        if entry is None:
+            raise ValueError("No such entry [%s]" % src)
+        self.entries[dst] = entry
+        print("Move [%s] -> [%s]" % (src, dst))
+
+    def _extract_entry(self, name: str, out: str):
+        e = self.entries[name]
+        print("Extract [%s] to [%s]" % (name, out))
+        parent = os.path.dirname(out)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        if stat.S_ISDIR(e.mode):
+            os.makedirs(out, exist_ok=True)
+            os.chmod(out, stat.S_IMODE(e.mode))
+            return
+        if os.path.lexists(out) and not os.path.isdir(out):
+            os.remove(out)
+        if stat.S_ISREG(e.mode):
+            with open(out, 'wb') as f:
+                f.write(e.data)
+            os.chmod(out, stat.S_IMODE(e.mode))
+        elif stat.S_ISLNK(e.mode):
+            os.symlink(bytes(e.data).decode("utf-8", "surrogateescape"), out)
+        else:
+            try:
+                os.mknod(out, e.mode, os.makedev(e.rdevmajor, e.rdevminor))
+            except (AttributeError, PermissionError):
+                print("Skip special file [%s]" % name)
+
+    def extract(self, name: str = None, out: str = None):
+        # 不带参数时把全部条目解到当前目录 (或 out 目录); 否则只解出一个条目
+        if name is None:
+            with trace.span("cpio_extract", entries=len(self.entries)):
+                # 按名字排序, 目录总在其内容之前
+                for n in sorted(self.entries):
+                    self._extract_entry(n, os.path.join(out, n) if out else n)
+            return
+        name = norm_path(name)
+        if name not in self.entries:
+            raise ValueError("No such entry [%s]" % name)
+        self._extract_entry(name, out or name)
+
+    def diff(self, orig):
+        # 与原始档案 orig 比较, 返回排序后的 {"add": [...], "modify": [...], "remove": [...]}
+        # 两边的 .backup 都不参与比较
+        add, modify = [], []
+        with trace.span("cpio_diff", entries=len(self.entries)):
+            for name, e in self.entries.items():
+                if _is_backup(name):
+                    continue
+                o = orig.entries.get(name)
+                if o is None:
+                    add.append(name)
+                elif not e.same(o):
+                    modify.append(name)
+            remove = [n for n in orig.entries if n not in self.entries and not _is_backup(n)]
+        return {"add": sorted(add), "modify": sorted(modify), "remove": sorted(remove)}
+
+    def backup(self, orig, compress: bool = True):
+        # 把相对 orig 的改动记录到 .backup 中, restore() 可以只凭索引还原出 orig
+        # 修改 / 删除的条目保存原始内容 (compress 时普通文件用 xz 压缩, 名字加 .xz), 新增的只记名字
+        if isinstance(orig, str):
+            orig = Cpio.load(orig)
+        self.rm(BACKUP_DIR, True)
+        changes = self.diff(orig)
+        with trace.span("cpio_backup") as sp:
+            backups = {BACKUP_DIR: CpioEntry(stat.S_IFDIR)}
+            for name in changes["modify"] + changes["remove"]:
+                e = orig.entries[name]
+                data = e.data
+                bname = BACKUP_DIR + "/" + name
+                if compress and stat.S_ISREG(e.mode) and data:
+                    data = b"".join(encode(Format.XZ, iter_chunks(data)))
+                    bname += ".xz"
+                backups[bname] = CpioEntry(e.mode, data, e.uid, e.gid, e.rdevmajor, e.rdevminor)
+                sp.add("bytes_out", len(data))
+                print("Backup [%s] -> [%s]" % (name, bname))
+            if changes["add"]:
+                for name in changes["add"]:
+                    print("Record new entry: [%s] -> [%s]" % (name, BACKUP_RMLIST))
+                rmlist = b"".join(_encode_name(n) + b"\0" for n in changes["add"])
+                backups[BACKUP_RMLIST] = CpioEntry(stat.S_IFREG, rmlist)
+            self.entries.update(backups)
+        return changes
+
+    def restore(self):
+        # 回放 .backup: 删除 .rmlist 中的新增条目, 把保存的原始条目移回原位
+        if BACKUP_DIR not in self.entries:
+            raise ValueError("No backup found in cpio")
+        with trace.span("cpio_restore"):
+            rmlist = self.entries.pop(BACKUP_RMLIST, None)
+            if rmlist is not None:
+                for name in bytes(rmlist.data).split(b"\0"):
+                    if name:
+                        self.rm(name.decode("utf-8", "surrogateescape"))
+            del self.entries[BACKUP_DIR]
+            prefix = BACKUP_DIR + "/"
+            for bname in sorted(k for k in self.entries if k.startswith(prefix)):
+                e = self.entries.pop(bname)
+                name = bname[len(prefix):]
+                if name.endswith(".xz") and bytes(e.data[:len(XZ_MAGIC)]) == XZ_MAGIC:
+                    name = name[:-3]
+                    data = b"".join(decode(Format.XZ, iter_chunks(e.data)))
+                    e = CpioEntry(e.mode, data, e.uid, e.gid, e.rdevmajor, e.rdevminor)
+                self.entries[name] = e
+                print("Restore [%s] -> [%s]" % (bname, name))
+
+    def iter_chunks(self):
+        # 生成 newc 档案; 小条目合并成一块, 大的数据直接产出源映射上的视图
+        buf = bytearray()
+        for ino, name in enumerate(sorted(self.entries), 300000):
+            e = self.entries[name]
+            size = len(e.data)
+            buf += _newc_hdr(ino, e.mode, e.uid, e.gid, size,
+                             e.rdevmajor, e.rdevminor, _encode_name(name))
+            if size >= CHUNK:
+                yield bytes(buf)
+                buf.clear()
+                yield e.data
+            else:
+                buf += e.data
+            buf += b"\0" * ((-size) % 4)
+            if len(buf) >= CHUNK:
+                yield bytes(buf)
+                buf.clear()
+        buf += _newc_hdr(0, 0, 0, 0, 0, 0, 0, CPIO_TRAILER.encode())
+        yield bytes(buf)
+
+    def encode(self, fmt: Format = None, workers: int = 1):
+        # 直接接到 ramdisk 编码器上, fmt 为 None 时沿用载入时的格式
+        if fmt is None:
+            fmt = self.fmt
+        if not COMPRESSED(fmt):
+            return self.iter_chunks()
+        return encode(fmt, self.iter_chunks(), workers)
+
+    def dump(self, path: str, fmt: Format = None, workers: int = 1):
+        # 先写临时文件再替换, 输出路径可以就是正在映射的源档案
+        print("Dumping cpio: [%s]" % path)
+        tmp = path + ".tmp"
+        with trace.span("cpio_dump", path=path, entries=len(self.entries)) as sp:
+            with open(tmp, 'wb') as f:
+                for chunk in self.encode(fmt, workers):
+                    f.write(chunk)
+                sp.add("bytes_out", f.tell())
+            os.replace(tmp, path)
+
+def _is_backup(name: str):
+    return name == BACKUP_DIR or name.startswith(BACKUP_DIR + "/")
+
+def _chain(head: bytes, f):
+    yield head
+    yield from iter(lambda: f.read(CHUNK), b"")
+
+def _parse_mode(s: str):
+    try:
+        return int(s, 8)
+    except ValueError:
+        raise ValueError("Invalid mode [%s]" % s) from None
+
+def cpio_commands(incpio: str, cmds):
+    # magiskboot cpio <incpio> [commands...]; 每个命令是一个参数, 例如 "add 0750 init magiskinit"
+    # 返回退出码; 有修改时写回 incpio (保持原压缩格式)
+    if os.path.exists(incpio):
+        cpio = Cpio.load(incpio)
+    else:
+        cpio = Cpio()
+    dirty = False
+    with cpio:
+        for cmd in cmds:
+            argv = cmd.split()
+            if not argv:
+                continue
+            op, args = argv[0], argv[1:]
+            recursive = bool(args) and args[0] == "-r"
+            if recursive:
+                args = args[1:]
+            if op == "exists" and len(args) == 1:
+                return 0 if cpio.exists(args[0]) else 1
+            elif op == "ls" and len(args) <= 1:
+                cpio.ls(args[0] if args else "/", recursive)
+                return 0
+            elif op == "extract" and len(args) in (0, 2):
+                cpio.extract(*args)
+                return 0
+            elif op == "rm" and len(args) == 1:
+                cpio.rm(args[0], recursive)
+            elif op == "mkdir" and len(args) == 2:
+                cpio.mkdir(_parse_mode(args[0]), args[1])
+            elif op == "ln" and len(args) == 2:
+                cpio.ln(args[0], args[1])
+            elif op == "mv" and len(args) == 2:
+                cpio.mv(args[0], args[1])
+            elif op == "add" and len(args) == 3:
+                cpio.add(_parse_mode(args[0]), args[1], args[2])
+            elif op == "backup" and len(args) in (1, 2) and args[1:] in ([], ["-n"]):
+                cpio.backup(args[0], len(args) == 1)
+            elif op == "restore" and not args:
+                cpio.restore()
+            else:
+                raise ValueError("Unknown cpio command [%s]" % cmd)
+            dirty = True
+        if dirty:
+            cpio.dump(incpio)
+    return 0
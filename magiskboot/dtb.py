@@ -0,0 +1,320 @@
+import mmap
+import os
+import struct
+
+from . import trace
+from .format import DTB_MAGIC
+
+# FDT 结构块的 token
+FDT_BEGIN_NODE = 1
+FDT_END_NODE = 2
+FDT_PROP = 3
+FDT_NOP = 4
+FDT_END = 9
+
+_FDT_HDR = struct.Struct(">10I")
+_U32 = struct.Struct(">I")
+_PROP = struct.Struct(">III")
+
+# 从 fsmgr_flags 中去掉的 verity / avb 相关选项 (与 magiskboot 的 patch_verity 一致)
+VERITY_FLAGS = ("verifyatboot", "verify", "avb_keys", "avb", "support_scfs", "fsverity")
+
+def _align4(v: int):
+    return (v + 3) & ~3
+
+class Fdt:
+    # 缓冲区中 base 处的一个 FDT; nodes 为 路径 -> {属性名: (值的绝对偏移, 长度)}
+    # edits 里是无法原地完成的修改, 由 DtbFile 在保存时重建
+    __slots__ = ("buf", "base", "totalsize", "off_struct", "off_strings",
+                 "size_strings", "size_struct", "nodes", "edits")
+
+    def __init__(self, buf, base: int):
+        self.buf = buf
+        self.base = base
+        (magic, self.totalsize, self.off_struct, self.off_strings, _, version, _, _,
+         self.size_strings, self.size_struct) = _FDT_HDR.unpack_from(buf, base)
+        if version < 17:
+            # v16 之前没有 size_dt_struct, 结构块一直延伸到字符串表
+            self.size_struct = self.off_strings - self.off_struct
+        if base + self.totalsize > len(buf):
+            raise ValueError("Truncated dtb at [0x%x]" % base)
+        self.nodes = {}
+        self.edits = {}
+        self._index()
+
+    def _string(self, nameoff: int):
+        start = self.base + self.off_strings + nameoff
+        end = self.buf.find(b"\0", start, self.base + self.off_strings + self.size_strings)
+        return bytes(self.buf[start:end]).decode(errors="replace")
+
+    def _index(self):
+        buf = self.buf
+        pos = self.base + self.off_struct
+        end = pos + self.size_struct
+        path = []
+        props = None
+        while pos < end:
+            tag, = _U32.unpack_from(buf, pos)
+            pos += 4
+            if tag == FDT_BEGIN_NODE:
+                nul = buf.find(b"\0", pos, end)
+                path.append(bytes(buf[pos:nul]).decode(errors="replace"))
+                pos = _align4(nul + 1)
+                props = self.nodes.setdefault("/" + "/".join(path[1:]), {})
+            elif tag == FDT_END_NODE:
+                path.pop()
+                props = self.nodes.get("/" + "/".join(path[1:])) if path else None
+            elif tag == FDT_PROP:
+                size, nameoff = _U32.unpack_from(buf, pos)[0], _U32.unpack_from(buf, pos + 4)[0]
+                pos += 8
+                props[self._string(nameoff)] = (pos, size)
+                pos = _align4(pos + size)
+            elif tag == FDT_NOP:
+                continue
+            elif tag == FDT_END:
+                break
+            else:
+                raise ValueError("Invalid FDT token [%u] at [0x%x]" % (tag, pos - 4))
+
+    def getprop(self, path: str, name: str):
+        if (path, name) in self.edits:
+            return self.edits[(path, name)]
+        prop = self.nodes.get(path, {}).get(name)
+        if prop is None:
+            return None
+        off, size = prop
+        return self.buf[off:off + size]
+
+    def setprop(self, path: str, name: str, value: bytes):
+        # 对齐后长度不变时直接改写映射中的长度和值; 否则记下来, 保存时重建
+        # 返回是否原地完成
+        prop = self.nodes.get(path, {}).get(name)
+        if prop is not None and (path, name) not in self.edits \
+                and _align4(len(value)) == _align4(prop[1]):
+            off, size = prop
+            _U32.pack_into(self.buf, off - 8, len(value))
+            self.buf[off:off + _align4(size)] = value + b"\0" * (_align4(size) - len(value))
+            self.nodes[path][name] = (off, len(value))
+            return True
+        self.edits[(path, name)] = bytes(value)
+        return False
+
+    def rebuild(self):
+        # 重新生成结构块, 新属性名追加到字符串表末尾; 头部到结构块之间 (mem_rsvmap) 原样保留
+        buf = self.buf
+        strings = bytearray(buf[self.base + self.off_strings:self.base + self.off_strings + self.size_strings])
+        names = {}
+
+        def nameoff(name):
+            if name not in names:
+                key = name.encode() + b"\0"
+                off = strings.find(key)
+                # 必须匹配一个完整的字符串, 不能是其它名字的后缀
+                while off > 0 and strings[off - 1] != 0:
+                    off = strings.find(key, off + 1)
+                if off < 0:
+                    off = len(strings)
+                    strings.extend(key)
+                names[name] = off
+            return names[name]
+
+        pending = {}
+        for (path, name), value in self.edits.items():
+            pending.setdefault(path, {})[name] = value
+        out = bytearray()
+        pos = self.base + self.off_struct
+        end = pos + self.size_struct
+        path = []
+        while pos < end:
+            tag, = _U32.unpack_from(buf, pos)
+            start = pos
+            pos += 4
+            if tag == FDT_BEGIN_NODE:
+                nul = buf.find(b"\0", pos, end)
+                path.append(bytes(buf[pos:nul]).decode(errors="replace"))
+                pos = _align4(nul + 1)
+                out += buf[start:pos]
+            elif tag == FDT_END_NODE:
+                # 节点中原本不存在的属性加在节点末尾
+                node = "/" + "/".join(path[1:])
+                for name, value in pending.pop(node, {}).items():
+                    out += _PROP.pack(FDT_PROP, len(value), nameoff(name)) + value
+                    out += b"\0" * ((-len(value)) % 4)
+                path.pop()
+                out += buf[start:pos]
+            elif tag == FDT_PROP:
+                size, off = _U32.unpack_from(buf, pos)[0], _U32.unpack_from(buf, pos + 4)[0]
+                pos = _align4(pos + 8 + size)
+                node = "/" + "/".join(path[1:])
+                name = self._string(off)
+                value = pending.get(node, {}).pop(name, None)
+                if value is None:
+                    out += _PROP.pack(FDT_PROP, size, nameoff(name)) + buf[start + 12:pos]
+                else:
+                    out += _PROP.pack(FDT_PROP, len(value), nameoff(name)) + value
+                    out += b"\0" * ((-len(value)) % 4)
+            elif tag == FDT_NOP:
+                out += buf[start:pos]
+            else:
+                out += buf[start:pos]
+                break
+        if any(pending.values()):
+            raise ValueError("No such node [%s]" % next(k for k, v in pending.items() if v))
+        head = bytearray(buf[self.base:self.base + self.off_struct])
+        off_strings = self.off_struct + len(out)
+        total = off_strings + len(strings)
+        struct.pack_into(">I", head, 4, total)
+        struct.pack_into(">I", head, 12, off_strings)
+        struct.pack_into(">I", head, 32, len(strings))
+        if len(head) >= 40:
+            struct.pack_into(">I", head, 36, len(out))
+        return bytes(head + out + strings)
+
+class DtbFile:
+    # dtb / kernel_dtb 中拼接的所有 FDT, 一次扫描建立索引
+    # write=True 时以读写方式映射文件, 原地修改直接落到文件上, 只改动变化的字节
+    def __init__(self, path: str = None, write: bool = False, buf=None):
+        self.path = path
+        self.map = None
+        if buf is None:
+            with open(path, 'r+b' if write else 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if write else mmap.ACCESS_READ)
+            buf = self.map
+        self.buf = buf
+        self.fdts = []
+        with trace.span("dtb_index", bytes_in=len(buf)) as sp:
+            pos = buf.find(DTB_MAGIC)
+            while pos >= 0:
+                if len(buf) - pos < _FDT_HDR.size:
+                    break
+                try:
+                    fdt = Fdt(buf, pos)
+                except (ValueError, struct.error):
+                    # 偶然出现的魔数, 不是完整的 FDT
+                    pos = buf.find(DTB_MAGIC, pos + 4)
+                    continue
+                self.fdts.append(fdt)
+                pos = buf.find(DTB_MAGIC, pos + max(fdt.totalsize, 4))
+            sp.set("count", len(self.fdts))
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if getattr(self, "map", None) is None:
+            return
+        self.fdts = []
+        self.buf = None
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+        self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def dirty(self):
+        return any(fdt.edits for fdt in self.fdts)
+
+    def rebuild(self):
+        # 拼接所有 FDT, 有待重建修改的重新生成, 其余与 FDT 之间的数据原样复制
+        out = bytearray()
+        pos = 0
+        for fdt in self.fdts:
+            out += self.buf[pos:fdt.base]
+            if fdt.edits:
+                out += fdt.rebuild()
+            else:
+                out += self.buf[fdt.base:fdt.base + fdt.totalsize]
+            pos = fdt.base + fdt.totalsize
+        out += self.buf[pos:]
+        return bytes(out)
+
+    def save(self, path: str = None):
+        # 只有原地修改时映射已经写回, 仅 flush; 否则重建整个文件
+        path = path or self.path
+        if not self.dirty():
+            if self.map is not None and path == self.path:
+                self.map.flush()
+            else:
+                with open(path, 'wb') as f:
+                    f.write(self.buf)
+            return
+        with trace.span("dtb_rebuild", path=path):
+            data = self.rebuild()
+        self.close()
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def print(self, fstab: bool = False):
+        for i, fdt in enumerate(self.fdts):
+            print("Found fdt [%u] at [0x%x] size [%u]" % (i, fdt.base, fdt.totalsize))
+            for path, props in fdt.nodes.items():
+                if fstab and not _is_fstab(path):
+                    continue
+                print("  %s" % path)
+                for name in props:
+                    print("    %s: %s" % (name, _prop_str(fdt.getprop(path, name))))
+
+    def patch(self, keep_verity: bool = False):
+        # 去掉 fstab 中的 verity / avb 选项, 并把 bootargs 中的 skip_initramfs 换成 want_initramfs
+        # 两者长度都不增加, 全部原地完成
+        patched = False
+        with trace.span("dtb_patch", fdts=len(self.fdts)):
+            for i, fdt in enumerate(self.fdts):
+                for path, props in fdt.nodes.items():
+                    if not keep_verity and _is_fstab(path) and "fsmgr_flags" in props:
+                        value = bytes(fdt.getprop(path, "fsmgr_flags"))
+                        new = patch_verity(value)
+                        if new != value:
+                            print("Patch fdt [%u] [%s] fsmgr_flags [%s] -> [%s]" % (
+                                i, path, value.rstrip(b"\0").decode(errors="replace"),
+                                new.rstrip(b"\0").decode(errors="replace")))
+                            fdt.setprop(path, "fsmgr_flags", new)
+                            patched = True
+                    if path == "/chosen" and "bootargs" in props:
+                        value = bytes(fdt.getprop(path, "bootargs"))
+                        if b"skip_initramfs" in value:
+                            print("Patch fdt [%u] [skip_initramfs] -> [want_initramfs]" % i)
+                            fdt.setprop(path, "bootargs", value.replace(b"skip_initramfs", b"want_initramfs"))
+                            patched = True
+        return patched
+
+def _is_fstab(path: str):
+    # /firmware/android/fstab/<partition>
+    parent = path.rsplit("/", 1)[0]
+    return parent.rsplit("/", 1)[-1] == "fstab"
+
+def _prop_str(value):
+    value = bytes(value)
+    text = value.rstrip(b"\0")
+    if text and all(0x20 <= c < 0x7f or c == 0 for c in text):
+        return "[%s]" % text.replace(b"\0", b", ").decode()
+    return "<%s>" % value.hex()
+
+def patch_verity(value: bytes):
+    # "wait,slotselect,avb\0" -> "wait,slotselect\0\0\0\0\0", 长度不变, 末尾补 0
+    flags = value.rstrip(b"\0").split(b",")
+    keep = [f for f in flags if f.split(b"=", 1)[0].decode(errors="replace") not in VERITY_FLAGS]
+    new = b",".join(keep)
+    return new + b"\0" * (len(value) - len(new))
+
+def dtb_commands(path: str, action: str, args):
+    # magiskboot dtb <file> <action> [args...]
+    if action == "print":
+        with DtbFile(path) as dtb:
+            dtb.print(args == ["-f"])
+        return 0
+    if action == "patch":
+        keep_verity = os.environ.get("KEEPVERITY", "false").lower() == "true"
+        dtb = DtbFile(path, write=True)
+        with dtb:
+            if not dtb.patch(keep_verity):
+                return 1
+            dtb.save()
+        return 0
+    raise ValueError("Unknown dtb action [%s]" % action)
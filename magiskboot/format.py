@@ -1,3 +1,4 @@
+import re
 from enum import Enum , auto
 from mmap import mmap
 
@@ -52,56 +53,80 @@ ZIMAGE_MAGIC = b"\x18\x28\x6f\x01"
 
 # 辅助宏定义
 def COMPRESSED(fmt):
-    return fmt >= Format.GZIP and fmt < Format.LZOP
+    return fmt.value >= Format.GZIP.value and fmt.value < Format.LZOP.value
 
 def COMPRESSED_ANY(fmt):
-    return fmt >= Format.GZIP and fmt <= Format.LZOP
+    return fmt.value >= Format.GZIP.value and fmt.value <= Format.LZOP.value
 
 def BUFFER_MATCH(buf, s):
-    return buf.startswith(s)
+    # buf 可能是 bytes / mmap / memoryview
+    return buf[:len(s)] == s
 
 def BUFFER_CONTAIN(buf, s):
     return s in buf
 
+def _is_lzma(buf, size):
+    return size >= 13 and buf[12] in (0xff, 0x00)
+
+# check_fmt 的分发表: 以首字节为键, 每项为 (magic, format, 额外检查)
+# 顺序与原先的 if/elif 链一致
+_FMT_CHECKS = (
+    (CHROMEOS_MAGIC, Format.CHROMEOS, None),
+    (BOOT_MAGIC, Format.AOSP, None),
+    (VENDOR_BOOT_MAGIC, Format.AOSP_VENDOR, None),
+    (GZIP1_MAGIC, Format.GZIP, None),
+    (GZIP2_MAGIC, Format.GZIP, None),
+    (LZOP_MAGIC, Format.LZOP, None),
+    (XZ_MAGIC, Format.XZ, None),
+    (b"\x5d\x00\x00", Format.LZMA, _is_lzma),
+    (BZIP_MAGIC, Format.BZIP2, None),
+    (LZ41_MAGIC, Format.LZ4, None),
+    (LZ42_MAGIC, Format.LZ4, None),
+    (LZ4_LEG_MAGIC, Format.LZ4_LEGACY, None),
+    (MTK_MAGIC, Format.MTK, None),
+    (DTB_MAGIC, Format.DTB, None),
+    (DHTB_MAGIC, Format.DHTB, None),
+    (TEGRABLOB_MAGIC, Format.BLOB, None),
+)
+
+_FMT_TABLE = {}
+for _check in _FMT_CHECKS:
+    _FMT_TABLE.setdefault(_check[0][0], []).append(_check)
+_FMT_TABLE = {k: tuple(v) for k, v in _FMT_TABLE.items()}
+del _check
+
 def check_fmt(buf, size: int):
-    def CHECKED_MATCH(s):
-        return (size >= (len(s)) and BUFFER_MATCH(buf, s))
-    def memcmp(buf, buf2, length):
-        return buf[:length] == buf2[:length]
-
-    if (CHECKED_MATCH(CHROMEOS_MAGIC)):
-        return Format.CHROMEOS
-    elif (CHECKED_MATCH(BOOT_MAGIC)):
-        return Format.AOSP
-    elif (CHECKED_MATCH(VENDOR_BOOT_MAGIC)):
-        return Format.AOSP_VENDOR
-    elif (CHECKED_MATCH(GZIP1_MAGIC) or CHECKED_MATCH(GZIP2_MAGIC)):
-        return Format.GZIP
-    elif (CHECKED_MATCH(LZOP_MAGIC)):
-        return Format.LZOP
-    elif (CHECKED_MATCH(XZ_MAGIC)):
-        return Format.XZ
-    elif (size >= 13 and memcmp(buf, b"\x5d\x00\x00", 3) == 0
-            and (buf[12] == '\xff' or buf[12] == '\x00')):
-        return Format.LZMA
-    elif (CHECKED_MATCH(BZIP_MAGIC)):
-        return Format.BZIP2
-    elif (CHECKED_MATCH(LZ41_MAGIC) or CHECKED_MATCH(LZ42_MAGIC)):
-        return Format.LZ4
-    elif (CHECKED_MATCH(LZ4_LEG_MAGIC)):
-        return Format.LZ4_LEGACY
-    elif (CHECKED_MATCH(MTK_MAGIC)):
-        return Format.MTK
-    elif (CHECKED_MATCH(DTB_MAGIC)):
-        return Format.DTB
-    elif (CHECKED_MATCH(DHTB_MAGIC)):
-        return Format.DHTB
-    elif (CHECKED_MATCH(TEGRABLOB_MAGIC)):
-        return Format.BLOB_FMT
-    elif (size >= 0x28 and memcmp(buf[0x24:], ZIMAGE_MAGIC, 4) == 0):
+    # 按首字节查表, 通常只需比较一个 magic
+    if size > 0:
+        for magic, fmt, extra in _FMT_TABLE.get(buf[0], ()):
+            if (size >= len(magic) and BUFFER_MATCH(buf, magic)
+                    and (extra is None or extra(buf, size))):
+                return fmt
+    if size >= 0x28 and buf[0x24:0x28] == ZIMAGE_MAGIC:
         return Format.ZIMAGE
-    else:
-        return Format.UNKNOWN
+    return Format.UNKNOWN
+
+# scan_fmt 识别的内嵌 magic
+SCAN_MAGICS = {
+    GZIP1_MAGIC + b"\x08": "gzip",
+    XZ_MAGIC: "xz",
+    LZ41_MAGIC: "lz4",
+    LZ42_MAGIC: "lz4",
+    LZ4_LEG_MAGIC: "lz4_legacy",
+    DTB_MAGIC: "dtb",
+    AVB_MAGIC: "avb",
+    AVB_FOOTER_MAGIC: "avb_footer",
+    SEANDROID_MAGIC: "seandroid",
+    LG_BUMP_MAGIC: "lg_bump",
+}
+
+_SCAN_RE = re.compile(b"|".join(re.escape(m) for m in sorted(SCAN_MAGICS, key=len, reverse=True)))
+
+def scan_fmt(buf, start: int = 0, end: int = -1):
+    # 一次线性扫描找出所有内嵌 magic, 返回 [(offset, name), ...]
+    if end < 0:
+        end = len(buf)
+    return [(m.start(), SCAN_MAGICS[m.group()]) for m in _SCAN_RE.finditer(buf, start, end)]
 
 def Fmt2Name(fmt: Format):
     match fmt:
@@ -1,30 +1,176 @@
 import binascii
 import mmap
+import os
+import re
+import shutil
+import tempfile
+
+from . import trace
+from .compress import Stream, get_decoder, get_encoder, iter_chunks
+from .bootimg import check_fmt_lg
+from .format import COMPRESSED, Format, fmt2name
 
 # Code Generated by chatgpt 3.5
 def hex2byte(hex_string: str):
     return binascii.unhexlify(hex_string)
 
-def hexpatch(file_path: str, from_hex: str, to_hex: str):
-    patched = 1
+def _compile(patterns):
+    # 多模式匹配: 所有 pattern 合成一个正则, 长的优先, 一次扫描即可
+    return re.compile(b"|".join(re.escape(p) for p in sorted(set(patterns), key=len, reverse=True)))
+
+def hexpatch_buf(buf, patches, dry_run: bool = False):
+    # patches: [(from_hex, to_hex), ...], buf 为可写的 mmap / bytearray
+    # 返回 [(offset, from_hex), ...]
+    table = {}
+    for from_hex, to_hex in patches:
+        table.setdefault(hex2byte(from_hex), (from_hex, hex2byte(to_hex)))
+    if not table:
+        return []
+
+    with trace.span("hexpatch", bytes_in=len(buf), patterns=len(table)) as sp:
+        # 先收集所有匹配再写入, 避免扫描过程中修改缓冲区
+        matches = [(m.start(), m.group()) for m in _compile(table).finditer(buf)]
+        records = []
+        for curr, pattern in matches:
+            from_hex, patch = table[pattern]
+            if not dry_run:
+                buf[curr:curr + len(pattern)] = b'\x00' * len(pattern)
+                buf[curr:curr + len(patch)] = patch
+            records.append((curr, from_hex))
+        sp.set("matches", len(records))
+    return records
+
+def hexpatch_batch(file_path: str, patches, dry_run: bool = False):
+    if dry_run:
+        with open(file_path, 'rb') as file:
+            file_contents = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        with open(file_path, 'r+b') as file:
+            file_contents = mmap.mmap(file.fileno(), 0)
+    with file_contents:
+        return hexpatch_buf(file_contents, patches, dry_run)
+
+class HexPatchStream(Stream):
+    # 在数据流上打补丁: 每块末尾保留 (最长 pattern / patch - 1) 字节与下一块拼接,
+    # 因此跨块边界的匹配也能找到, 比 pattern 长的 patch 也总能完整写入,
+    # 输出与分块方式无关, 内存只与块大小有关
+    def __init__(self, patches, dry_run: bool = False):
+        self.table = {}
+        for from_hex, to_hex in patches:
+            self.table.setdefault(hex2byte(from_hex), (from_hex, hex2byte(to_hex)))
+        self.regex = _compile(self.table) if self.table else None
+        self.keep = max((max(len(p), len(patch)) for p, (_, patch) in self.table.items()), default=1) - 1
+        self.dry_run = dry_run
+        self.buf = bytearray()
+        self.base = 0
+        self.skip = 0
+        self.records = []
+
+    def _scan(self, limit: int):
+        # 只处理起始位置在 limit 之前的匹配
+        pos = self.skip
+        while self.regex is not None:
+            m = self.regex.search(self.buf, pos)
+            if m is None or m.start() >= limit:
+                break
+            curr, pattern = m.start(), m.group()
+            from_hex, patch = self.table[pattern]
+            if not self.dry_run:
+                self.buf[curr:curr + len(pattern)] = b'\x00' * len(pattern)
+                # 只有 finish 时 patch 才可能超出数据末尾, 超出部分丢弃 (与原地修改文件相同, 不改变大小)
+                self.buf[curr:curr + len(patch)] = patch[:len(self.buf) - curr]
+            self.records.append((self.base + curr, from_hex))
+            pos = m.end()
+        return pos
 
-    with open(file_path, 'r+b') as file:
-        file_contents = mmap.mmap(file.fileno(), 0)
+    def feed(self, data):
+        self.buf += data
+        cut = len(self.buf) - self.keep
+        if cut <= 0:
+            return
+        pos = self._scan(cut)
+        out = bytes(self.buf[:cut])
+        del self.buf[:cut]
+        self.base += cut
+        self.skip = max(0, pos - cut)
+        yield out
 
-        pattern = hex2byte(from_hex)
-        patch = hex2byte(to_hex)
+    def finish(self):
+        self._scan(len(self.buf))
+        if self.buf:
+            yield bytes(self.buf)
+        self.base += len(self.buf)
+        self.buf = bytearray()
 
-        end = len(file_contents)
-        curr = 0
+def _patch_stream(src, fmt: Format, patches, dry_run: bool):
+    # 解码 -> 打补丁的数据流, 返回 (解码器, 补丁流, 输出块)
+    decoder = get_decoder(fmt)
+    patcher = HexPatchStream(patches, dry_run)
+    chunks = trace.stream("hexpatch", patcher,
+                          trace.stream("decode", decoder, iter_chunks(src), format=fmt2name(fmt)),
+                          patterns=len(patcher.table))
+    return decoder, patcher, chunks
 
-        while curr < end:
-            curr = file_contents.find(pattern, curr)
-            if curr == -1:
-                return patched
+def _close(m):
+    try:
+        m.close()
+    except BufferError:
+        # 出错时 traceback 仍引用映射上的视图, 由垃圾回收关闭
+        pass
+
+def hexpatch_compressed(file_path: str, patches, dry_run: bool = False):
+    # 用 check_fmt_lg 识别压缩格式 (区分 LZ4_LG), 解码 -> 打补丁 -> 重新编码, 全程流式, 不落地中间文件
+    # 返回的 offset 是解压后数据中的偏移; 未压缩的文件直接走 hexpatch_batch
+    with open(file_path, 'rb') as file:
+        src = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    tmp = None
+    try:
+        fmt = check_fmt_lg(src, len(src))
+        if not COMPRESSED(fmt):
+            _close(src)
+            return hexpatch_batch(file_path, patches, dry_run)
+
+        # 先只解压扫描到第一个匹配: 没有匹配时不重新压缩, dry_run 时扫描全部
+        _, patcher, chunks = _patch_stream(src, fmt, patches, True)
+        for _ in chunks:
+            if patcher.records and not dry_run:
+                break
+        chunks.close()
+        if dry_run or not patcher.records:
+            return patcher.records
+
+        # 临时文件名唯一, 同一文件的并发补丁不会互相覆盖或删除对方的临时文件
+        decoder, patcher, chunks = _patch_stream(src, fmt, patches, False)
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(file_path) + ".", suffix=".tmp",
+                                   dir=os.path.dirname(file_path) or ".")
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in trace.stream("encode", get_encoder(fmt), chunks, format=fmt2name(fmt)):
+                out.write(chunk)
+            # 压缩流之后的数据 (如附加的 dtb) 原样保留
+            tail = getattr(decoder, "unused", b"")
+            if fmt == Format.LZ4_LG and decoder.done:
+                # 原来的总大小字段由编码器重新写入
+                tail = tail[4:]
+            out.write(tail)
+        shutil.copymode(file_path, tmp)
+    except BaseException:
+        if tmp is not None:
+            os.remove(tmp)
+        raise
+    finally:
+        _close(src)
+
+    # 映射关闭之后再替换原文件
+    os.replace(tmp, file_path)
+    return patcher.records
+
+def hexpatch(file_path: str, from_hex: str, to_hex: str, compressed: bool = False):
+    # compressed: 压缩文件先解压再打补丁, 之后按原格式重新压缩, offset 为解压后数据中的偏移
+    patched = 1
+    patch = hexpatch_compressed if compressed else hexpatch_batch
 
-            print(f"Patch @ {curr:08X} [{from_hex}] -> [{to_hex}]")
-            file_contents[curr:curr + len(pattern)] = b'\x00' * len(pattern)
-            file_contents[curr:curr + len(patch)] = patch
-            patched = 0
+    for curr, pattern in patch(file_path, [(from_hex, to_hex)]):
+        print(f"Patch @ {curr:08X} [{from_hex}] -> [{to_hex}]")
+        patched = 0
 
-    return patched
\ No newline at end of file
+    return patched
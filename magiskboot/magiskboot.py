@@ -7,3 +7,6 @@ KER_DTB_FILE = "kernel_dtb"
 RECV_DTBO_FILE = "recovery_dtbo"
 DTB_FILE = "dtb"
 NEW_BOOT = "new-boot.img"
+CHECKSUM_FILE = "checksums"
+VND_RAMDISK_DIR = "vendor_ramdisk"
+TUNE_FILE = "tune.json"
@@ -0,0 +1,420 @@
+import hashlib
+import os
+import struct
+from ctypes import sizeof
+
+from . import trace
+from .bootimg import (
+    AMONET_MICROLOADER_SZ,
+    FDT_BEGIN_NODE,
+    INFO_HEAD_SZ,
+    INFO_PROBE_SZ,
+    PADDING,
+    BlobHdr,
+    BootFlag,
+    BootImage,
+    DhtbHdr,
+    DynImgPxa,
+    DynImgV0,
+    HashedWriter,
+    MtkHdr,
+    VendorRamdiskTableEntryV4,
+    _pread,
+    align_to,
+    hdr_class,
+    pre_header,
+    vendor_ramdisk_file,
+    vendor_ramdisk_name,
+)
+from .compress import CHUNK, LZ4_BLOCK_BOUND, decode
+from .format import (
+    AMONET_MICROLOADER_MAGIC,
+    DTB_MAGIC,
+    LG_BUMP_MAGIC,
+    SEANDROID_MAGIC,
+    COMPRESSED,
+    Format,
+    check_fmt,
+    fmt2name,
+)
+from .magiskboot import *
+
+# 默认的内存上限: 读缓冲, 解压输出以及 lz4 legacy 的块槽位都计入其中
+# 各解压器内部的字典 (xz/lzma 最大 64M) 由格式决定, 不在此限制内
+STREAM_MEM_LIMIT = 0x4000000
+# 查找 kernel_dtb 时候选 fdt 头向前缓存的最大字节数, off_dt_struct 超出的候选视为非法
+DTB_HOLD = 0x10000
+
+class _Reader:
+    # 顺序读取任意可读对象 (文件 / 管道 / socket), 不 seek
+    # buf 只保存已读入但尚未交出的数据, pos 为 buf[0] 在流中的位置
+    def __init__(self, fp, chunk: int):
+        self.fp = fp
+        self.chunk = chunk
+        self.buf = bytearray()
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, n: int):
+        # 尽量让 buf 中有 n 字节, 返回实际可用的字节数
+        while len(self.buf) < n and not self.eof:
+            data = self.fp.read(n - len(self.buf))
+            if data:
+                self.buf += data
+            else:
+                self.eof = True
+        return len(self.buf)
+
+    def drop(self, n: int):
+        del self.buf[:n]
+        self.pos += n
+
+    def chunks(self, size: int):
+        # 依次产出接下来的 size 字节, 数据不足时报错
+        while size > 0:
+            if self.buf:
+                n = min(size, len(self.buf), self.chunk)
+                data = bytes(self.buf[:n])
+                self.drop(n)
+            else:
+                data = b"" if self.eof else self.fp.read(min(size, self.chunk))
+                if not data:
+                    self.eof = True
+                    raise ValueError("Unexpected end of stream at [%u]" % self.pos)
+                self.pos += len(data)
+            size -= len(data)
+            yield data
+
+    def skip(self, pos: int):
+        # 丢弃到 pos 为止的数据; 流提前结束时停在末尾
+        if pos < self.pos:
+            raise ValueError("Cannot seek backwards to [%u]" % pos)
+        n = min(pos - self.pos, len(self.buf))
+        self.drop(n)
+        while self.pos < pos and not self.eof:
+            data = self.fp.read(min(pos - self.pos, self.chunk))
+            if not data:
+                self.eof = True
+            self.pos += len(data)
+
+    def drain(self):
+        self.drop(len(self.buf))
+        while not self.eof:
+            data = self.fp.read(self.chunk)
+            if not data:
+                self.eof = True
+            self.pos += len(data)
+
+    def probe(self, size: int):
+        # 组件开头的少量字节, 只用于判断格式; LZ4_LG 需要整个组件才能区分, 这里不区分
+        n = self.fill(min(size, INFO_PROBE_SZ))
+        return check_fmt(bytes(self.buf[:n]), n)
+
+class _DtbSplitter:
+    # 在流过的 kernel 中查找第一个合法的 fdt 头 (规则同 find_dtb_offset)
+    # kernel() 产出之前的部分, 找到后 dtb() 产出剩余部分
+    def __init__(self, chunks, start: int, size: int):
+        self.it = iter(chunks)
+        # pend[0] 在组件中的位置与组件总大小, 用于判断 totalsize 是否越界
+        self.pos = start
+        self.size = size
+        self.pend = bytearray()
+        self.found = False
+
+    def _valid(self, i: int, final: bool):
+        # True / False, 或者 None: 需要更多数据才能判断
+        avail = len(self.pend) - i
+        if avail < 12:
+            return False if final else None
+        totalsize, off_dt_struct = struct.unpack_from(">II", self.pend, i + 4)
+        remain = self.size - (self.pos + i)
+        if totalsize > remain or off_dt_struct + 4 > remain or off_dt_struct + 4 > DTB_HOLD:
+            return False
+        if avail < off_dt_struct + 4:
+            return False if final else None
+        return struct.unpack_from(">I", self.pend, i + off_dt_struct)[0] == FDT_BEGIN_NODE
+
+    def kernel(self):
+        scan = 0
+        search = True
+        while True:
+            chunk = next(self.it, None)
+            final = chunk is None
+            if not final:
+                self.pend += chunk
+            safe = len(self.pend)
+            while search:
+                i = self.pend.find(DTB_MAGIC, scan)
+                if i < 0:
+                    if not final:
+                        # magic 可能跨越块边界
+                        safe = max(scan, len(self.pend) - len(DTB_MAGIC) + 1)
+                    break
+                ok = self._valid(i, final)
+                if ok is None:
+                    safe = i
+                    break
+                if ok:
+                    if self.pos + i > 0:
+                        if i:
+                            yield bytes(self.pend[:i])
+                            del self.pend[:i]
+                            self.pos += i
+                        self.found = True
+                        return
+                    # 位于组件开头的 fdt 不拆分, 与 find_dtb_offset 返回 0 相同
+                    search = False
+                    break
+                scan = i + 40 # sizeof(fdt_header)
+            safe = min(safe, len(self.pend))
+            if safe:
+                yield bytes(self.pend[:safe])
+                del self.pend[:safe]
+                self.pos += safe
+                scan = max(scan - safe, 0)
+            if final:
+                return
+
+    def dtb(self):
+        if not self.found:
+            return
+        if self.pend:
+            yield bytes(self.pend)
+            self.pend.clear()
+        yield from self.it
+
+def _lz4_workers(mem_limit: int, chunk: int, workers: int):
+    # lz4 legacy 每个线程占用一个输入槽位和一个输出块, 其余格式每次输出不超过 CHUNK
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    fixed = INFO_HEAD_SZ + chunk + CHUNK + DTB_HOLD
+    return max(0, min(workers, (mem_limit - fixed) // (2 * LZ4_BLOCK_BOUND)))
+
+def _print_mtk(reader: _Reader, name: str):
+    hdr = MtkHdr.from_buffer_copy(bytes(reader.buf[:sizeof(MtkHdr)]))
+    print(name)
+    print("%-*s [%u]" %(PADDING, "SIZE", hdr.size))
+    print("%-*s [%s]" %(PADDING, "NAME", hdr.name.decode(errors="replace")))
+
+def _locate(reader: _Reader, flags: set):
+    # 与 BootImage 相同的规则查找头部, 跳过 CHROMEOS / DHTB / BLOB 以及 loader 等前置数据
+    # 返回的头部对象基于拷贝, reader.pos 停在头部起点
+    while True:
+        n = reader.fill(INFO_HEAD_SZ)
+        m = BootImage._HDR_RE.search(reader.buf)
+        if m is None:
+            if reader.eof:
+                raise ValueError("Invalid boot image")
+            # magic 可能跨越窗口边界
+            reader.drop(n - 0x20)
+            continue
+        reader.drop(m.start())
+        n = reader.fill(INFO_HEAD_SZ)
+        fmt = check_fmt(reader.buf, n)
+        skip = 1
+        if fmt == Format.CHROMEOS:
+            flags.add(BootFlag.CHROMEOS_FLAG)
+            skip = 65536
+        elif fmt == Format.DHTB:
+            flags.update((BootFlag.DHTB_FLAG, BootFlag.SEANDROID_FLAG))
+            print("DHTB_HDR")
+            skip = sizeof(DhtbHdr)
+        elif fmt == Format.BLOB:
+            flags.add(BootFlag.BLOB_FLAG)
+            print("TEGRA_BLOB")
+            skip = sizeof(BlobHdr)
+        elif fmt in (Format.AOSP, Format.AOSP_VENDOR):
+            hdr = _create_hdr(reader, fmt, flags)
+            if hdr is not None:
+                return hdr
+        reader.skip(reader.pos + skip)
+
+def _create_hdr(reader: _Reader, fmt: Format, flags: set):
+    try:
+        head = bytes(reader.buf)
+        if fmt == Format.AOSP_VENDOR:
+            print("VENDOR_BOOT_HDR")
+            cls = hdr_class(head, 0, fmt)
+        elif DynImgV0(head, 0).page_size >= 0x02000000:
+            print("PXA_BOOT_HDR")
+            cls = DynImgPxa
+        else:
+            flag, shift = pre_header(DynImgV0(head, 0))
+            if flag is not None:
+                flags.add(flag)
+                print("NOOKHD_LOADER" if flag == BootFlag.NOOKHD_FLAG else "ACCLAIM_LOADER")
+                reader.skip(reader.pos + shift)
+                reader.fill(INFO_HEAD_SZ)
+                head = bytes(reader.buf)
+            cls = hdr_class(head, 0, fmt)
+        hdr = cls(head, 0)
+    except ValueError:
+        # 头部超出流末尾
+        return None
+    if hdr.page_size == 0 or reader.fill(hdr.hdr_space()) < hdr.hdr_space():
+        return None
+    # 拷贝一份可写的头部, 之后 reader.buf 会被截断
+    return cls(bytearray(reader.buf[:hdr.hdr_space()]), 0)
+
+def _file_chunks(f, off: int, size: int, chunk: int):
+    while size > 0:
+        data = _pread(f, off, min(size, chunk))
+        if not data:
+            return
+        off += len(data)
+        size -= len(data)
+        yield data
+
+def unpack_stream(fp, skip_decomp: bool = False, hdr: bool = False,
+                  mem_limit: int = STREAM_MEM_LIMIT, workers: int = 0):
+    # 从任意可读对象 (例如 stdin 管道) 顺序解包, 不 seek 也不映射整个镜像
+    # 组件按头部给出的大小与页对齐依次路由到各自的输出, 内存占用不超过 mem_limit
+    # 输出文件与 unpack() 相同; v4 vendor ramdisk 的表位于 ramdisk 之后, 先暂存到磁盘再拆分
+    chunk = min(CHUNK, max(mem_limit // 16, 0x1000))
+    lz4_workers = _lz4_workers(mem_limit, chunk, workers)
+    reader = _Reader(fp, chunk)
+    flags = set()
+    sums = {}
+
+    def dump(chunks, filename, fmt=Format.UNKNOWN):
+        raw, src = hashlib.sha1(), hashlib.sha1()
+
+        def hashed():
+            for data in chunks:
+                src.update(data)
+                sp.add("bytes_in", len(data))
+                yield data
+
+        with trace.span("dump", component=filename, format=fmt2name(fmt)) as sp, \
+                open(filename, 'wb') as fd:
+            out = HashedWriter(fd, raw)
+            it = hashed()
+            if not skip_decomp and COMPRESSED(fmt):
+                if fmt in (Format.LZ4_LEGACY, Format.LZ4_LG) and not lz4_workers:
+                    raise ValueError("Memory limit [%u] is too small for [%s]" %(mem_limit, fmt2name(fmt)))
+                it = decode(fmt, it, lz4_workers)
+            for data in it:
+                out.write(data)
+            sp.set("bytes_out", fd.tell())
+        sums[filename] = (raw.hexdigest(), src.hexdigest())
+
+    def strip_mtk(size, name, flag):
+        fmt = reader.probe(size)
+        if fmt == Format.MTK and size > sizeof(MtkHdr):
+            flags.add(flag)
+            _print_mtk(reader, name)
+            reader.skip(reader.pos + sizeof(MtkHdr))
+            size -= sizeof(MtkHdr)
+            fmt = reader.probe(size)
+        return fmt, size
+
+    with trace.span("unpack_stream", mem_limit=mem_limit) as sp:
+        head = _locate(reader, flags)
+        head.print()
+        if hdr:
+            head.dump_hdr_file()
+
+        base = reader.pos
+        page_size = head.page_size
+        blocks = {}
+        off = head.hdr_space()
+        for name in ("kernel", "ramdisk", "second", "extra", "recovery_dtbo", "dtb",
+                     "signature", "vendor_ramdisk_table", "bootconfig"):
+            size = getattr(head, name + "_size")
+            blocks[name] = (base + off, size)
+            off = align_to(off + size, page_size)
+
+        koff, ksize = blocks["kernel"]
+        if ksize:
+            reader.skip(koff)
+            start = 0
+            reader.fill(min(ksize, INFO_PROBE_SZ))
+            if reader.buf[:len(AMONET_MICROLOADER_MAGIC)] == AMONET_MICROLOADER_MAGIC:
+                flags.add(BootFlag.AMONET_FLAG)
+                print("AMONET_MICROLOADER")
+                reader.skip(reader.pos + AMONET_MICROLOADER_SZ)
+                start = AMONET_MICROLOADER_SZ
+            k_fmt, size = strip_mtk(ksize - start, "MTK_KERNEL_HDR", BootFlag.MTK_KERNEL)
+            start = ksize - size
+            if k_fmt == Format.ZIMAGE:
+                # piggy 的结束位置在 zImage 末尾, 顺序读取时无法预先拆分
+                print("! Streaming does not split zImage, keeping raw kernel")
+            print("%-*s [%s]" %(PADDING, "KERNEL_FMT", fmt2name(k_fmt)))
+            splitter = _DtbSplitter(reader.chunks(size), start, ksize)
+            dump(splitter.kernel(), KERNEL_FILE, k_fmt)
+            if splitter.found:
+                dt_size = ksize - splitter.pos
+                print("%-*s [%u]" %(PADDING, "KERNEL_DTB_SZ", dt_size))
+                dump(splitter.dtb(), KER_DTB_FILE)
+
+        roff, rsize = blocks["ramdisk"]
+        spool = None
+        if rsize:
+            reader.skip(roff)
+            if head.is_vendor and head.header_version >= 4:
+                # 片段的位置要等读到 vendor ramdisk 表才知道, 原样暂存到磁盘
+                import tempfile
+                os.makedirs(VND_RAMDISK_DIR, exist_ok=True)
+                spool = tempfile.TemporaryFile(dir=VND_RAMDISK_DIR)
+                with trace.span("spool", component="ramdisk", bytes_in=rsize):
+                    for data in reader.chunks(rsize):
+                        spool.write(data)
+                spool.flush()
+                print("%-*s [%s]" %(PADDING, "RAMDISK_FMT", fmt2name(Format.UNKNOWN)))
+            else:
+                r_fmt, rsize = strip_mtk(rsize, "MTK_RAMDISK_HDR", BootFlag.MTK_RAMDISK)
+                print("%-*s [%s]" %(PADDING, "RAMDISK_FMT", fmt2name(r_fmt)))
+                dump(reader.chunks(rsize), RAMDISK_FILE, r_fmt)
+
+        for name, filename in (("second", SECOND_FILE), ("extra", EXTRA_FILE),
+                               ("recovery_dtbo", RECV_DTBO_FILE), ("dtb", DTB_FILE)):
+            coff, csize = blocks[name]
+            if not csize:
+                continue
+            reader.skip(coff)
+            fmt = Format.UNKNOWN
+            if name == "extra":
+                fmt = reader.probe(csize)
+                print("%-*s [%s]" %(PADDING, "EXTRA_FMT", fmt2name(fmt)))
+            dump(reader.chunks(csize), filename, fmt)
+
+        if spool is not None:
+            with spool:
+                toff, tsize = blocks["vendor_ramdisk_table"]
+                entries = []
+                if tsize:
+                    reader.skip(toff)
+                    table = b"".join(reader.chunks(tsize))
+                    esize = head.vendor_ramdisk_table_entry_size
+                    for i in range(head.vendor_ramdisk_table_entry_num):
+                        if (i + 1) * esize > len(table) or esize < sizeof(VendorRamdiskTableEntryV4):
+                            break
+                        entries.append(VendorRamdiskTableEntryV4.from_buffer_copy(table, i * esize))
+                if not entries:
+                    dump(_file_chunks(spool, 0, rsize, chunk), RAMDISK_FILE)
+                for entry in entries:
+                    foff = min(entry.ramdisk_offset, rsize)
+                    fsize = min(entry.ramdisk_size, rsize - foff)
+                    probe = _pread(spool, foff, min(fsize, INFO_PROBE_SZ))
+                    fmt = check_fmt(probe, len(probe))
+                    print("%-*s [%s] type=[%u] size=[%u] fmt=[%s]" %(PADDING, "VND_RAMDISK",
+                          vendor_ramdisk_name(entry), entry.ramdisk_type, entry.ramdisk_size, fmt2name(fmt)))
+                    dump(_file_chunks(spool, foff, fsize, chunk), vendor_ramdisk_file(entry), fmt)
+
+        # 最后一个组件之后: 尾部标记, 其余数据 (AVB footer 等) 读完丢弃
+        reader.skip(base + off)
+        if reader.fill(16) >= 16:
+            if reader.buf[:16] == SEANDROID_MAGIC:
+                print("SAMSUNG_SEANDROID")
+                flags.add(BootFlag.SEANDROID_FLAG)
+            elif reader.buf[:16] == LG_BUMP_MAGIC:
+                print("LG_BUMP_IMAGE")
+                flags.add(BootFlag.LG_BUMP_FLAG)
+        reader.drain()
+        sp.set("bytes_in", reader.pos)
+
+        with open(CHECKSUM_FILE, 'w') as fp:
+            for name, (raw, src) in sums.items():
+                print("%s=%s %s" %(name, raw, src), file=fp)
+
+        return 2 if BootFlag.CHROMEOS_FLAG in flags else 0
@@ -0,0 +1,219 @@
+import os
+import threading
+import time
+
+try:
+    import resource
+    _RUSAGE = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+except ImportError:
+    # Windows 没有 resource 模块, 不记录缺页次数
+    resource = None
+
+# 当前的收集器; 为 None 时所有钩子都是空操作, 调用方只多一次全局变量判断
+tracer = None
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, key, n):
+        pass
+
+    def set(self, key, value):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+def span(name: str, cat: str = "magiskboot", **args):
+    # with span("dump", component="kernel") as s: s.add("bytes_out", n)
+    if tracer is None:
+        return _NULL_SPAN
+    return tracer.span(name, cat, args)
+
+def count(name: str, n: int):
+    if tracer is not None:
+        tracer.count(name, n)
+
+def stream(name: str, codec, chunks, **args):
+    # 等同于 codec.transform(chunks), 记录时附带字节数与编解码耗时
+    if tracer is None:
+        return codec.transform(chunks)
+    return tracer.stream(name, codec, chunks, args)
+
+class Span:
+    __slots__ = ("collector", "name", "cat", "args", "start", "faults")
+
+    def __init__(self, collector, name, cat, args):
+        self.collector = collector
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        if self.collector.faults:
+            ru = resource.getrusage(_RUSAGE)
+            self.faults = (ru.ru_minflt, ru.ru_majflt)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        if self.collector.faults:
+            ru = resource.getrusage(_RUSAGE)
+            self.args["minflt"] = ru.ru_minflt - self.faults[0]
+            self.args["majflt"] = ru.ru_majflt - self.faults[1]
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.collector._record(self, end)
+        return False
+
+    def add(self, key, n):
+        self.args[key] = self.args.get(key, 0) + n
+
+    def set(self, key, value):
+        self.args[key] = value
+
+class TraceCollector:
+    # 记录带时间的 span 和字节计数器, 可输出为 JSON 或 Chrome trace (chrome://tracing / Perfetto)
+    # with TraceCollector() as t:
+    #     repack("boot.img", "new-boot.img")
+    # t.write_chrome_trace("repack.trace.json")
+    def __init__(self, faults: bool = True):
+        self.faults = faults and resource is not None
+        self.events = []
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.t0 = time.perf_counter_ns()
+        self._prev = None
+
+    def install(self):
+        global tracer
+        self._prev = tracer
+        tracer = self
+        return self
+
+    def uninstall(self):
+        global tracer
+        tracer = self._prev
+        self._prev = None
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc):
+        self.uninstall()
+        return False
+
+    def span(self, name: str, cat: str = "magiskboot", args: dict = None):
+        return Span(self, name, cat, {} if args is None else args)
+
+    def _record(self, span: Span, end: int):
+        event = {
+            "name": span.name,
+            "cat": span.cat,
+            "ts": (span.start - self.t0) / 1000,
+            "dur": (end - span.start) / 1000,
+            "tid": threading.get_ident(),
+            "args": span.args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def count(self, name: str, n: int):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def stream(self, name: str, codec, chunks, args: dict = None):
+        # 包装编解码器的 transform(): 统计输入/输出字节数,
+        # codec_s 是扣除上游 (读取 / 上一级解码) 之后编解码器自身占用的时间
+        sp = self.span(name, "codec", args)
+        upstream = 0
+
+        def source():
+            nonlocal upstream
+            it = iter(chunks)
+            while True:
+                t = time.perf_counter()
+                try:
+                    data = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    upstream += time.perf_counter() - t
+                sp.add("bytes_in", len(data))
+                yield data
+
+        with sp:
+            gen = codec.transform(source())
+            busy = 0
+            try:
+                while True:
+                    t = time.perf_counter()
+                    try:
+                        out = next(gen)
+                    except StopIteration:
+                        break
+                    finally:
+                        busy += time.perf_counter() - t
+                    sp.add("bytes_out", len(out))
+                    yield out
+            finally:
+                # 调用者提前放弃时关闭编解码器, 释放其线程池
+                gen.close()
+                sp.set("codec_s", busy - upstream)
+        self.count("%s.bytes_in" % name, sp.args.get("bytes_in", 0))
+        self.count("%s.bytes_out" % name, sp.args.get("bytes_out", 0))
+
+    def summary(self):
+        # 按 span 名字汇总: 次数, 总耗时 (秒), 以及各字节计数之和
+        result = {}
+        for event in self.events:
+            item = result.setdefault(event["name"], {"count": 0, "seconds": 0.0})
+            item["count"] += 1
+            item["seconds"] += event["dur"] / 1e6
+            for key, value in event["args"].items():
+                if key.startswith("bytes") or key.endswith("flt"):
+                    item[key] = item.get(key, 0) + value
+        return result
+
+    def to_json(self):
+        return {"spans": self.events, "counters": self.counters, "summary": self.summary()}
+
+    def to_chrome_trace(self):
+        events = []
+        for event in self.events:
+            events.append(dict(event, ph="X", pid=self.pid))
+        end = max((e["ts"] + e["dur"] for e in self.events), default=0)
+        for name, value in self.counters.items():
+            events.append({"name": name, "ph": "C", "ts": end, "pid": self.pid, "args": {"value": value}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_json(self, path: str):
+        import json
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f, indent=2)
+
+    def write_chrome_trace(self, path: str):
+        import json
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+def _from_env():
+    # MAGISKBOOT_TRACE=<path> 时整个进程都记录, 退出时写出; MAGISKBOOT_TRACE_FORMAT=json|chrome (默认 chrome)
+    path = os.environ.get("MAGISKBOOT_TRACE")
+    if not path:
+        return
+    import atexit
+    collector = TraceCollector().install()
+    if os.environ.get("MAGISKBOOT_TRACE_FORMAT", "chrome") == "json":
+        atexit.register(collector.write_json, path)
+    else:
+        atexit.register(collector.write_chrome_trace, path)
+
+_from_env()
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import mmap
+import os
+
+from . import trace
+from .compress import CHUNK, encode, get_encoder, iter_chunks
+from .format import Format, fmt2name, name2fmt
+from .magiskboot import TUNE_FILE
+
+# 按解压速度从快到慢排列; 同一格式内等级只影响压缩速度和大小, 解压速度基本不变
+DECODE_ORDER = (Format.LZ4_LEGACY, Format.LZ4_LG, Format.LZ4, Format.GZIP,
+                Format.LZMA, Format.XZ, Format.BZIP2)
+LEVELS = {
+    Format.LZ4_LEGACY: (1, 9, 12),
+    Format.LZ4_LG: (1, 9, 12),
+    Format.LZ4: (1, 9, 12),
+    Format.GZIP: (1, 6, 9),
+    Format.LZMA: (0, 6, 9),
+    Format.XZ: (0, 6, 9),
+    Format.BZIP2: (1, 9),
+}
+
+# 估算时抽样的块数与块大小; 不超过 SAMPLE_BLOCKS * SAMPLE_SZ 的组件直接整体压缩
+SAMPLE_BLOCKS = 8
+SAMPLE_SZ = CHUNK
+
+_usable = {}
+
+def usable(fmt: Format):
+    # 缺少可选依赖 (lz4 / zopfli) 的格式不参与搜索
+    if fmt not in _usable:
+        try:
+            get_encoder(fmt)
+            _usable[fmt] = True
+        except (RuntimeError, ValueError):
+            _usable[fmt] = False
+    return _usable[fmt]
+
+def candidates(formats):
+    # formats 中可用的 (格式, 等级), 解压最快的在前, 同一格式内等级从低到高
+    return [(fmt, level) for fmt in DECODE_ORDER if fmt in formats and usable(fmt)
+            for level in LEVELS[fmt]]
+
+def _compressed_size(fmt: Format, level: int, data):
+    return sum(len(c) for c in encode(fmt, iter_chunks(data), 1, level))
+
+def estimate(buf, fmt: Format, level: int):
+    # 均匀抽取若干块分别压缩, 按压缩率推算整体大小; 各块独立压缩, 结果略偏大
+    size = len(buf)
+    if size <= SAMPLE_BLOCKS * SAMPLE_SZ:
+        return _compressed_size(fmt, level, buf)
+    step = (size - SAMPLE_SZ) // (SAMPLE_BLOCKS - 1)
+    raw = comp = 0
+    for i in range(SAMPLE_BLOCKS):
+        block = buf[i * step:i * step + SAMPLE_SZ]
+        raw += len(block)
+        comp += _compressed_size(fmt, level, block)
+    return comp * size // raw
+
+def _pool(workers: int):
+    from concurrent.futures import ThreadPoolExecutor
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return ThreadPoolExecutor(max_workers=workers)
+
+def _load_cache(path: str):
+    try:
+        with open(path, 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+def _save_cache(path: str, cache: dict):
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as fp:
+        json.dump(cache, fp, indent=2)
+    os.replace(tmp, path)
+
+def tune(components, budget: int, workers: int = 0, cache: str = TUNE_FILE, cost=sum):
+    # components: [(文件名, 允许的格式), ...]; 在 budget 字节内为每个组件选出解压最快的 (格式, 等级)
+    # cost: 由各组件压缩后的大小 (按 components 顺序) 计算占用的字节数, 默认直接相加; repack 传入按页对齐的计算
+    # 先用抽样估算贪心搜索, 选定后实际压缩确认, 超出时用实际大小继续搜索
+    # 返回 {文件名: {"format", "level", "data"}}, data 为压缩结果, repack 直接写出
+    # 选择按 (各输入的 sha1, 允许的格式, budget) 缓存在 cache 文件中
+    maps, bufs, cands, digests = [], [], [], []
+    try:
+        for name, formats in components:
+            with open(name, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+            maps.append(m)
+            bufs.append(memoryview(m))
+            cands.append(candidates(formats))
+            digests.append(hashlib.sha1(m).hexdigest())
+            if not cands[-1]:
+                raise ValueError("No usable compression format for [%s]" % name)
+        key = hashlib.sha1(json.dumps([budget] + [
+            [name, digest, [fmt2name(f) for f, _ in c]]
+            for (name, _), digest, c in zip(components, digests, cands)]).encode()).hexdigest()
+        with trace.span("tune", components=len(components), budget=budget) as sp, _pool(workers) as pool:
+            plan = _search(components, bufs, cands, budget, cost, pool, _load_cache(cache).get(key), sp)
+        saved = _load_cache(cache)
+        saved[key] = {name: [fmt2name(p["format"]), p["level"]] for name, p in plan.items()}
+        _save_cache(cache, saved)
+        return plan
+    finally:
+        del bufs
+        for m in maps:
+            if isinstance(m, mmap.mmap):
+                try:
+                    m.close()
+                except BufferError:
+                    pass
+
+def _search(components, bufs, cands, budget, cost, pool, cached, sp):
+    n = len(components)
+    sizes = {}
+    exact = {}
+    idx = [0] * n
+    if cached:
+        # 命中缓存: 直接从上次的选择开始, 通常一次实际压缩就能确认
+        for i, (name, _) in enumerate(components):
+            choice = cached.get(name)
+            if choice is not None:
+                cand = (name2fmt(choice[0]), choice[1])
+                if cand in cands[i]:
+                    idx[i] = cands[i].index(cand)
+        sp.set("cached", True)
+
+    def trial(i, j):
+        fmt, level = cands[i][j]
+        return estimate(bufs[i], fmt, level)
+
+    def need(pairs):
+        pairs = [p for p in pairs if p not in sizes and p not in exact]
+        for p, size in zip(pairs, pool.map(lambda p: trial(*p), pairs)):
+            sizes[p] = size
+        sp.add("trials", len(pairs))
+
+    def size(p):
+        return exact.get(p, sizes.get(p))
+
+    while True:
+        need([(i, idx[i]) for i in range(n)])
+        while cost([size((i, idx[i])) for i in range(n)]) > budget:
+            # 每个组件换到下一个候选, 取节省最多的那个
+            nxt = [(i, idx[i] + 1) for i in range(n) if idx[i] + 1 < len(cands[i])]
+            if not nxt:
+                total = cost([size((i, idx[i])) for i in range(n)])
+                raise ValueError("Components need [%u] bytes, over the budget [%u]" % (total, budget))
+            need(nxt)
+            i, j = max(nxt, key=lambda p: size((p[0], idx[p[0]])) - size(p))
+            idx[i] = j
+
+        # 实际压缩选中的候选
+        def run(i):
+            fmt, level = cands[i][idx[i]]
+            return b"".join(encode(fmt, iter_chunks(bufs[i]), 1, level))
+        datas = list(pool.map(run, range(n)))
+        for i, data in enumerate(datas):
+            exact[(i, idx[i])] = len(data)
+        if cost([len(d) for d in datas]) <= budget:
+            break
+
+    plan = {}
+    for i, (name, _) in enumerate(components):
+        fmt, level = cands[i][idx[i]]
+        plan[name] = {"format": fmt, "level": level, "data": datas[i]}
+        print("Tune [%s] -> [%s] level [%d] size [%u]" % (name, fmt2name(fmt), level, len(datas[i])))
+    sp.set("bytes_out", sum(len(d) for d in datas))
+    return plan
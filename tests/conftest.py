@@ -0,0 +1,37 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+# 仓库没有打包配置, 直接从源码目录导入 magiskboot
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from magiskboot import cache
+from magiskboot.corpus import build_image
+
+HAS_LZ4 = importlib.util.find_spec("lz4") is not None
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # unpack / repack 在 cwd 中读写组件文件; 组件缓存保持关闭
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cache, "active", None)
+    return tmp_path
+
+@pytest.fixture
+def image(workdir):
+    # image("v2", wrappers=("avb",)) -> 在 workdir 中生成镜像, 返回文件名
+    def make(layout="v2", name="boot.img", **kwargs):
+        kwargs.setdefault("kernel_size", 0x40000)
+        kwargs.setdefault("ramdisk_size", 0x20000)
+        if layout == "v4":
+            # v4 boot 的 ramdisk 在 repack 时固定为 lz4_legacy
+            if not HAS_LZ4:
+                pytest.skip("v4 boot images need the 'lz4' package")
+            from magiskboot.format import Format
+            kwargs.setdefault("ramdisk_codec", Format.LZ4_LEGACY)
+        with open(workdir / name, 'wb') as f:
+            f.write(build_image(layout, **kwargs))
+        return name
+    return make
@@ -0,0 +1,31 @@
+import asyncio
+import time
+
+from magiskboot import aio
+from magiskboot.bootimg import unpack
+from magiskboot.magiskboot import CHECKSUM_FILE
+
+def test_executors_across_event_loops():
+    # 同一个 Executors 在多次 asyncio.run 中使用, 并发数超过信号量上限
+    ex = aio.Executors(io_workers=2, backlog=1)
+
+    async def main():
+        await asyncio.gather(*(ex.io(time.sleep, 0.001) for _ in range(40)))
+
+    try:
+        asyncio.run(main())
+        asyncio.run(main())
+    finally:
+        ex.shutdown()
+
+def test_unpack_matches_sync(image, workdir):
+    src = image("vendor_v4")
+    unpack(src)
+    ex = aio.Executors()
+    try:
+        asyncio.run(aio.unpack(src, "out", ex=ex))
+    finally:
+        ex.shutdown()
+    for path in (workdir / "out").rglob("*"):
+        if path.is_file() and path.name != CHECKSUM_FILE:
+            assert path.read_bytes() == (workdir / path.relative_to(workdir / "out")).read_bytes()
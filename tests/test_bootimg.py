@@ -0,0 +1,125 @@
+import os
+
+import pytest
+
+from magiskboot import cache, trace
+from magiskboot.bootimg import BootImage, repack, unpack
+from magiskboot.corpus import LAYOUTS, WRAPPERS, _boot_id
+from magiskboot.format import Format
+from magiskboot.magiskboot import CHECKSUM_FILE, KERNEL_FILE
+from magiskboot.stream import unpack_stream
+
+def _files(root):
+    # {相对路径: 内容}; 校验和文件的行顺序与写出顺序有关, 按行排序后比较
+    result = {}
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            if name == CHECKSUM_FILE:
+                data = b"".join(sorted(data.splitlines(True)))
+            result[os.path.relpath(path, root)] = data
+    return result
+
+def _unpack_to(workdir, name, src, **kwargs):
+    out = workdir / name
+    out.mkdir()
+    os.chdir(out)
+    try:
+        unpack(str(workdir / src), **kwargs)
+    finally:
+        os.chdir(workdir)
+    return out
+
+@pytest.mark.parametrize("wrappers", [()] + [(w,) for w in WRAPPERS] + [("dhtb", "avb"), ("mtk", "seandroid")])
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_round_trip(image, workdir, layout, wrappers):
+    src = image(layout, wrappers=wrappers)
+    unpack(src)
+    repack(src, "new-boot.img")
+    assert (workdir / "new-boot.img").read_bytes() == (workdir / src).read_bytes()
+
+@pytest.mark.parametrize("codec", [Format.XZ, Format.LZMA, Format.BZIP2])
+def test_round_trip_codecs(image, workdir, codec):
+    src = image("v2", codec=codec)
+    unpack(src)
+    repack(src, "new-boot.img")
+    assert (workdir / "new-boot.img").read_bytes() == (workdir / src).read_bytes()
+
+@pytest.mark.parametrize("layout", ["v0", "v1", "v2"])
+def test_boot_id(image, workdir, layout):
+    # 修改 kernel 后 id 按新的组件重新计算
+    src = image(layout)
+    unpack(src)
+    with open(KERNEL_FILE, 'ab') as f:
+        f.write(b"modified")
+    repack(src, "new-boot.img")
+    boot = BootImage("new-boot.img")
+    try:
+        blocks = [boot.kernel, boot.ramdisk, boot.second, boot.extra, boot.recovery_dtbo, boot.dtb]
+        expect = _boot_id([bytes(b) for b in blocks], boot.hdr.header_version)
+        assert boot.hdr.id[:len(expect)] == expect
+    finally:
+        boot.close()
+
+@pytest.mark.parametrize("wrappers", [("avb",), ("dhtb", "avb")])
+def test_avb_update(image, workdir, wrappers):
+    src = image("v2", wrappers=wrappers)
+    boot = BootImage(src)
+    try:
+        assert boot.verify()
+    finally:
+        boot.close()
+    unpack(src)
+    with open(KERNEL_FILE, 'ab') as f:
+        f.write(b"modified")
+    repack(src, "stale.img")
+    repack(src, "new-boot.img", update_avb=True)
+    for name, ok in (("stale.img", False), ("new-boot.img", True)):
+        boot = BootImage(name)
+        try:
+            assert boot.verify() == ok
+        finally:
+            boot.close()
+
+@pytest.mark.parametrize("wrappers", [(), ("avb",), ("mtk",)])
+@pytest.mark.parametrize("layout", ["v0", "v2", "v3", "vendor_v3", "vendor_v4"])
+def test_unpack_stream(image, workdir, layout, wrappers):
+    src = image(layout, wrappers=wrappers)
+    ref = _unpack_to(workdir, "ref", src, hdr=True)
+    out = workdir / "stream"
+    out.mkdir()
+    os.chdir(out)
+    try:
+        with open(workdir / src, 'rb') as fp:
+            unpack_stream(fp, hdr=True, mem_limit=0x10000)
+    finally:
+        os.chdir(workdir)
+    assert _files(out) == _files(ref)
+
+@pytest.mark.parametrize("layout", ["v2", "v3", "vendor_v4"])
+def test_tune_fits_original_size(image, workdir, layout):
+    src = image(layout, wrappers=("dhtb",))
+    size = os.path.getsize(src)
+    unpack(src)
+    repack(src, "new-boot.img", size_limit=size)
+    assert os.path.getsize("new-boot.img") <= size
+    # 压缩参数可能变化, 只比较解压后的组件
+    new = _files(_unpack_to(workdir, "new", "new-boot.img"))
+    orig = _files(_unpack_to(workdir, "orig", src))
+    del new[CHECKSUM_FILE], orig[CHECKSUM_FILE]
+    assert new == orig
+
+def test_cache_hit_matches_miss(image, workdir, monkeypatch):
+    src = image("vendor_v4")
+    monkeypatch.setattr(cache, "active", cache.ComponentCache(str(workdir / "cache")))
+    tracer = trace.TraceCollector().install()
+    try:
+        miss = _files(_unpack_to(workdir, "miss", src))
+        assert not tracer.counters.get("cache.hit")
+        hit = _files(_unpack_to(workdir, "hit", src))
+        assert tracer.counters.get("cache.hit")
+    finally:
+        tracer.uninstall()
+    assert hit == miss
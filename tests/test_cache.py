@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from magiskboot import cache
+from magiskboot.compress import encode
+from magiskboot.format import Format
+
+DATA = os.urandom(0x20000) + bytes(0x60000)
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    c = cache.ComponentCache(str(tmp_path / "cache"))
+    monkeypatch.setattr(cache, "active", c)
+    return c
+
+def _keys(c):
+    return [path for _, _, path in c.entries()]
+
+def test_hit_matches_miss(store):
+    comp = b"".join(encode(Format.XZ, [DATA]))
+    assert b"".join(cache.decode(Format.XZ, comp)) == DATA
+    assert len(_keys(store)) == 1
+    assert store.open(store.key(Format.XZ, comp)) is not None
+    assert b"".join(cache.decode(Format.XZ, comp)) == DATA
+
+def test_no_commit_on_error(store):
+    comp = b"".join(encode(Format.GZIP, [DATA]))
+    with pytest.raises(ValueError):
+        b"".join(cache.decode(Format.GZIP, comp[:-100]))
+    # 中途放弃同样不写入
+    gen = cache.decode(Format.GZIP, comp)
+    next(gen)
+    gen.close()
+    assert _keys(store) == []
+    assert os.listdir(store.root) == []
@@ -0,0 +1,76 @@
+import importlib.util
+import os
+import threading
+
+import pytest
+
+from magiskboot.compress import decode, encode, get_decoder, iter_chunks
+from magiskboot.format import Format
+
+DATA = os.urandom(0x30000) + bytes(0x90000)
+
+def _codecs():
+    formats = [Format.GZIP, Format.XZ, Format.LZMA, Format.BZIP2]
+    if importlib.util.find_spec("lz4") is not None:
+        formats.append(Format.LZ4)
+    return formats
+
+def _lz4_legacy():
+    if importlib.util.find_spec("lz4") is None:
+        return []
+    return [Format.LZ4_LEGACY, Format.LZ4_LG]
+
+def _decode(fmt, buf):
+    return b"".join(decode(fmt, iter_chunks(buf, chunk=0x8000)))
+
+@pytest.mark.parametrize("fmt", _codecs())
+def test_round_trip(fmt):
+    comp = b"".join(encode(fmt, iter_chunks(DATA)))
+    assert _decode(fmt, comp) == DATA
+    # 多个串联的流, 以及流之后的填充
+    assert _decode(fmt, comp + comp) == DATA + DATA
+    assert _decode(fmt, comp + bytes(100)) == DATA
+
+@pytest.mark.parametrize("fmt", _codecs())
+def test_member_at_chunk_boundary(fmt):
+    # 前一个流恰好在输入块末尾结束, 后面的流和填充都在下一块
+    m1 = b"".join(encode(fmt, iter_chunks(DATA[:0x1000])))
+    m2 = b"".join(encode(fmt, iter_chunks(DATA[0x1000:])))
+    assert b"".join(decode(fmt, [m1, m2])) == DATA
+    assert b"".join(decode(fmt, [m1, m2[:1], m2[1:]])) == DATA
+    dec = get_decoder(fmt)
+    assert b"".join(dec.transform([m1, bytes(100)])) == DATA[:0x1000]
+    assert dec.unused == bytes(100)
+
+@pytest.mark.parametrize("fmt", _codecs() + _lz4_legacy())
+def test_truncated(fmt):
+    comp = b"".join(encode(fmt, iter_chunks(DATA)))
+    for size in (len(comp) - 1, len(comp) // 2):
+        with pytest.raises(ValueError):
+            _decode(fmt, comp[:size])
+
+@pytest.mark.parametrize("fmt", _codecs())
+def test_magic_prefix_padding(fmt):
+    # 末尾只有 magic 的第一个字节时视为填充, 不是截断的新流
+    comp = b"".join(encode(fmt, iter_chunks(DATA)))
+    assert _decode(fmt, comp + comp[:1]) == DATA
+
+@pytest.mark.parametrize("fmt", [Format.GZIP, Format.XZ])
+def test_abandoned_parallel_encoder(fmt):
+    # 调用者中途放弃时线程池随之关闭
+    before = threading.active_count()
+    gen = encode(fmt, iter_chunks(os.urandom(0x100000) * 24), 4, 1)
+    next(gen)
+    next(gen)
+    assert threading.active_count() > before
+    gen.close()
+    assert threading.active_count() == before
+
+@pytest.mark.parametrize("size", [0x1000, len(DATA)])
+def test_lz4_lg_trailer(size):
+    pytest.importorskip("lz4")
+    # 总大小字段不解压, 原样留在 unused 中
+    comp = b"".join(encode(Format.LZ4_LG, iter_chunks(DATA[:size])))
+    dec = get_decoder(Format.LZ4_LG)
+    assert b"".join(dec.transform(iter_chunks(comp, chunk=0x8000))) == DATA[:size]
+    assert bytes(dec.unused) == size.to_bytes(4, "little")
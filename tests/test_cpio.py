@@ -0,0 +1,31 @@
+import pytest
+
+from magiskboot.compress import encode
+from magiskboot.corpus import ramdisk_cpio
+from magiskboot.cpio import Cpio
+from magiskboot.format import Format
+
+@pytest.mark.parametrize("fmt", [Format.UNKNOWN, Format.GZIP, Format.XZ])
+def test_backup_restore(workdir, fmt):
+    data = ramdisk_cpio(0x20000)
+    if fmt != Format.UNKNOWN:
+        data = b"".join(encode(fmt, [data]))
+    (workdir / "ramdisk.cpio").write_bytes(data)
+    (workdir / "magiskinit").write_bytes(b"\x7fELF" + bytes(64))
+
+    with Cpio.load("ramdisk.cpio") as orig:
+        orig.dump("orig.cpio")
+        with Cpio.load("ramdisk.cpio") as c:
+            c.rm("fstab.qcom")
+            c.add(0o750, "init", "magiskinit")
+            c.mkdir(0o755, "overlay.d")
+            changes = c.backup(orig)
+            assert changes == {"add": ["overlay.d"], "modify": ["init"], "remove": ["fstab.qcom"]}
+            c.dump("patched.cpio")
+
+    with Cpio.load("patched.cpio") as c:
+        c.restore()
+        c.dump("restored.cpio")
+    with Cpio.load("restored.cpio") as restored, Cpio.load("orig.cpio") as orig:
+        assert restored.diff(orig) == {"add": [], "modify": [], "remove": []}
+    assert (workdir / "restored.cpio").read_bytes() == (workdir / "orig.cpio").read_bytes()
@@ -0,0 +1,56 @@
+import os
+
+from magiskboot.bootimg import repack, unpack
+from magiskboot.corpus import make_dtb
+from magiskboot.dtb import DtbFile
+from magiskboot.magiskboot import DTB_FILE
+
+FSTAB = "/firmware/android/fstab/system"
+
+def test_patch_in_place(workdir):
+    (workdir / "dtb").write_bytes(make_dtb() * 2)
+    size = os.path.getsize("dtb")
+    with DtbFile("dtb", write=True) as dtb:
+        assert dtb.patch()
+        # 补丁不增加长度, 不需要重建
+        assert not dtb.dirty()
+        dtb.save()
+    assert os.path.getsize("dtb") == size
+    with DtbFile("dtb") as dtb:
+        assert len(dtb.fdts) == 2
+        for fdt in dtb.fdts:
+            assert bytes(fdt.getprop(FSTAB, "fsmgr_flags")).rstrip(b"\0") == b"wait,slotselect"
+            assert b"want_initramfs" in bytes(fdt.getprop("/chosen", "bootargs"))
+        assert not dtb.patch()
+
+def test_rebuild(workdir):
+    (workdir / "dtb").write_bytes(make_dtb() * 2)
+    with DtbFile("dtb") as dtb:
+        fdt = dtb.fdts[1]
+        assert not fdt.setprop(FSTAB, "fsmgr_flags", b"wait,slotselect,avb=vbmeta,first_stage_mount\0")
+        assert not fdt.setprop("/chosen", "serialno", b"0123456789\0")
+        dtb.save("new-dtb")
+    with DtbFile("new-dtb") as dtb:
+        assert len(dtb.fdts) == 2
+        first, second = dtb.fdts
+        assert bytes(first.getprop(FSTAB, "fsmgr_flags")) == b"wait,slotselect,avb\0"
+        assert bytes(second.getprop(FSTAB, "fsmgr_flags")) == b"wait,slotselect,avb=vbmeta,first_stage_mount\0"
+        assert bytes(second.getprop("/chosen", "serialno")) == b"0123456789\0"
+        assert second.nodes.keys() == first.nodes.keys()
+        for path, props in first.nodes.items():
+            for name in props:
+                if (path, name) != (FSTAB, "fsmgr_flags"):
+                    assert bytes(second.getprop(path, name)) == bytes(first.getprop(path, name))
+
+def test_patch_boot_dtb(image, workdir):
+    src = image("v2")
+    unpack(src)
+    with DtbFile(DTB_FILE, write=True) as dtb:
+        assert dtb.patch()
+        dtb.save()
+    patched = (workdir / DTB_FILE).read_bytes()
+    repack(src, "new-boot.img")
+    os.mkdir("new")
+    os.chdir("new")
+    unpack(str(workdir / "new-boot.img"))
+    assert (workdir / "new" / DTB_FILE).read_bytes() == patched
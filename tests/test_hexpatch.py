@@ -0,0 +1,103 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from magiskboot.bootimg import check_fmt_lg
+from magiskboot.compress import encode
+from magiskboot.format import Format
+from magiskboot.hexpatch import HexPatchStream, hexpatch_buf, hexpatch_compressed
+
+def _stream(data, patches, sizes):
+    # 按 sizes 循环切块后喂给 HexPatchStream
+    chunks, pos, i = [], 0, 0
+    while pos < len(data):
+        n = sizes[i % len(sizes)]
+        chunks.append(data[pos:pos + n])
+        pos += n
+        i += 1
+    s = HexPatchStream(patches)
+    return b"".join(s.transform(chunks)), s.records
+
+def test_patch_longer_than_pattern_across_split():
+    data = b"A" * 10 + b"XY" + b"B" * 10
+    patches = [("5859", "0102030405")]
+    expect = b"A" * 10 + b"\x01\x02\x03\x04\x05" + b"B" * 7
+    for cut in range(len(data) + 1):
+        s = HexPatchStream(patches)
+        assert b"".join(s.transform([data[:cut], data[cut:]])) == expect
+        assert s.records == [(10, "5859")]
+
+@pytest.mark.parametrize("sizes", [(1,), (2,), (3,), (7,), (5, 1, 9), (64,), (1 << 20,)])
+def test_chunk_size_independent(sizes):
+    data = (b"\x00" * 5 + b"XY" + b"Z" * 3 + b"abc" + b"\x11" * 6) * 40 + b"XY"
+    patches = [("5859", "0102030405"), ("616263", "7a"), ("5a5a", "")]
+    ref, ref_records = _stream(data, patches, (len(data),))
+    out, records = _stream(data, patches, sizes)
+    assert out == ref
+    assert records == ref_records
+    assert len(out) == len(data)
+
+def test_matches_hexpatch_buf():
+    # 补丁互不重叠时, 流式结果与整块修改相同
+    data = bytes(range(256)) * 8
+    patches = [("0a0b0c", "ffff"), ("7f80", "00112233")]
+    buf = bytearray(data)
+    records = hexpatch_buf(buf, patches)
+    out, stream_records = _stream(data, patches, (13,))
+    assert out == bytes(buf)
+    assert stream_records == records
+
+@pytest.mark.parametrize("fmt", [Format.GZIP, Format.XZ, Format.LZ4_LEGACY, Format.LZ4_LG])
+def test_compressed_keeps_format(tmp_path, fmt):
+    if fmt in (Format.LZ4_LEGACY, Format.LZ4_LG):
+        pytest.importorskip("lz4")
+    data = b"HELLO" + bytes(1 << 20) + b"HELLO"
+    path = tmp_path / "kernel"
+    path.write_bytes(b"".join(encode(fmt, [data])))
+    records = hexpatch_compressed(str(path), [("48454c4c4f", "4a454c4c4f")])
+    assert [off for off, _ in records] == [0, len(data) - 5]
+    new = path.read_bytes()
+    # LZ4_LG 的总大小字段只有一个, 且与重新压缩的结果相同
+    assert check_fmt_lg(new, len(new)) == fmt
+    assert new == b"".join(encode(fmt, [data.replace(b"HELLO", b"JELLO")]))
+
+def test_compressed_no_match_untouched(tmp_path, monkeypatch):
+    hp = sys.modules["magiskboot.hexpatch"]
+    path = tmp_path / "kernel"
+    raw = b"".join(encode(Format.GZIP, [bytes(1 << 16)]))
+    path.write_bytes(raw)
+    # 没有匹配时不应重新压缩
+    monkeypatch.setattr(hp, "get_encoder", lambda fmt: pytest.fail("encoded without a match"))
+    assert hexpatch_compressed(str(path), [("48454c4c4f", "4a454c4c4f")]) == []
+    assert path.read_bytes() == raw
+    assert os.listdir(tmp_path) == ["kernel"]
+
+def test_compressed_dry_run_finds_all(tmp_path):
+    path = tmp_path / "kernel"
+    raw = b"".join(encode(Format.GZIP, [b"HELLO" + bytes(1 << 16) + b"HELLO"]))
+    path.write_bytes(raw)
+    records = hexpatch_compressed(str(path), [("48454c4c4f", "4a454c4c4f")], dry_run=True)
+    assert len(records) == 2
+    assert path.read_bytes() == raw
+
+def test_compressed_keeps_mode(tmp_path):
+    path = tmp_path / "kernel"
+    path.write_bytes(b"".join(encode(Format.GZIP, [b"HELLO"])))
+    os.chmod(path, 0o644)
+    hexpatch_compressed(str(path), [("48454c4c4f", "4a454c4c4f")])
+    assert os.stat(path).st_mode & 0o777 == 0o644
+    assert os.listdir(tmp_path) == ["kernel"]
+
+def test_compressed_concurrent(tmp_path):
+    # 各文件的临时文件互不冲突
+    paths = []
+    for i in range(4):
+        path = tmp_path / ("kernel%d" % i)
+        path.write_bytes(b"".join(encode(Format.GZIP, [b"HELLO" * 1000])))
+        paths.append(str(path))
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda p: hexpatch_compressed(p, [("48454c4c4f", "4a454c4c4f")]), paths))
+    assert all(len(r) == 1000 for r in results)
+    assert sorted(os.listdir(tmp_path)) == ["kernel%d" % i for i in range(4)]